@@ -1,16 +1,23 @@
 import cProfile
 import logging
 import pstats
+import queue
 import sys
-from time import sleep
+import threading
+from typing import TYPE_CHECKING, Any, List, Optional, Sequence, Tuple
 
-import numpy as np
 import pygame
 
-from mapgen.biomes import Biomes
-from mapgen.cell import Cell
+from mapgen.biomes import Biomes, CompiledBiomes
+from mapgen.events import CollapseEvent
 from mapgen.exceptions import ImpossibleWorld
-from mapgen.cgrid import Grid
+from mapgen.generate import make_grid
+from mapgen.presets import CONNECTOR_ID, DEFAULT_SEEDS, lbiomes, rbiomes, tbiomes
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    from mapgen.cgrid import Grid
 
 PROFILE = False
 
@@ -22,72 +29,8 @@ logging.basicConfig(
 # Creating a logger
 logger = logging.getLogger(__name__)
 
-lbiomes: Biomes = Biomes()
-tbiomes: Biomes = Biomes()
-rbiomes: Biomes = Biomes()
-
-tbiomes.add_biome(Cell(id='g', color=(128, 255, 0),
-                  neighbor_weights={'g': 2, 'f': 0.38}))
-tbiomes.add_biome(Cell(id='f', color=(0, 204, 0),
-                  neighbor_weights={'f': 2, 'g': 0.4, 'F': 0.66}))
-tbiomes.add_biome(Cell(id='F', color=(0, 102, 51),
-                  neighbor_weights={'F': 2, 'f': 0.85}))
-
-
-# Define some grid objects with single character IDs and neighbor weights for first index renders
-lbiomes.add_biome(Cell(id='W', color=(0, 0, 153),
-                  neighbor_weights={'W': 1.5, "w": 0.9, 'r': 0.01}))
-lbiomes.add_biome(Cell(id='w', color=(0, 0, 204),
-                  neighbor_weights={'w': 1.5, 'W': 0.7, 'g': 0.7, 's': 0.6, 'r': 0.01}))
-lbiomes.add_biome(Cell(id='g', color=(128, 255, 0),
-                  neighbor_weights={'g': 2, 'w': 0.25, 'f': 0.35, 's': 0.35, 'h': 0.5, 'r': 0.01}))
-lbiomes.add_biome(Cell(id='f', color=(0, 204, 0),
-                  neighbor_weights={'f': 2, 'g': 0.4, 'F': 0.66, 'r': 0.01}))
-lbiomes.add_biome(Cell(id='F', color=(0, 102, 51),
-                  neighbor_weights={'F': 2, 'f': 0.85, 'r': 0.01}))
-lbiomes.add_biome(Cell(id='h', color=(102, 51, 0),
-                  neighbor_weights={'h': 2, 'g': 0.66, 'm': 0.7, 'r': 0.01}))
-lbiomes.add_biome(Cell(id='m', color=(128, 128, 128),
-                  neighbor_weights={'m': 2, 'M': 0.75, 'h': 0.8, 'r': 0.01}))
-lbiomes.add_biome(Cell(id='M', color=(192, 192, 192),
-                  neighbor_weights={'M': 2, 'm': 1.0, 'r': 0.01}))
-lbiomes.add_biome(Cell(id='s', color=(153, 153, 0),
-                  neighbor_weights={'s': 2, 'w': 0.6, 'g': 0.8, 'r': 0.01}))
-lbiomes.add_biome(Cell(id='r', color=(210, 180, 140),
-                  neighbor_weights={'r': 0.001, 'W': 0.1, 'w': 0.1, 'g': 0.1, 
-                                    'f': 0.1, 'F': 0.1, 'h': 0.1, 'm': 0.1, 'M': 0.1, 
-                                    's': 0.1, 'r': 0.01 }))
-
-
-# Define some cell types for random index renders
-rbiomes.add_biome(Cell(id='W', color=(0, 0, 153),
-                  neighbor_weights={'W': 1.3, "w": 0.9, 'r': 0.001}))
-rbiomes.add_biome(Cell(id='w', color=(0, 0, 204),
-                  neighbor_weights={'w': 1.35, 'W': 0.5, 'g': 0.7, 's': 0.6, 'r': 0.001}))
-rbiomes.add_biome(Cell(id='g', color=(128, 255, 0),
-                  neighbor_weights={'g': 2.2, 'w': 0.27, 'f': 0.38, 's': 0.18, 'h': 0.39, 'r': 0.001}))
-rbiomes.add_biome(Cell(id='f', color=(0, 204, 0),
-                  neighbor_weights={'f': 2.2, 'g': 0.65, 'F': 1.2, 'r': 0.001}))
-rbiomes.add_biome(Cell(id='F', color=(0, 102, 51),
-                  neighbor_weights={'F': 1.3, 'f': 1.0, 'r': 0.001}))
-rbiomes.add_biome(Cell(id='h', color=(102, 51, 0),
-                  neighbor_weights={'h': 2, 'g': 0.7, 'm': 1.0, 'r': 0.001}))
-rbiomes.add_biome(Cell(id='m', color=(128, 128, 128),
-                  neighbor_weights={'m': 1.2, 'M': 0.7, 'h': 0.8, 'r': 0.001}))
-rbiomes.add_biome(Cell(id='M', color=(192, 192, 192),
-                  neighbor_weights={'M': 1.2, 'm': 1.0, 'r': 0.001}))
-rbiomes.add_biome(Cell(id='s', color=(153, 153, 0),
-                  neighbor_weights={'s': 2, 'w': 0.75, 'g': 0.76, 'r': 0.001}))
-rbiomes.add_biome(Cell(id='r', color=(210, 180, 140),
-                  neighbor_weights={'r': 0.001, 'W': 0.1, 'w': 0.1, 'g': 0.1, 
-                                    'f': 0.1, 'F': 0.1, 'h': 0.1, 'm': 0.1, 'M': 0.1, 
-                                    's': 0.1}))
-
 biomes: Biomes = rbiomes
 
-# Initialize Pygame
-pygame.init()
-
 # Screen dimensions and colors
 CELL_SIZE = 8
 SCREEN_WIDTH = 1200
@@ -95,77 +38,151 @@ SCREEN_HEIGHT = 600
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255) 
 
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption('Wave Function Collapse')
-
-CONNECTOR_ID = 'r'
-
-def run_wfc_and_display(grid: Grid) -> bool:
-    try:
-        count = 0
-        while grid.needs_work():
-            grid.collapse_least_entropy_cell()
-            count += 1
-            if count // 50 == count / 50:
-                display_grid(grid)
-    except ImpossibleWorld as e:
-        display_grid(grid)
-        # e.args[1] is the list of objects
-        objects_with_ids = e.args[1]
-        # Collect all ids in a list and join them into a single string
-        ids = [str(obj.id) for obj in objects_with_ids if obj is not None]
-        print(" ".join(ids))
+# Grid engine to run, one of mapgen.generate.ENGINES
+ENGINE = 'cgrid'
+# Collapses sent to the screen per update
+COLLAPSE_CHUNK = 50
+# Smoothing changes sent to the screen per update
+SMOOTH_BUDGET = 500
+# Collapses cgrid may undo on a contradiction before giving up on the map
+BACKTRACK_DEPTH = 32
+FPS = 60
+# Updates the generation thread can get ahead of the screen by before it waits
+QUEUE_SIZE = 64
+
+class Renderer:
+    """
+    Keeps the map in an 8 bit surface with one pixel per cell and the biome colors as its
+    palette, so drawing a cell is writing its biome index. update() redraws only the cells
+    it's given, scaled up to CELL_SIZE, and passes just those rects to display.update.
+    """
+
+    def __init__(self, screen: pygame.Surface, rules: CompiledBiomes, width: int, height: int):
+        self.screen = screen
+        self.width = width
+        self.height = height
+        self.surface = pygame.Surface((width, height), depth=8)
+        palette = [BLACK] * 256
+        for i, cell in enumerate(rules.cells):
+            palette[i] = cell.color
+        self.surface.set_palette(palette)
+
+    def draw(self, indices: "np.ndarray") -> None:
+        # Redraw every cell from a uint8 index array, surfarray is indexed (x, y)
+        pygame.surfarray.blit_array(self.surface, indices.T)
+        self.screen.blit(pygame.transform.scale(self.surface, (self.width * CELL_SIZE, self.height * CELL_SIZE)), (0, 0))
+        pygame.display.flip()
+
+    def update(self, events: Sequence[CollapseEvent]) -> None:
+        if not events:
+            return
+        pixels = pygame.surfarray.pixels2d(self.surface)
+        for event in events:
+            pixels[event.x, event.y] = event.biome
+        # The surface can't be blitted while the pixel array holds it locked
+        del pixels
+        rects = []
+        for x0, x1, y in self.runs(events):
+            rect = pygame.Rect(x0, y, x1 - x0, 1)
+            scaled = pygame.transform.scale(self.surface.subsurface(rect), (rect.width * CELL_SIZE, CELL_SIZE))
+            rects.append(self.screen.blit(scaled, (x0 * CELL_SIZE, y * CELL_SIZE)))
+        pygame.display.update(rects)
+
+    @staticmethod
+    def runs(events: Sequence[CollapseEvent]) -> List[Tuple[int, int, int]]:
+        # Horizontal runs [x0, x1) of changed cells per row, so neighbors share a rect
+        runs = []
+        for y, x in sorted({(event.y, event.x) for event in events}):
+            if runs and runs[-1][2] == y and runs[-1][1] == x:
+                runs[-1] = (runs[-1][0], x + 1, y)
+            else:
+                runs.append((x, x + 1, y))
+        return runs
+
+class GenerationWorker(threading.Thread):
+    """
+    Generates one map in the background and hands the screen updates to the UI loop through
+    a bounded queue: ('start', (rules, indices)) once the seeds are placed, ('events',
+    [CollapseEvent, ...]) while collapsing and smoothing, then ('done', None) or ('failed',
+    neighbor ids). cancel() stops it at the next update.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.updates: "queue.Queue[Tuple[str, Any]]" = queue.Queue(maxsize=QUEUE_SIZE)
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def run(self) -> None:
+        grid = init_grid()
+        if not self.send('start', (grid.rules, grid.index_array())):
+            return
+        try:
+            for events in grid.iter_collapse(COLLAPSE_CHUNK):
+                if not self.send('events', events):
+                    return
+        except ImpossibleWorld as e:
+            # e.args[1] is the list of objects
+            self.send('failed', [str(obj.id) for obj in e.args[1] if obj is not None])
+            return
+        for events in grid.iter_smooth(SMOOTH_BUDGET):
+            if not self.send('events', events):
+                return
+        logger.debug("Sampling cache %s", grid.rules.sampling_cache.stats())
+        if hasattr(grid, 'backtrack_stats'):
+            logger.debug("Backtracking %s", grid.backtrack_stats())
+        self.send('done', None)
+
+    def send(self, kind: str, payload: Any) -> bool:
+        # Waits while the queue is full, returns False once the run is cancelled
+        while not self._cancelled.is_set():
+            try:
+                self.updates.put((kind, payload), timeout=0.05)
+                return True
+            except queue.Full:
+                pass
         return False
-    
-    display_grid(grid)
-    return True
 
-def run_smooth_and_display(grid: Grid) -> None:
-    count = 0
-    running = True
-    while running:
-        count += 1
-        running = grid.smooth()
-        if count // 5 == count / 5:
-            display_grid(grid)
-    display_grid(grid)
-    return
-
-def display_grid(grid: Grid):
-    for y in range(grid.height):
-        for x in range(grid.width):
-            cell: Cell = grid.grid[y][x]
-            color = cell.color if cell else BLACK
-            pygame.draw.rect(screen, color, (x * CELL_SIZE, y * CELL_SIZE, CELL_SIZE, CELL_SIZE))
-    pygame.display.flip()
-
-def init_grid() -> Grid:
+    def drain(self) -> List[Tuple[str, Any]]:
+        # Everything queued so far, without waiting
+        updates = []
+        while True:
+            try:
+                updates.append(self.updates.get_nowait())
+            except queue.Empty:
+                return updates
+
+def start_worker() -> GenerationWorker:
+    worker = GenerationWorker()
+    worker.start()
+    return worker
+
+def init_grid() -> "Grid":
     grid_width = int(SCREEN_WIDTH / CELL_SIZE)
     grid_height = int(SCREEN_HEIGHT / CELL_SIZE)
-    grid = Grid(width=grid_width, height=grid_height, biomes=biomes)
-    grid.connector_name = CONNECTOR_ID
-    grid.add_random('s', 5)
-    grid.add_random('s', 5)
-    grid.add_random('W', 5)
-    grid.add_random('W', 3)
-    grid.add_random('W', 3)
-    grid.add_random('M', 3)
-    grid.add_random('M', 4)
-    grid.add_random('M', 5)
-    grid.add_random('F', 5)
-    grid.add_random('F', 5)
-    grid.add_random('F', 5)
+    grid = make_grid(ENGINE, biomes, grid_width, grid_height, CONNECTOR_ID)
+    grid.BACKTRACK_DEPTH = BACKTRACK_DEPTH
+    grid.add_many(DEFAULT_SEEDS)
     return grid
 
+def open_window() -> pygame.Surface:
+    # Nothing touches the display until here, so importing this module has no side effects
+    pygame.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption('Wave Function Collapse')
+    return screen
+
 def main():
     
-    grid = init_grid()
-    #display = PygameDisplay(screen_height=SCREEN_HEIGHT, screen_width=SCREEN_WIDTH, cell_size=CELL_SIZE)
+    screen = open_window()
+    worker = start_worker()
+    renderer: Optional[Renderer] = None
+    clock = pygame.time.Clock()
 
     running = True
     while running:
-        screen.fill(WHITE)
-        
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
@@ -176,15 +193,31 @@ def main():
                     logger.debug("Quit key recieved")
                 if event.key == pygame.K_r:
                     logger.debug("Rerun command recieved")
-                    grid = init_grid()
-                    run_wfc_and_display(grid)
-
-        if run_wfc_and_display(grid):
-            run_smooth_and_display(grid)
-        else:
-            print("problem rendering")
-            sleep(1)            
-
+                    worker.cancel()
+                    worker = start_worker()
+
+        # Apply whatever the worker has produced since the last frame in one screen update
+        pending: List[CollapseEvent] = []
+        for kind, payload in worker.drain():
+            if kind == 'start':
+                rules, indices = payload
+                renderer = Renderer(screen, rules, indices.shape[1], indices.shape[0])
+                renderer.draw(indices)
+                pending = []
+            elif kind == 'events':
+                pending.extend(payload)
+            elif kind == 'failed':
+                print(" ".join(payload))
+                print("problem rendering, starting again")
+                worker = start_worker()
+                break
+            elif kind == 'done':
+                logger.debug("Map finished")
+        if renderer is not None:
+            renderer.update(pending)
+        clock.tick(FPS)
+
+    worker.cancel()
     if not PROFILE:            
         pygame.quit()
         sys.exit()
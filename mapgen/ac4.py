@@ -0,0 +1,136 @@
+import logging
+from array import array
+from collections import deque
+from typing import Deque, Tuple
+
+from .exceptions import ImpossibleWorld
+from .smoothing import NEIGHBOR_OFFSETS
+from .storage import neighbor_directions
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+# OPPOSITE[d] is the direction that points back at a cell from its neighbor in direction d
+OPPOSITE: Tuple[int, ...] = tuple(NEIGHBOR_OFFSETS.index((-dx, -dy)) for dx, dy in NEIGHBOR_OFFSETS)
+# rebuild packs each cell's domain into one int64 bit field, with the top bit left as the sign
+MAX_BIOMES = 63
+
+
+class SupportPropagator:
+    """
+    AC-4 style arc consistency for cgrid.Grid in bitset mode.
+
+    For every cell, direction and biome it keeps the number of biomes in the neighbor's
+    domain that are compatible with it. When a biome is removed from a domain, the
+    matching counts of the 8 neighbors go down, and a neighbor loses a biome only when
+    its count reaches zero. That also prunes against uncollapsed neighbors, so an empty
+    domain shows up as soon as it happens instead of when the cell is collapsed.
+
+    Domain changes go through grid.set_domain and count changes are logged on the grid's
+    backtracking trail, so both can be undone.
+    """
+
+    def __init__(self, grid):
+        if len(grid.rules) > MAX_BIOMES:
+            raise ValueError(f"AC-4 supports at most {MAX_BIOMES} biomes, got {len(grid.rules)}; turn off USE_AC4")
+        self.grid = grid
+        self.rules = grid.rules
+        self.width: int = grid.width
+        self.height: int = grid.height
+        self.biome_count: int = len(self.rules)
+        # (direction, neighbor flat index) for every neighbor of a cell
+        self.neighbors = neighbor_directions(self.width, self.height, grid.wrap)
+        self._bits = [tuple(i for i in range(self.biome_count) if mask >> i & 1)
+                      for mask in range(1 << self.biome_count)] if self.biome_count <= 12 else None
+        self.removals = 0
+        self.counts: array = array('h')
+        self.rebuild()
+
+    def bits(self, mask: int) -> Tuple[int, ...]:
+        if self._bits is not None:
+            return self._bits[mask]
+        return tuple(i for i in range(self.biome_count) if mask >> i & 1)
+
+    def rebuild(self) -> None:
+        # Count supports from the current domains, then prune anything that has none
+        import numpy as np
+        compat_masks = self.rules.compat_masks
+        domains = np.array(self.grid.potential_states, dtype=np.int64).reshape(self.height, self.width)
+        padded = np.zeros((self.height + 2, self.width + 2), dtype=np.int64)
+        padded[1:-1, 1:-1] = domains
+        inside = np.zeros_like(padded, dtype=bool)
+        inside[1:-1, 1:-1] = True
+        counts = np.empty((self.height, self.width, len(NEIGHBOR_OFFSETS), self.biome_count), dtype=np.int16)
+        for d, (dx, dy) in enumerate(NEIGHBOR_OFFSETS):
+            if self.grid.wrap:
+                neighbor = np.roll(domains, (-dy, -dx), axis=(0, 1))
+                in_bounds = True
+            else:
+                neighbor = padded[1 + dy:1 + dy + self.height, 1 + dx:1 + dx + self.width]
+                in_bounds = inside[1 + dy:1 + dy + self.height, 1 + dx:1 + dx + self.width]
+            for a in range(self.biome_count):
+                # Directions off the edge of the grid never run out of support
+                counts[:, :, d, a] = np.where(in_bounds, np.bitwise_count(neighbor & compat_masks[a]), 1)
+        self.counts = array('h', counts.tobytes())
+
+        unsupported = np.zeros((self.height, self.width), dtype=np.int64)
+        for a in range(self.biome_count):
+            unsupported |= (counts[:, :, :, a] == 0).any(axis=-1).astype(np.int64) << a
+        unsupported &= domains
+        queue: Deque[Tuple[int, int]] = deque()
+        for y, x in zip(*np.nonzero(unsupported)):
+            if self.grid.grid[y][x] is None:
+                self._shrink(int(y) * self.width + int(x), int(unsupported[y, x]), queue)
+        self._propagate(queue)
+
+    def remove(self, x: int, y: int, mask: int) -> None:
+        # Take the biomes in mask out of an uncollapsed cell's domain and propagate
+        queue: Deque[Tuple[int, int]] = deque()
+        self._shrink(y * self.width + x, mask & self.grid.potential_states[y][x], queue)
+        self._propagate(queue)
+
+    def collapsed(self, x: int, y: int, old_states: int) -> None:
+        # Called after set_cell has narrowed (x, y) to its chosen biome
+        removed = old_states & ~self.grid.potential_states[y][x]
+        if removed:
+            self._propagate(deque([(y * self.width + x, removed)]))
+
+    def _shrink(self, flat: int, mask: int, queue: Deque[Tuple[int, int]]) -> None:
+        if not mask:
+            return
+        y, x = divmod(flat, self.width)
+        states = self.grid.potential_states[y][x] & ~mask
+        self.grid.set_domain(x, y, states, None)
+        self.removals += 1
+        if not states:
+            raise ImpossibleWorld(f"Cannot resolve world, no states left at {x},{y}", self.grid.get_neighbors(x, y))
+        queue.append((flat, mask))
+
+    def _propagate(self, queue: Deque[Tuple[int, int]]) -> None:
+        grid = self.grid.grid
+        potential_states = self.grid.potential_states
+        compat_masks = self.rules.compat_masks
+        counts = self.counts
+        biome_count = self.biome_count
+        trail = self.grid._trail
+        width = self.width
+        while queue:
+            flat, removed = queue.popleft()
+            removed_bits = self.bits(removed)
+            for d, neighbor in self.neighbors[flat]:
+                ny, nx = divmod(neighbor, width)
+                if grid[ny][nx] is not None:
+                    continue
+                states = potential_states[ny][nx]
+                base = (neighbor * 8 + OPPOSITE[d]) * biome_count
+                unsupported = 0
+                for b in removed_bits:
+                    for a in self.bits(states & compat_masks[b] & ~unsupported):
+                        k = base + a
+                        counts[k] -= 1
+                        if trail is not None:
+                            trail.append(('support', k, 0, None))
+                        if counts[k] == 0:
+                            unsupported |= 1 << a
+                if unsupported:
+                    self._shrink(neighbor, unsupported, queue)
@@ -0,0 +1,150 @@
+"""
+Out-of-core generation of maps too big to hold in memory as a grid.
+
+    python -m mapgen.banded --width 50000 --height 50000 --band-rows 64 --seed 0 --out continent.npy
+
+The map is generated top to bottom in bands of rows. Each band is solved on its own with
+lgrid, with the last row of the band above pinned as its first row, so only one band and
+that frontier row are ever in memory. A band that can't be fitted below its frontier is
+solved again together with the last few rows of the band above, from a frontier further
+up. Bands are written straight into a .npy file opened with numpy.lib.format.open_memmap,
+which later tools can open with np.load(path, mmap_mode='r') without reading it in.
+"""
+import argparse
+import logging
+import random
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from . import lgrid
+from .biomes import Biomes
+from .exceptions import ImpossibleWorld
+from .generate import seeds_that_fit
+from .presets import BIOME_SETS, CONNECTOR_ID
+from .smoothing import smooth_indices
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+BAND_ROWS = 64
+# Rows of the band above solved again with a band that failed against its frontier, tried in turn
+BACKOFF = (4, 16)
+
+
+def band_spans(height: int, band_rows: int) -> List[Tuple[int, int]]:
+    # [r0, r1) of every band, a last band under half of band_rows being folded into the one above
+    spans = [(r0, min(r0 + band_rows, height)) for r0 in range(0, height, band_rows)]
+    if len(spans) > 1 and spans[-1][1] - spans[-1][0] < band_rows / 2:
+        spans[-2:] = [(spans[-2][0], height)]
+    return spans
+
+
+def solve_band(biomes: Biomes, width: int, rows: int, frontier: Optional[np.ndarray], seeds: Sequence[Tuple[str, int]],
+               band_seeds: random.Random, retries: int = 3, use_random: Optional[bool] = None) -> np.ndarray:
+    # Generate rows x width cells below the frontier row, or a free standing band without one
+    context = 0 if frontier is None else 1
+    for attempt in range(1, retries + 2):
+        grid = lgrid.Grid(width=width, height=rows + context, biomes=biomes, seed=band_seeds.getrandbits(64))
+        if use_random is not None:
+            grid.USE_RANDOM = use_random
+        try:
+            grid.add_many(seeds_that_fit(seeds, width, rows + context))
+            if frontier is not None:
+                # Pinned after the stamps, so a stamp landing on the frontier row is overwritten
+                grid.set_cells([(x, 0, biome) for x, biome in enumerate(frontier.tolist())])
+            while grid.needs_work():
+                grid.collapse_least_entropy_cell()
+        except ImpossibleWorld as e:
+            logger.debug("Band attempt %s failed: %s", attempt, e.args[0])
+            continue
+        return grid.map[context:]
+    raise ImpossibleWorld(f"Cannot resolve band below the frontier after {retries + 1} attempts")
+
+
+def smooth_band(out: np.ndarray, r0: int, r1: int, connector: Optional[int], biome_count: int) -> int:
+    # Smooth rows [r0, r1) in place, reading one row either side as context. Those rows
+    # aren't written, so seams are smoothed from one side at a time
+    top, bottom = max(r0 - 1, 0), min(r1 + 1, out.shape[0])
+    window = np.array(out[top:bottom])
+    changes = smooth_indices(window, biome_count, connector)
+    out[r0:r1] = window[r0 - top:r1 - top]
+    return changes
+
+
+def generate_banded(path: str, biomes: Biomes, width: int, height: int, seed: Optional[int] = None,
+                    band_rows: int = BAND_ROWS, seeds: Sequence[Tuple[str, int]] = (),
+                    connector: Optional[str] = CONNECTOR_ID, smooth: bool = True, retries: int = 3,
+                    use_random: Optional[bool] = None) -> np.memmap:
+    """
+    Generate a height x width map band by band into a uint8 .npy file at path and return it
+    memory-mapped. seeds are stamped with add_many in every band, skipping any too big
+    for it. A band that hits ImpossibleWorld is retried against the same frontier, up to
+    retries times, then solved again from higher up with each of BACKOFF rows of the band
+    above.
+    """
+    rules = biomes.compile()
+    connector_index = rules.index[connector] if connector and connector in rules.index else None
+    out = open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width))
+    band_seeds = random.Random(seed)
+    previous: Optional[Tuple[int, int]] = None
+    for r0, r1 in band_spans(height, band_rows):
+        # The band above isn't smoothed yet, so its rows are still as solved and can be solved
+        # again, all but its first row, which is kept as the frontier
+        room = r0 - previous[0] - 1 if previous is not None else 0
+        backoffs = [0] + sorted({min(back, room) for back in BACKOFF if room > 0})
+        for back in backoffs:
+            top = r0 - back
+            frontier = np.array(out[top - 1]) if top > 0 else None
+            try:
+                band = solve_band(biomes, width, r1 - top, frontier, seeds, band_seeds, retries, use_random)
+            except ImpossibleWorld:
+                logger.debug("Rows %s-%s failed from frontier row %s", top, r1, top - 1)
+                continue
+            break
+        else:
+            raise ImpossibleWorld(f"Cannot resolve rows {r0}-{r1} after backing off {backoffs[-1]} rows")
+        out[top:r1] = band
+        # The band above can be smoothed now that the row below it exists
+        if smooth and previous is not None:
+            smooth_band(out, *previous, connector_index, len(rules))
+        previous = (r0, r1)
+        logger.debug("Generated rows %s-%s of %s", r0, r1, height)
+    if smooth and previous is not None:
+        smooth_band(out, *previous, connector_index, len(rules))
+    out.flush()
+    return out
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m mapgen.banded',
+                                     description='Generate a map larger than memory into a memory-mapped file.')
+    parser.add_argument('--biomes', choices=sorted(BIOME_SETS), default='random')
+    parser.add_argument('--width', type=int, required=True)
+    parser.add_argument('--height', type=int, required=True)
+    parser.add_argument('--band-rows', type=int, default=BAND_ROWS)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--retries', type=int, default=3, help='restarts allowed per band on ImpossibleWorld')
+    parser.add_argument('--out', required=True, help='.npy file to write')
+    parser.add_argument('--no-smooth', dest='smooth', action='store_false')
+    parser.add_argument('--first-index', dest='use_random', action='store_const', const=False, default=None,
+                        help='break entropy ties by first index instead of at random')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    biomes = BIOME_SETS[args.biomes]
+    connector = CONNECTOR_ID if CONNECTOR_ID in biomes.compile().index else None
+    try:
+        generate_banded(args.out, biomes, args.width, args.height, args.seed, args.band_rows,
+                        connector=connector, smooth=args.smooth, retries=args.retries, use_random=args.use_random)
+    except ImpossibleWorld as e:
+        logger.error("%s", e.args[0])
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,134 @@
+"""
+Headless batch generation, fanned out over a process pool.
+
+    python -m mapgen.batch --engine cgrid --biomes random --width 150 --height 75 \
+        --seed-start 0 --count 1000 --workers 8 --out maps/
+
+Each map is written as a uint8 biome index array (map_<seed>.npy), or with --codec as a
+map file (map_<seed>.wfcm, see mapgen.mapfile), and manifest.json records the biome palette
+and the outcome for every seed.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .exceptions import ImpossibleWorld
+from .generate import ENGINES, generate_map
+from .mapcache import MapCache
+from .mapfile import CODECS, save_map
+from .presets import BIOME_SETS, CONNECTOR_ID, DEFAULT_SEEDS
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def _run_task(task: Dict[str, Any]) -> Dict[str, Any]:
+    # Runs in a worker process, so the map goes straight to disk instead of back through a pipe
+    biomes = BIOME_SETS[task['biomes']]
+    start = time.perf_counter()
+    record: Dict[str, Any] = {'seed': task['seed']}
+    args = (task['engine'], biomes, task['width'], task['height'], task['seeds'], task['seed'], task['connector'],
+            task['smooth'], task['retries'], task['use_random'])
+    try:
+        if task['cache']:
+            # Attempts aren't known for maps that come out of the cache
+            cache = MapCache(task['cache'], memory_size=0)
+            indices = cache.get_or_generate(*args)
+            record.update(cached=cache.misses == 0)
+        else:
+            indices, attempts = generate_map(*args)
+            record.update(attempts=attempts)
+    except ImpossibleWorld as e:
+        record.update(status='failed', attempts=task['retries'] + 1, error=e.args[0])
+    else:
+        if task['codec'] == 'npy':
+            path = os.path.join(task['out'], f"map_{task['seed']}.npy")
+            np.save(path, indices)
+        else:
+            path = os.path.join(task['out'], f"map_{task['seed']}.wfcm")
+            save_map(path, indices, biomes.compile(), task['codec'])
+        record.update(status='ok', file=os.path.basename(path))
+    record['seconds'] = round(time.perf_counter() - start, 4)
+    return record
+
+
+def run_batch(engine: str, biome_set: str, width: int, height: int, seed_start: int, count: int, out: str,
+              workers: Optional[int] = None, retries: int = 3, smooth: bool = True,
+              use_random: Optional[bool] = None, cache: Optional[str] = None,
+              codec: str = 'npy') -> List[Dict[str, Any]]:
+    biomes = BIOME_SETS[biome_set]
+    rules = biomes.compile()
+    # Seeds for biomes that aren't in the set can't be stamped
+    seeds = [(biome_id, size) for biome_id, size in DEFAULT_SEEDS if biome_id in rules.index]
+    connector = CONNECTOR_ID if CONNECTOR_ID in rules.index else None
+    os.makedirs(out, exist_ok=True)
+    tasks = [dict(engine=engine, biomes=biome_set, width=width, height=height, seeds=seeds, seed=seed,
+                  connector=connector, smooth=smooth, retries=retries, use_random=use_random, out=out,
+                  cache=cache, codec=codec)
+             for seed in range(seed_start, seed_start + count)]
+
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    if workers == 1:
+        records = [_run_task(task) for task in tasks]
+    else:
+        chunksize = max(1, len(tasks) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            records = list(executor.map(_run_task, tasks, chunksize=chunksize))
+    elapsed = time.perf_counter() - start
+
+    manifest = {
+        'engine': engine,
+        'biomes': biome_set,
+        'width': width,
+        'height': height,
+        'ids': list(rules.ids),
+        'colors': [list(cell.color) for cell in rules.cells],
+        'seeds': seeds,
+        'smooth': smooth,
+        'maps': records,
+    }
+    with open(os.path.join(out, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    failed = sum(1 for record in records if record['status'] != 'ok')
+    logger.info("Generated %s maps (%s failed) in %.2fs with %s workers, %.2f maps/s",
+                len(records) - failed, failed, elapsed, workers, len(records) / elapsed if elapsed else 0.0)
+    return records
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m mapgen.batch', description='Generate maps without a display.')
+    parser.add_argument('--engine', choices=ENGINES, default='cgrid')
+    parser.add_argument('--biomes', choices=sorted(BIOME_SETS), default='random')
+    parser.add_argument('--width', type=int, default=150)
+    parser.add_argument('--height', type=int, default=75)
+    parser.add_argument('--seed-start', type=int, default=0)
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None, help='defaults to the number of CPUs')
+    parser.add_argument('--retries', type=int, default=3, help='restarts allowed per seed on ImpossibleWorld')
+    parser.add_argument('--out', default='maps')
+    parser.add_argument('--no-smooth', dest='smooth', action='store_false')
+    parser.add_argument('--first-index', dest='use_random', action='store_const', const=False, default=None,
+                        help='break entropy ties by first index instead of at random')
+    parser.add_argument('--cache', default=None, help='directory of a map cache to reuse previously generated maps')
+    parser.add_argument('--codec', choices=('npy',) + CODECS, default='npy',
+                        help='write .npy arrays, or map files stored with this codec')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    records = run_batch(args.engine, args.biomes, args.width, args.height, args.seed_start, args.count, args.out,
+                        args.workers, args.retries, args.smooth, args.use_random, args.cache, args.codec)
+    return 0 if all(record['status'] == 'ok' for record in records) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,10 +1,201 @@
-from typing import List, Optional
+import hashlib
+import json
 from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from .cache import LRUCache
 from .cell import Cell
 
+if TYPE_CHECKING:
+    import numpy as np
+
+# Index used for uncollapsed cells in uint8 index arrays
+EMPTY = 255
+
+# Neighborhood signatures pack a count of collapsed neighbors per biome into 4 bits each
+SIGNATURE_BITS = 4
+SAMPLING_CACHE_SIZE = 4096
+DOMAIN_CACHE_SIZE = 4096
+
+
+def rules_digest(cells: Iterable[Cell]) -> str:
+    # Stable hash of everything that affects generation: order, ids, colors and weights. Values
+    # are normalised first, so a weight of 2 and 2.0 or a color tuple and list hash the same
+    canonical = [[str(cell.id), [int(c) for c in cell.color],
+                  sorted((str(neighbor_id), float(weight)) for neighbor_id, weight in cell.neighbor_weights.items())]
+                 for cell in cells]
+    return hashlib.sha256(json.dumps(canonical, separators=(',', ':')).encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class CompiledBiomes:
+    """
+    Immutable rule table built from a Biomes list by Biomes.compile().
+
+    Biome i is cells[i]. compatible[i, j] is True when i and j both list each other as
+    neighbors, and weights[i, j] is the weight a collapsed neighbor i gives to candidate j.
+    The tuple forms of the same tables are there for the pure Python engines, where
+    indexing a tuple is cheaper than indexing a numpy array one element at a time. The
+    numpy forms are only built when first used, so those engines never import numpy.
+    """
+    cells: Tuple[Cell, ...]
+    ids: Tuple[str, ...]
+    index: Mapping[str, int]
+    compat_table: Tuple[Tuple[bool, ...], ...]
+    weight_table: Tuple[Tuple[float, ...], ...]
+    compat_masks: Tuple[int, ...]
+    full_mask: int
+    signature_units: Tuple[int, ...]
+    digest: str
+    sampling_cache: LRUCache = field(default_factory=lambda: LRUCache(SAMPLING_CACHE_SIZE), compare=False, repr=False)
+    domain_cache: LRUCache = field(default_factory=lambda: LRUCache(DOMAIN_CACHE_SIZE), compare=False, repr=False)
+    _arrays: Dict[str, Any] = field(default_factory=dict, compare=False, repr=False)
+    # (buffer, byte offset) of little-endian tables the numpy forms can be views of, see mapgen.rulefile
+    _buffers: Dict[str, Tuple[Any, int]] = field(default_factory=dict, compare=False, repr=False)
+
+    @classmethod
+    def from_cells(cls, cells: List[Cell]) -> "CompiledBiomes":
+        cells = tuple(cells)
+        ids = tuple(cell.id for cell in cells)
+        index = {biome_id: i for i, biome_id in enumerate(ids)}
+        count = len(cells)
+        if count >= EMPTY:
+            raise ValueError(f"At most {EMPTY - 1} biomes fit in a uint8 index array, got {count}")
+        weights = [[0.0] * count for _ in range(count)]
+        allowed = [[False] * count for _ in range(count)]
+        for i, cell in enumerate(cells):
+            for neighbor_id, weight in cell.neighbor_weights.items():
+                j = index.get(neighbor_id)
+                if j is not None:
+                    weights[i][j] = float(weight)
+                    allowed[i][j] = True
+        compat_masks = [sum(1 << j for j in range(count) if allowed[i][j] and allowed[j][i]) for i in range(count)]
+        return cls.from_tables(cells, compat_masks, weights, rules_digest(cells))
+
+    @classmethod
+    def from_tables(cls, cells: Iterable[Cell], compat_masks: Iterable[int], weights: Iterable[Iterable[float]],
+                    digest: str, buffers: Optional[Dict[str, Tuple[Any, int]]] = None) -> "CompiledBiomes":
+        # Build from tables that are already compiled, such as a rule file's sidecar
+        cells = tuple(cells)
+        ids = tuple(cell.id for cell in cells)
+        count = len(cells)
+        compat_masks = tuple(compat_masks)
+        return cls(
+            cells=cells,
+            ids=ids,
+            index=MappingProxyType({biome_id: i for i, biome_id in enumerate(ids)}),
+            compat_table=tuple(tuple(bool(mask >> j & 1) for j in range(count)) for mask in compat_masks),
+            weight_table=tuple(tuple(row) for row in weights),
+            compat_masks=compat_masks,
+            full_mask=(1 << count) - 1,
+            signature_units=tuple(1 << (SIGNATURE_BITS * i) for i in range(count)),
+            digest=digest,
+            _buffers=dict(buffers or {}),
+        )
+
+    @property
+    def compatible(self) -> "np.ndarray":
+        # Read-only (B, B) bool array of compat_table
+        return self._array('compatible', self.compat_table, bool)
+
+    @property
+    def weights(self) -> "np.ndarray":
+        # Read-only (B, B) float64 array of weight_table
+        return self._array('weights', self.weight_table, '<f8')
+
+    def _array(self, name: str, table: Tuple[Tuple[Any, ...], ...], dtype: Any) -> "np.ndarray":
+        array = self._arrays.get(name)
+        if array is None:
+            import numpy as np
+            count = len(self.cells)
+            if name in self._buffers:
+                buffer, offset = self._buffers[name]
+                array = np.frombuffer(buffer, dtype=dtype, count=count * count, offset=offset).reshape(count, count)
+            else:
+                array = np.array(table, dtype=dtype).reshape(count, count)
+            array.setflags(write=False)
+            self._arrays[name] = array
+        return array
+
+    @property
+    def biomes(self) -> List[Cell]:
+        return list(self.cells)
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    def find_by_id(self, target_id: str) -> Optional[Cell]:
+        i = self.index.get(target_id)
+        return None if i is None else self.cells[i]
+
+    def compile(self) -> "CompiledBiomes":
+        return self
+
+    def configure_caches(self, sampling_size: Optional[int] = SAMPLING_CACHE_SIZE,
+                         domain_size: Optional[int] = DOMAIN_CACHE_SIZE, policy: str = "lru") -> None:
+        # The dataclass is frozen, so replace the caches in place
+        object.__setattr__(self, "sampling_cache", LRUCache(sampling_size, policy))
+        object.__setattr__(self, "domain_cache", LRUCache(domain_size, policy))
+
+    def domain(self, signature: int) -> Tuple[int, int]:
+        # Mask of biomes that fit next to every collapsed neighbor counted in signature, and its entropy
+        return self.domain_cache.get_or_compute(signature, lambda: self._build_domain(signature))
+
+    def _build_domain(self, signature: int) -> Tuple[int, int]:
+        mask = self.full_mask
+        neighbor = 0
+        nibble = (1 << SIGNATURE_BITS) - 1
+        while signature:
+            if signature & nibble:
+                mask &= self.compat_masks[neighbor]
+            signature >>= SIGNATURE_BITS
+            neighbor += 1
+        return mask, bin(mask).count("1")
+
+    def sampling_table(self, signature: int, mask: int) -> Tuple[Tuple[Cell, ...], Tuple[float, ...]]:
+        """
+        Candidates in mask with a non-zero weight and their cumulative weights, for a cell
+        whose collapsed neighbors are counted in signature (see signature_units). Ready to
+        pass to random.choices(candidates, cum_weights=...).
+        """
+        return self.sampling_cache.get_or_compute((signature, mask), lambda: self._build_sampling_table(signature, mask))
+
+    def _build_sampling_table(self, signature: int, mask: int) -> Tuple[Tuple[Cell, ...], Tuple[float, ...]]:
+        counts = []
+        neighbor = 0
+        nibble = (1 << SIGNATURE_BITS) - 1
+        while signature:
+            if signature & nibble:
+                counts.append((self.weight_table[neighbor], signature & nibble))
+            signature >>= SIGNATURE_BITS
+            neighbor += 1
+        candidates = []
+        cum_weights = []
+        total = 0.0
+        for i, cell in enumerate(self.cells):
+            if not mask >> i & 1:
+                continue
+            weight = 1.0
+            for row, count in counts:
+                weight *= row[i] ** count
+            if weight > 0:
+                total += weight
+                candidates.append(cell)
+                cum_weights.append(total)
+        return tuple(candidates), tuple(cum_weights)
+
+    def encode(self, grid: Iterable[Iterable[Optional[Cell]]]) -> "np.ndarray":
+        # Rows of Cells (or a numpy object array) to a uint8 index array, EMPTY where unset
+        import numpy as np
+        index = self.index
+        return np.array([[EMPTY if cell is None else index[cell.id] for cell in row] for row in grid], dtype=np.uint8)
+
+
 @dataclass
 class Biomes:
     _biomes: List[Cell] = field(default_factory=list)
+    _compiled: Optional[CompiledBiomes] = field(default=None, init=False, repr=False, compare=False)
 
     @property
     def biomes(self) -> List[Cell]:
@@ -12,8 +203,28 @@ class Biomes:
         return self._biomes
     
     def find_by_id(self, target_id: str) -> Optional[Cell]:
-        return next((obj for obj in self._biomes if obj.id == target_id), None)
+        return self.compile().find_by_id(target_id)
 
     def add_biome(self, grid_obj: Cell) -> None:
         self._biomes.append(grid_obj)
+        self._compiled = None
         return
+
+    def compile(self) -> CompiledBiomes:
+        # Cached until the next add_biome
+        if self._compiled is None:
+            self._compiled = CompiledBiomes.from_cells(self._biomes)
+        return self._compiled
+
+    @classmethod
+    def from_file(cls, path: str, cache: bool = True) -> "Biomes":
+        # Load and validate a JSON or TOML rule file, see mapgen.rulefile
+        from .rulefile import load_biomes
+        return load_biomes(path, cache)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The compiled table may be backed by a memory map, which can't be pickled, so the
+        # receiving process compiles its own
+        state = self.__dict__.copy()
+        state['_compiled'] = None
+        return state
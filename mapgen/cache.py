@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, TypeVar
+
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """
+    Small bounded mapping that evicts the least recently used entry and counts hits and
+    misses, so callers can see whether a cache is earning its keep. With policy "fifo"
+    hits don't refresh an entry, so the oldest insert is evicted first.
+    """
+
+    def __init__(self, maxsize: Optional[int] = 4096, policy: str = "lru"):
+        # maxsize None means unbounded, 0 disables caching
+        if policy not in ("lru", "fifo"):
+            raise ValueError(f"Unknown eviction policy {policy!r}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self._data: "OrderedDict[Hashable, V]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Optional[V] = None) -> Optional[V]:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if self.policy == "lru":
+            self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: V) -> None:
+        if self.maxsize == 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                self.evict(*self._data.popitem(last=False))
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], V]) -> V:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            self.put(key, value)
+            return value
+        if self.policy == "lru":
+            self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def evict(self, key: Hashable, value: V) -> None:
+        # Hook for subclasses that want to do something with evicted entries
+        self.evictions += 1
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "policy": self.policy,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import Dict, Set, Tuple
+from typing import AbstractSet, Dict, Tuple
 
 
 @dataclass
@@ -8,5 +8,6 @@ class Cell:
     color: Tuple[int, int, int]
     neighbor_weights: Dict[str, float] = field(default_factory=dict)
 
-    def allowed_neighbors(self) -> Set[str]:
-        return set(self.neighbor_weights.keys())
\ No newline at end of file
+    def allowed_neighbors(self) -> AbstractSet[str]:
+        # A view on the weights dict, so membership tests don't build a new set every call
+        return self.neighbor_weights.keys()
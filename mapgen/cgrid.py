@@ -1,12 +1,20 @@
 import random
 from collections import Counter, deque
 from dataclasses import dataclass, field
-from typing import List, Optional, Tuple, Set
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterable, List, Optional, Sequence, Tuple, Set, Union
 import logging
 
-from .biomes import Biomes
+from .ac4 import SupportPropagator
+from .biomes import EMPTY, Biomes, CompiledBiomes
 from .cell import Cell
+from .entropy import EntropyIndex
+from .events import EventRecorder, iter_collapse, iter_smooth
 from .exceptions import ImpossibleWorld
+from .smoothing import SmoothWorklist, smooth_grid
+from .storage import mask_cells, neighbor_coords
+
+if TYPE_CHECKING:
+    import numpy as np
 
 
 @dataclass
@@ -16,135 +24,333 @@ class Grid:
     biomes: Biomes
     grid: List[List[Optional[Cell]]] = field(init=False)
     entropy_grid: List[List[int]] = field(init=False)
-    potential_states: List[List[Set[str]]] = field(init=False)
+    potential_states: List[List[Union[Set[str], int]]] = field(init=False)
     smooth_point: Tuple[int, int] = (0, 0)
     
     connector_name: str = None
+    # Seed for this grid's own random number generator, None seeds from the OS
+    seed: Optional[int] = None
+    # Treat the grid as a torus, so cells on opposite edges are neighbors. Smoothing ignores this
+    # and stops at the edges, whichever entry point runs it
+    wrap: bool = False
     USE_RANDOM = True
+    # Hold each cell's potential states as a bitmask over biome indices instead of a set of ids
+    USE_BITSET = True
+    # With a depth above 0, a contradiction undoes up to this many of the most recent collapses and
+    # bans the choice that led to it, instead of raising ImpossibleWorld. Needs USE_BITSET
+    BACKTRACK_DEPTH = 0
+    # Prune domains with AC-4 support counts against every neighbor, collapsed or not, from the
+    # first collapse_least_entropy_cell on. Needs USE_BITSET
+    USE_AC4 = False
+    # Give up and raise ImpossibleWorld after this many backtracks in one run
+    MAX_BACKTRACKS = 10_000
+    # Trail entries kept for decisions that can no longer be undone before they're dropped
+    TRAIL_TRIM = 4096
 
     # Creating a logger
     logger = logging.getLogger("CGrid")
 
     def __post_init__(self):
+        # Each grid draws from its own generator, so runs are reproducible and grids don't interfere
+        self.rng: random.Random = random.Random(self.seed)
+        # Bit i of a potential states mask stands for rules.cells[i]
+        self.rules: CompiledBiomes = self.biomes.compile()
         self.grid = [[None for _ in range(self.width)] for _ in range(self.height)]
+        # (x, y) of each cell's neighbors, indexed by y * width + x
+        self.neighbors = neighbor_coords(self.width, self.height, self.wrap)
+        # smooth() stops at the edges even on a torus, like the vectorized and worklist smoothing
+        self.smooth_neighbors = neighbor_coords(self.width, self.height, False) if self.wrap else self.neighbors
         initial_entropy = self.calculate_initial_entropy()
         self.entropy_grid = [[initial_entropy for _ in range(self.width)] for _ in range(self.height)]
-        self.potential_states = [[set(biome.id for biome in self.biomes.biomes) for _ in range(self.width)] for _ in range(self.height)]
+        if self.USE_BITSET:
+            self.potential_states = [[self.rules.full_mask for _ in range(self.width)] for _ in range(self.height)]
+        else:
+            self.potential_states = [[set(biome.id for biome in self.rules.cells) for _ in range(self.width)] for _ in range(self.height)]
+        # Collapsed neighbor counts per cell, kept up to date by set_cell and used to look up sampling tables
+        self.neighbor_signatures: List[List[int]] = [[0 for _ in range(self.width)] for _ in range(self.height)]
+        # Uncollapsed cells, kept up to date by set_cell so completion checks don't scan the grid
+        self.open_cells: Set[Tuple[int, int]] = {(x, y) for y in range(self.height) for x in range(self.width)}
+        # Buckets uncollapsed cells by entropy so selection doesn't have to scan the grid
+        self.entropy_index = EntropyIndex(self.width, self.height, initial_entropy)
         self.smoothed = set()  # Track smoothed cells
         self._smooth_change: bool = False  # Trace if we've changed anything through a pass of the grid
+        self._smooth_worklist: Optional[SmoothWorklist] = None
+        # Gets every cell set and entropy change while installed, see iter_collapse
+        self.recorder: Optional[EventRecorder] = None
+        # Undo log of (kind, x, y, old value), None until the first backtracking collapse
+        self._trail: Optional[List[Tuple[str, int, int, Any]]] = None
+        # (x, y, biome index, trail length before the collapse) for the collapses that can still be undone
+        self._decisions: Deque[Tuple[int, int, int, int]] = deque()
+        # Biomes ruled out per cell by backtracking, as masks
+        self._banned: Dict[Tuple[int, int], int] = {}
+        self.backtracks = 0
+        self.max_backtrack_depth = 0
+        # AC-4 support counts, None until the first collapse with USE_AC4 set
+        self.supports: Optional[SupportPropagator] = None
 
     def calculate_initial_entropy(self) -> int:
-        return len(self.biomes.biomes)
+        return len(self.rules)
 
     def collapse_least_entropy_cell(self):
+        if self.USE_AC4 and self.supports is None:
+            # Seeds stamped so far were propagated the plain way, prune them fully before picking a cell
+            self.supports = SupportPropagator(self)
         if self.USE_RANDOM:
             y, x = self.find_least_entropy_cell_random()
         else:
             y, x = self.find_least_entropy_cell_first()
         if x is not None and y is not None:
-            self.collapse_cell(x, y)
+            if self.BACKTRACK_DEPTH > 0:
+                self.collapse_cell_backtracking(x, y)
+            else:
+                self.collapse_cell(x, y)
 
     def find_least_entropy_cell_first(self) -> Tuple[Optional[int], Optional[int]]:
-        min_entropy = float('inf')
-        min_entropy_index = (None, None)
-
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.grid[y][x] is None:
-                    if self.entropy_grid[y][x] < min_entropy:
-                        min_entropy = self.entropy_grid[y][x]
-                        min_entropy_index = (y, x)
-        
-        if min_entropy == float('inf'):
-            return None, None
-        
-        return min_entropy_index
+        return self.entropy_index.first()
 
     def find_least_entropy_cell_random(self) -> Tuple[Optional[int], Optional[int]]:
-        min_entropy = float('inf')
-        min_entropy_indices = []
-
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.grid[y][x] is None:
-                    if self.entropy_grid[y][x] < min_entropy:
-                        min_entropy = self.entropy_grid[y][x]
-                        min_entropy_indices = [(y, x)]
-                    elif self.entropy_grid[y][x] == min_entropy:
-                        min_entropy_indices.append((y, x))
-        
-        if min_entropy == float('inf'):
-            return None, None
-        
-        return random.choice(min_entropy_indices)
+        return self.entropy_index.random(self.rng)
     
     def collapse_cell(self, x: int, y: int):
         if self.grid[y][x] is None:  # Note: numpy uses (row, col), i.e., (y, x)
-            possible_states = list(self.potential_states[y][x])
-            weights = [self.calculate_weight(x, y, self.biomes.find_by_id(state)) for state in possible_states]
-            try:
-                chosen_state = random.choices(possible_states, weights=weights)[0]
-                chosen_object = self.biomes.find_by_id(chosen_state)
-            except ValueError:
-                raise ImpossibleWorld(f"Cannot resolve world, stopping at {x},{y}", self.get_neighbors(x, y))
+            self.set_cell(x, y, self.choose_state(x, y))
+
+    def choose_state(self, x: int, y: int) -> Cell:
+        if self.USE_BITSET:
+            mask = self.potential_states[y][x]
+        else:
+            mask = sum(1 << self.rules.index[state] for state in self.potential_states[y][x])
+        # Weighted candidates come from a table shared by every cell with the same neighborhood
+        candidates, cum_weights = self.rules.sampling_table(self.neighbor_signatures[y][x], mask)
+        if not candidates:
+            raise ImpossibleWorld(f"Cannot resolve world, stopping at {x},{y}", self.get_neighbors(x, y))
+        return self.rng.choices(candidates, cum_weights=cum_weights)[0]
+
+    def collapse_cell_backtracking(self, x: int, y: int):
+        if self.grid[y][x] is not None:
+            return
+        if self._trail is None:
+            # Cells set before this point (add_random seeds) are never undone
+            self._trail = []
+        try:
+            chosen_object = self.choose_state(x, y)
+        except ImpossibleWorld:
+            self.backtrack(x, y)
+            return
+        self._decisions.append((x, y, self.rules.index[chosen_object.id], len(self._trail)))
+        if len(self._decisions) > self.BACKTRACK_DEPTH:
+            self._decisions.popleft()
+            self.trim_trail()
+        try:
             self.set_cell(x, y, chosen_object)
-            
+        except ImpossibleWorld:
+            # AC-4 found an empty domain while propagating this collapse
+            self.backtrack(x, y)
+
+    def backtrack(self, x: int, y: int):
+        # Undo recent collapses until one can be banned without emptying its cell
+        depth = 0
+        while self._decisions and self.backtracks < self.MAX_BACKTRACKS:
+            dx, dy, index, mark = self._decisions.pop()
+            self.undo_to(mark)
+            depth += 1
+            try:
+                self.ban(dx, dy, index)
+            except ImpossibleWorld:
+                # The ban emptied a domain somewhere, the next undo takes it back out
+                continue
+            if self.potential_states[dy][dx]:
+                self.backtracks += 1
+                self.max_backtrack_depth = max(self.max_backtrack_depth, depth)
+                self.logger.debug("backtracked %s collapses from %s,%s, banned %s at %s,%s",
+                                  depth, x, y, self.rules.ids[index], dx, dy)
+                return
+        raise ImpossibleWorld(f"Cannot resolve world, stopping at {x},{y} after {self.backtracks} backtracks",
+                              self.get_neighbors(x, y))
+
+    def ban(self, x: int, y: int, index: int):
+        bit = 1 << index
+        old = self._banned.get((x, y), 0)
+        self._trail.append(('ban', x, y, old))
+        self._banned[(x, y)] = old | bit
+        if self.supports is not None:
+            self.supports.remove(x, y, bit)
+        else:
+            self.set_domain(x, y, self.potential_states[y][x] & ~bit, None)
+
+    def set_domain(self, x: int, y: int, states: Union[Set[str], int], entropy: Optional[int]):
+        if entropy is None:
+            entropy = bin(states).count("1") if self.USE_BITSET else len(states)
+        if self._trail is not None:
+            self._trail.append(('domain', x, y, (self.potential_states[y][x], self.entropy_grid[y][x])))
+        if self.recorder is not None and entropy != self.entropy_grid[y][x]:
+            self.recorder.entropy(x, y, entropy)
+        self.potential_states[y][x] = states
+        self.entropy_grid[y][x] = entropy
+        self.entropy_index.update(x, y, entropy)
+
+    def undo_to(self, mark: int):
+        trail = self._trail
+        while len(trail) > mark:
+            kind, x, y, old = trail.pop()
+            if kind == 'domain':
+                states, entropy = old
+                if self.recorder is not None and entropy != self.entropy_grid[y][x] and self.grid[y][x] is None:
+                    self.recorder.entropy(x, y, entropy)
+                self.potential_states[y][x] = states
+                self.entropy_grid[y][x] = entropy
+                # Ignored while the cell is collapsed, the 'cell' entry below it re-adds it
+                self.entropy_index.update(x, y, entropy)
+            elif kind == 'cell':
+                self.update_signatures(x, y, self.grid[y][x], old)
+                self.grid[y][x] = old
+                if self.recorder is not None:
+                    self.recorder.cell(x, y, EMPTY if old is None else self.rules.index[old.id])
+                    if old is None:
+                        self.recorder.entropy(x, y, self.entropy_grid[y][x])
+                if old is None:
+                    self.open_cells.add((x, y))
+                    self.entropy_index.add(x, y, self.entropy_grid[y][x])
+            elif kind == 'support':
+                # x is the index of a support count that went down by one
+                self.supports.counts[x] += 1
+            elif kind == 'ban':
+                if old:
+                    self._banned[(x, y)] = old
+                else:
+                    self._banned.pop((x, y), None)
+
+    def reset_domains(self):
+        # Recompute every open domain from its collapsed neighbors and bans, then rebuild the AC-4
+        # counts. Nothing before this point can be undone any more
+        trail, self._trail = self._trail, None
+        self._decisions.clear()
+        for x, y in self.open_cells:
+            states, entropy = self.rules.domain(self.neighbor_signatures[y][x])
+            banned = self._banned.get((x, y))
+            if banned:
+                states &= ~banned
+                entropy = None
+            self.set_domain(x, y, states, entropy)
+        self.supports.rebuild()
+        self._trail = [] if trail is not None else None
+
+    def trim_trail(self):
+        # Entries before the oldest decision still on the stack can never be undone
+        base = self._decisions[0][3] if self._decisions else len(self._trail)
+        if base > self.TRAIL_TRIM and base * 2 > len(self._trail):
+            del self._trail[:base]
+            self._decisions = deque((x, y, index, mark - base) for x, y, index, mark in self._decisions)
+
+    def backtrack_stats(self) -> Dict[str, int]:
+        return {'backtracks': self.backtracks, 'max_depth': self.max_backtrack_depth, 'banned_cells': len(self._banned)}
+
     def set_cell(self, x: int, y: int, cell: Cell):
+        old_states = self.write_cell(x, y, cell)
+        if self.supports is None:
+            self.propagate_entropy(x, y)
+        elif old_states & self.potential_states[y][x]:
+            self.supports.collapsed(x, y, old_states)
+        else:
+            # Pinning a biome that had been ruled out, support counts can't grow back incrementally
+            self.reset_domains()
+
+    def set_cells(self, cells: Iterable[Tuple[int, int, int]]) -> None:
+        # Pin every (x, y, biome index) first, then run one propagation out from all of them
+        if self.supports is not None:
+            # AC-4 already propagates each pin on its own incrementally
+            for x, y, biome in cells:
+                self.set_cell(x, y, self.rules.cells[biome])
+            return
+        frontier = []
+        for x, y, biome in cells:
+            self.write_cell(x, y, self.rules.cells[biome])
+            frontier.append((x, y))
+        self.propagate_from(frontier)
+
+    def write_cell(self, x: int, y: int, cell: Cell) -> Union[Set[str], int]:
+        # Collapse a cell without propagating, returns its potential states from before
+        old_states = self.potential_states[y][x]
+        if self._trail is not None:
+            self._trail.append(('cell', x, y, self.grid[y][x]))
+            self._trail.append(('domain', x, y, (old_states, self.entropy_grid[y][x])))
+        self.update_signatures(x, y, self.grid[y][x], cell)
         self.grid[y][x] = cell
-        self.potential_states[y][x] = {cell.id}
+        if self.recorder is not None:
+            self.recorder.cell(x, y, self.rules.index[cell.id])
+        if self.USE_BITSET:
+            self.potential_states[y][x] = 1 << self.rules.index[cell.id]
+        else:
+            self.potential_states[y][x] = {cell.id}
         self.entropy_grid[y][x] = 0
-        self.propagate_entropy(x, y)
+        self.open_cells.discard((x, y))
+        self.entropy_index.remove(x, y)
+        return old_states
+
+    def update_signatures(self, x: int, y: int, old: Optional[Cell], new: Optional[Cell]) -> None:
+        # Each cell's signature counts its collapsed neighbors per biome, see CompiledBiomes.signature_units
+        units = self.rules.signature_units
+        delta = units[self.rules.index[new.id]] if new is not None else 0
+        if old is not None:
+            delta -= units[self.rules.index[old.id]]
+        if delta == 0:
+            return
+        for nx, ny in self.neighbors[y * self.width + x]:
+            self.neighbor_signatures[ny][nx] += delta
 
     def propagate_entropy(self, x: int, y: int):
-        queue = deque([(x, y)])
+        self.propagate_from([(x, y)])
+
+    def propagate_from(self, cells: Iterable[Tuple[int, int]]):
+        queue = deque(cells)
 
         while queue:
             cx, cy = queue.popleft()
             self.logger.debug("deque cx %s cy %s", cx, cy)
-            for dx in [-1, 0, 1]:
-                for dy in [-1, 0, 1]:
-                    if dx == 0 and dy == 0:
-                        continue
-                    nx, ny = cx + dx, cy + dy
-                    if 0 <= nx < self.width and 0 <= ny < self.height and self.grid[ny][nx] is None:
-                        old_potential_states = self.potential_states[ny][nx]
-                        new_potential_states = set(obj.id for obj in self.biomes.biomes if self.is_valid_object(nx, ny, obj))
-                        if new_potential_states != old_potential_states:
-                            self.logger.debug("nx %s ny %s, new potential states %s", nx, ny, len(new_potential_states))
-                            self.potential_states[ny][nx] = new_potential_states
-                            self.entropy_grid[ny][nx] = len(new_potential_states)
-                            queue.append((nx, ny))
+            for nx, ny in self.neighbors[cy * self.width + cx]:
+                if self.grid[ny][nx] is None:
+                    old_potential_states = self.potential_states[ny][nx]
+                    if self.USE_BITSET:
+                        new_potential_states, entropy = self.rules.domain(self.neighbor_signatures[ny][nx])
+                        if self._banned and (nx, ny) in self._banned:
+                            new_potential_states &= ~self._banned[(nx, ny)]
+                            entropy = None
+                    else:
+                        new_potential_states = set(obj.id for obj in self.rules.cells if self.is_valid_object(nx, ny, obj))
+                        entropy = len(new_potential_states)
+                    if new_potential_states != old_potential_states:
+                        self.logger.debug("nx %s ny %s, new potential states %s", nx, ny, entropy)
+                        self.set_domain(nx, ny, new_potential_states, entropy)
+                        queue.append((nx, ny))
 
     def is_valid_object(self, x: int, y: int, obj: Cell) -> bool:
+        compatible = self.rules.compat_table[self.rules.index[obj.id]]
         neighbors = self.get_neighbors(x, y)
         for neighbor in neighbors:
-            if neighbor and (obj.id not in neighbor.allowed_neighbors() or neighbor.id not in obj.allowed_neighbors()):
+            if neighbor and not compatible[self.rules.index[neighbor.id]]:
                 return False
         return True
 
-    def get_neighbors(self, x: int, y: int) -> List[Optional[Cell]]:
-        neighbors = []
-        for dx in [-1, 0, 1]:
-            for dy in [-1, 0, 1]:
-                if dx == 0 and dy == 0:
-                    continue
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height:
-                    neighbors.append(self.grid[ny][nx])
-        return neighbors
+    def get_neighbors(self, x: int, y: int, table=None) -> List[Optional[Cell]]:
+        # table is a neighbor table to read instead of self.neighbors, smooth() passes one that doesn't wrap
+        table = self.neighbors if table is None else table
+        return [self.grid[ny][nx] for nx, ny in table[y * self.width + x]]
 
     def calculate_weight(self, x: int, y: int, obj: Cell) -> float:
         weight = 1.0
+        column = self.rules.index[obj.id]
+        weight_table = self.rules.weight_table
+        index = self.rules.index
         neighbors = self.get_neighbors(x, y)
         for neighbor in neighbors:
             if neighbor:
-                weight *= neighbor.neighbor_weights.get(obj.id, 0)
+                weight *= weight_table[index[neighbor.id]][column]
         return weight
     
     def smooth(self) -> bool:
         remove_id = None
         if self.connector_name:
-            remove_id = self.biomes.find_by_id(self.connector_name).id
+            remove_id = self.rules.find_by_id(self.connector_name).id
         while True:
             x, y = self.smooth_point
             
@@ -158,7 +364,7 @@ class Grid:
                     return False
             
             # Get the neighbors of the current cell
-            neighbors = self.get_neighbors(x, y)
+            neighbors = self.get_neighbors(x, y, self.smooth_neighbors)
             
             # Collect the IDs of the neighbors
             neighbor_ids = [neighbor.id for neighbor in neighbors if neighbor is not None]
@@ -181,13 +387,37 @@ class Grid:
                 most_common_ids_dict[current_object.id] = 0
 
             if most_common_ids_dict[current_object.id] < 3 and current_object.id != majority_id:
-                self.grid[y][x] = self.biomes.find_by_id(majority_id)
+                self.grid[y][x] = self.rules.find_by_id(majority_id)
                 self._smooth_change = True
                 return True  # Return after smoothing one cell
             
             # Move to the next cell if no change was made
             self.update_smooth_point()
 
+    def iter_collapse(self, chunk_size: Optional[int] = None):
+        # Collapse the rest of the grid, yielding a CollapseEvent per cell set, or lists of chunk_size of them
+        return iter_collapse(self, chunk_size)
+
+    def iter_smooth(self, chunk_size: Optional[int] = None):
+        # Smooth with the worklist, yielding a CollapseEvent per cell changed, or lists of chunk_size of them
+        if self._smooth_worklist is None:
+            self._smooth_worklist = SmoothWorklist(self, self.connector_name)
+        return iter_smooth(self._smooth_worklist, chunk_size)
+
+    def index_array(self) -> "np.ndarray":
+        # The map as a uint8 index array over rules.cells, EMPTY where uncollapsed
+        return self.rules.encode(self.grid)
+
+    def smooth_vectorized(self, exact: bool = False) -> int:
+        # Smooth the whole grid to a fixpoint in one call, returns the number of cell changes
+        return smooth_grid(self, self.connector_name, exact)
+
+    def smooth_incremental(self, budget: Optional[int] = None) -> bool:
+        # Worklist smoothing, looks at no more than budget cells per call and returns True while work remains
+        if self._smooth_worklist is None:
+            self._smooth_worklist = SmoothWorklist(self, self.connector_name)
+        return self._smooth_worklist.run(budget)
+
     # Advance smooth point to next entry in grid
     def update_smooth_point(self):
         x, y = self.smooth_point
@@ -197,18 +427,42 @@ class Grid:
             self.smooth_point = (0, y + 1)
 
     def add_random(self, id: str, size: int = 1) -> None:
+        obj = self.rules.find_by_id(id)
+        for x, y in self.random_cross(size):
+            self.set_cell(x, y, obj)
+
+    def random_cross(self, size: int) -> List[Tuple[int, int]]:
+        # Cells of a cross with arms of size at a random spot, drawn the way add_random places them
         offset = size - 1
-        x = random.randint(0 + offset, self.width - offset - 1)
-        y = random.randint(0 + offset, self.height - offset - 1)
-        obj = self.biomes.find_by_id(id)
-        for dx in range(-size, size + 1):
-            if 0 <= x + dx < self.width:
-                self.set_cell(x + dx, y, obj)
-        for dy in range(-size, size + 1):
-            if 0 <= y + dy < self.height:
-                self.set_cell(x, y + dy, obj)
+        x = self.rng.randint(0 + offset, self.width - offset - 1)
+        y = self.rng.randint(0 + offset, self.height - offset - 1)
+        cross = [(x + dx, y) for dx in range(-size, size + 1) if 0 <= x + dx < self.width]
+        return cross + [(x, y + dy) for dy in range(-size, size + 1) if 0 <= y + dy < self.height]
+
+    def add_many(self, seeds: Sequence[Tuple[str, int]]) -> None:
+        # Stamp the same crosses as calling add_random for each (id, size), with one propagation
+        index = self.rules.index
+        self.set_cells([(x, y, index[id]) for id, size in seeds for x, y in self.random_cross(size)])
+
+    def stamp(self, mask: Any, id: str) -> None:
+        # Pin the cells of a height x width mask to one biome, e.g. an area painted in an editor
+        biome = self.rules.index[id]
+        self.set_cells([(x, y, biome) for x, y in mask_cells(mask, self.width, self.height)])
+
+    def save(self, path: str, codec: str = 'raw') -> int:
+        # Write the map as a map file, EMPTY where uncollapsed, returns its size in bytes. See mapgen.mapfile
+        from .mapfile import save_map
+        return save_map(path, self.index_array(), self.rules, codec)
+
+    def load(self, path: str) -> None:
+        # Pin every collapsed cell of a saved map of this grid's size, matching biomes by id
+        from .mapfile import load_map
+        self.set_cells(load_map(path).cells_for(self.rules, self.width, self.height))
 
     def needs_work(self) -> bool:
-        return any(any(cell is None for cell in row) for row in self.grid)
+        return bool(self.open_cells)
+
+    def remaining(self) -> int:
+        return len(self.open_cells)
     
         
\ No newline at end of file
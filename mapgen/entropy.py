@@ -0,0 +1,105 @@
+import heapq
+import random
+from typing import Dict, List, Optional, Tuple
+
+
+class EntropyIndex:
+    """
+    Tracks the entropy of every uncollapsed cell so the least entropy cell can be found
+    without scanning the grid.
+
+    Cells are kept in per-entropy buckets, which makes a random pick among the lowest
+    entropy cells O(number of distinct entropies). The first index pick uses a heap of
+    (entropy, flat index) entries with lazy deletion, so ties resolve in the same row-major
+    order as a full scan of the grid.
+    """
+
+    def __init__(self, width: int, height: int, initial_entropy: int):
+        self.width = width
+        size = width * height
+        # Entropy per flat index, None once the cell is removed from the index
+        self._entropy: List[Optional[int]] = [initial_entropy] * size
+        self._buckets: Dict[int, List[int]] = {initial_entropy: list(range(size))} if size else {}
+        self._pos: List[int] = list(range(size))
+        self._heap: Optional[List[Tuple[int, int]]] = None
+        self._count = size
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, xy: Tuple[int, int]) -> bool:
+        x, y = xy
+        return self._entropy[y * self.width + x] is not None
+
+    def entropy(self, x: int, y: int) -> Optional[int]:
+        return self._entropy[y * self.width + x]
+
+    def update(self, x: int, y: int, entropy: int) -> None:
+        self.update_flat(y * self.width + x, entropy)
+
+    def update_flat(self, flat: int, entropy: int) -> None:
+        old = self._entropy[flat]
+        if old is None or old == entropy:
+            return
+        self._take(flat, old)
+        self._put(flat, entropy)
+        self._entropy[flat] = entropy
+        if self._heap is not None:
+            heapq.heappush(self._heap, (entropy, flat))
+
+    def remove(self, x: int, y: int) -> None:
+        self.remove_flat(y * self.width + x)
+
+    def remove_flat(self, flat: int) -> None:
+        old = self._entropy[flat]
+        if old is None:
+            return
+        self._take(flat, old)
+        self._entropy[flat] = None
+        self._count -= 1
+
+    def add(self, x: int, y: int, entropy: int) -> None:
+        flat = y * self.width + x
+        if self._entropy[flat] is not None:
+            self.update(x, y, entropy)
+            return
+        self._put(flat, entropy)
+        self._entropy[flat] = entropy
+        self._count += 1
+        if self._heap is not None:
+            heapq.heappush(self._heap, (entropy, flat))
+
+    def first(self) -> Tuple[Optional[int], Optional[int]]:
+        if self._heap is None:
+            # Only pay for the ordering when first index selection is actually used
+            self._heap = [(e, flat) for flat, e in enumerate(self._entropy) if e is not None]
+            heapq.heapify(self._heap)
+        heap = self._heap
+        while heap:
+            entropy, flat = heap[0]
+            if self._entropy[flat] == entropy:
+                return divmod(flat, self.width)
+            heapq.heappop(heap)
+        return None, None
+
+    def random(self, rng=random) -> Tuple[Optional[int], Optional[int]]:
+        if not self._buckets:
+            return None, None
+        bucket = self._buckets[min(self._buckets)]
+        return divmod(rng.choice(bucket), self.width)
+
+    def _put(self, flat: int, entropy: int) -> None:
+        bucket = self._buckets.setdefault(entropy, [])
+        self._pos[flat] = len(bucket)
+        bucket.append(flat)
+
+    def _take(self, flat: int, entropy: int) -> None:
+        # Swap with the last entry so removal from the bucket is O(1)
+        bucket = self._buckets[entropy]
+        pos = self._pos[flat]
+        last = bucket.pop()
+        if last != flat:
+            bucket[pos] = last
+            self._pos[last] = pos
+        if not bucket:
+            del self._buckets[entropy]
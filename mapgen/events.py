@@ -0,0 +1,96 @@
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple, TypeVar, Union
+
+from .exceptions import ImpossibleWorld
+
+T = TypeVar("T")
+
+
+class CollapseEvent(NamedTuple):
+    """
+    One cell set by an engine. biome is an index into rules.cells, or EMPTY when
+    backtracking opens the cell again. entropy_changes holds (x, y, entropy) for the open
+    cells whose entropy changed as a result, and is empty for smoothing changes.
+    """
+    x: int
+    y: int
+    biome: int
+    entropy_changes: Tuple[Tuple[int, int, int], ...]
+
+
+class EventRecorder:
+    """
+    Collects CollapseEvents from an engine while it's installed as grid.recorder. Entropy
+    changes belong to the last cell set before them; any reported before the first cell of
+    a step go with that cell.
+    """
+    __slots__ = ('events', '_current', '_changes')
+
+    def __init__(self):
+        self.events: List[CollapseEvent] = []
+        self._current: Optional[Tuple[int, int, int]] = None
+        self._changes: List[Tuple[int, int, int]] = []
+
+    def cell(self, x: int, y: int, biome: int) -> None:
+        if self._current is not None:
+            self._close()
+        self._current = (x, y, biome)
+
+    def entropy(self, x: int, y: int, entropy: int) -> None:
+        self._changes.append((x, y, entropy))
+
+    def _close(self) -> None:
+        x, y, biome = self._current
+        self.events.append(CollapseEvent(x, y, biome, tuple(self._changes)))
+        self._current = None
+        self._changes = []
+
+    def drain(self) -> List[CollapseEvent]:
+        # Events recorded since the last drain, closing the one in progress
+        if self._current is not None:
+            self._close()
+        events, self.events = self.events, []
+        return events
+
+
+def chunked(events: Iterable[T], size: int) -> Iterator[List[T]]:
+    # Group events into lists of size, the last one may be shorter
+    chunk: List[T] = []
+    for event in events:
+        chunk.append(event)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_collapse(grid, chunk_size: Optional[int] = None) -> Iterator[Union[CollapseEvent, List[CollapseEvent]]]:
+    """
+    Run grid.collapse_least_entropy_cell until the grid is done, yielding a CollapseEvent
+    for every cell that gets set, or lists of up to chunk_size of them. Cells set before the
+    call, such as add_random stamps, aren't reported. On ImpossibleWorld the events of the
+    failed step are yielded before the exception is raised.
+    """
+    events = _collapse_events(grid)
+    return chunked(events, chunk_size) if chunk_size else events
+
+
+def _collapse_events(grid) -> Iterator[CollapseEvent]:
+    previous, recorder = grid.recorder, EventRecorder()
+    grid.recorder = recorder
+    try:
+        while grid.needs_work():
+            try:
+                grid.collapse_least_entropy_cell()
+            except ImpossibleWorld:
+                yield from recorder.drain()
+                raise
+            yield from recorder.drain()
+    finally:
+        grid.recorder = previous
+
+
+def iter_smooth(worklist, chunk_size: Optional[int] = None) -> Iterator[Union[CollapseEvent, List[CollapseEvent]]]:
+    # Run a SmoothWorklist to the end, yielding a CollapseEvent per cell it changes
+    events = (CollapseEvent(x, y, biome, ()) for x, y, biome in worklist.iter_changes())
+    return chunked(events, chunk_size) if chunk_size else events
@@ -1,7 +1,17 @@
 """
 Weights don't fully collapse
 """
+from typing import List
+
+
 class ImpossibleWorld(Exception):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
-        
\ No newline at end of file
+        
+
+class InvalidRules(ValueError):
+    # A rule file that doesn't describe a usable biome set, problems lists everything wrong with it
+    def __init__(self, path: str, problems: List[str]) -> None:
+        super().__init__(f"{path}: " + "; ".join(problems))
+        self.path = path
+        self.problems = problems
@@ -0,0 +1,69 @@
+import logging
+import random
+from importlib import import_module
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple
+
+from .biomes import Biomes
+from .exceptions import ImpossibleWorld
+from .presets import CONNECTOR_ID
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+ENGINES: Tuple[str, ...] = ('lgrid', 'cgrid', 'grid', 'ngrid')
+
+
+def seeds_that_fit(seeds: Sequence[Tuple[str, int]], width: int, height: int) -> List[Tuple[str, int]]:
+    # The (id, size) seeds whose crosses random_cross can place in a width x height grid
+    fitting = [(biome_id, size) for biome_id, size in seeds if 2 * size - 1 <= min(width, height)]
+    if len(fitting) < len(seeds):
+        logger.debug("Skipped %s seeds too big for a %sx%s grid", len(seeds) - len(fitting), width, height)
+    return fitting
+
+
+def make_grid(engine: str, biomes: Biomes, width: int, height: int, connector: Optional[str] = CONNECTOR_ID,
+              use_random: Optional[bool] = None, seed: Optional[int] = None):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine!r}, expected one of {', '.join(ENGINES)}")
+    module = import_module(f".{engine}", __package__)
+    grid = module.Grid(width=width, height=height, biomes=biomes, seed=seed)
+    # grid.py calls the connector connector_id, the list engines call it connector_name
+    if engine == 'grid':
+        grid.connector_id = connector
+    else:
+        grid.connector_name = connector
+    if use_random is not None:
+        grid.USE_RANDOM = use_random
+    return grid
+
+
+def generate_map(engine: str, biomes: Biomes, width: int, height: int, seeds: Sequence[Tuple[str, int]],
+                 seed: int, connector: Optional[str] = CONNECTOR_ID, smooth: bool = True, retries: int = 3,
+                 use_random: Optional[bool] = None) -> "Tuple[np.ndarray, int]":
+    """
+    Generate one map and return it as a uint8 index array over biomes.compile().cells,
+    along with the number of attempts it took. A run that hits ImpossibleWorld is
+    started again from scratch, up to retries times. The first attempt uses seed as the
+    grid seed, later ones draw theirs from a generator seeded with it, so the result only
+    depends on the arguments.
+    """
+    retry_seeds = random.Random(seed)
+    grid_seed = seed
+    for attempt in range(1, retries + 2):
+        if attempt > 1:
+            grid_seed = retry_seeds.getrandbits(64)
+        grid = make_grid(engine, biomes, width, height, connector, use_random, grid_seed)
+        try:
+            grid.add_many(seeds)
+            while grid.needs_work():
+                grid.collapse_least_entropy_cell()
+        except ImpossibleWorld as e:
+            logger.debug("Seed %s attempt %s failed: %s", seed, attempt, e.args[0])
+            continue
+        if smooth:
+            grid.smooth_vectorized()
+        return grid.index_array(), attempt
+    raise ImpossibleWorld(f"Cannot resolve world for seed {seed} after {retries + 1} attempts")
@@ -2,12 +2,15 @@ import logging
 import random
 from collections import Counter
 from dataclasses import dataclass, field
-from typing import List, Optional, Tuple
+from typing import Any, Iterable, List, Optional, Sequence, Set, Tuple
 
 import numpy as np
 
-from .biomes import Biomes
+from .biomes import Biomes, CompiledBiomes
+from .events import EventRecorder, iter_collapse, iter_smooth
 from .exceptions import ImpossibleWorld
+from .smoothing import SmoothWorklist, smooth_grid
+from .storage import mask_cells
 from .cell import Cell
 
 # Creating a logger
@@ -25,16 +28,28 @@ class Grid:
     # Keey the ability to generate based on either random or first index methods - they produce different looking results
     USE_RANDOM = False
     connector_id: str = None
+    # Seed for this grid's own random number generator, None seeds from the OS
+    seed: Optional[int] = None
     LARGE_INT = 10**9  # Use a large integer to represent 'infinity'
 
     def __post_init__(self):
+        # Each grid draws from its own generator, so runs are reproducible and grids don't interfere
+        self.rng: random.Random = random.Random(self.seed)
+        self.rules: CompiledBiomes = self.biomes.compile()
         self.grid = np.full((self.height, self.width), None, dtype=object)
         self.entropy_grid = np.full((self.height, self.width), self.calculate_initial_entropy(), dtype=int)
+        # Collapsed neighbor counts per cell, kept up to date by set_cell and used to look up sampling tables
+        self.neighbor_signatures: List[List[int]] = [[0 for _ in range(self.width)] for _ in range(self.height)]
+        # Uncollapsed cells, kept up to date by set_cell so completion checks don't scan the grid
+        self.open_cells: Set[Tuple[int, int]] = {(x, y) for y in range(self.height) for x in range(self.width)}
         self.smoothed = set()  # Track smoothed cells
         self._smooth_change: bool = False  # Trace if we've changed anything through a pass of the grid
+        self._smooth_worklist: Optional[SmoothWorklist] = None
+        # Gets every cell set and entropy change while installed, see iter_collapse
+        self.recorder: Optional[EventRecorder] = None
 
     def calculate_initial_entropy(self) -> int:
-        return len(self.biomes.biomes)
+        return len(self.rules)
 
     def collapse_least_entropy_cell(self):
         if self.USE_RANDOM:
@@ -67,41 +82,81 @@ class Grid:
         if min_entropy == self.LARGE_INT:
             return None, None        
         min_entropy_indices = np.argwhere(self.entropy_grid == min_entropy)
-        chosen_index = random.choice(min_entropy_indices)        
+        chosen_index = self.rng.choice(min_entropy_indices)        
         return tuple(chosen_index)
 
     def collapse_cell(self, x: int, y: int):
         if self.grid[y, x] is None:  # Note: numpy uses (row, col), i.e., (y, x)
-            weights = [self.calculate_weight(x, y, obj) for obj in self.biomes.biomes]
-            try:
-                chosen_object = random.choices(self.biomes.biomes, weights=weights)[0]
-            except ValueError:
+            # Weighted candidates come from a table shared by every cell with the same neighborhood
+            candidates, cum_weights = self.rules.sampling_table(self.neighbor_signatures[y][x], self.rules.full_mask)
+            if not candidates:
                 raise ImpossibleWorld(f"Cannot resolve world, stopping at {x},{y}", self.get_neighbors(x, y))
+            chosen_object = self.rng.choices(candidates, cum_weights=cum_weights)[0]
             self.set_cell(x, y, chosen_object)
 
     def set_cell(self, x: int, y: int, cell: Cell) -> None:
+            self.update_signatures(x, y, self.grid[y, x], cell)
             self.grid[y, x] = cell
+            if self.recorder is not None:
+                self.recorder.cell(x, y, self.rules.index[cell.id])
+            self.open_cells.discard((x, y))
             # Set entropy to LARGE_INT for the assigned cell
             self.entropy_grid[y, x] = self.LARGE_INT
             self.update_neighbors_entropy(x, y)
             return
 
+    def update_signatures(self, x: int, y: int, old: Optional[Cell], new: Cell) -> None:
+        # Each cell's signature counts its collapsed neighbors per biome, see CompiledBiomes.signature_units
+        units = self.rules.signature_units
+        delta = units[self.rules.index[new.id]]
+        if old is not None:
+            delta -= units[self.rules.index[old.id]]
+        if delta == 0:
+            return
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if dx == 0 and dy == 0:
+                    continue
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < self.width and 0 <= ny < self.height:
+                    self.neighbor_signatures[ny][nx] += delta
+
+    def set_cells(self, cells: Iterable[Tuple[int, int, int]]) -> None:
+        # Pin every (x, y, biome index) first, then update the open cells around them once each
+        touched = set()
+        for x, y, biome in cells:
+            cell = self.rules.cells[biome]
+            self.update_signatures(x, y, self.grid[y, x], cell)
+            self.grid[y, x] = cell
+            if self.recorder is not None:
+                self.recorder.cell(x, y, biome)
+            self.open_cells.discard((x, y))
+            self.entropy_grid[y, x] = self.LARGE_INT
+            touched.update((x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy)
+        for x, y in touched:
+            self.update_entropy(x, y)
+
     def update_neighbors_entropy(self, x: int, y: int):
         for dx in [-1, 0, 1]:
             for dy in [-1, 0, 1]:
                 if dx == 0 and dy == 0:
                     continue
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height and self.grid[ny, nx] is None:
-                    valid_objects = [obj for obj in self.biomes.biomes if self.is_valid_object(nx, ny, obj)]
-                    self.entropy_grid[ny, nx] = len(valid_objects)
-                    logger.debug("entropy after update of x %s y%s \n%s", x, y, self.entropy_grid)
+                self.update_entropy(x + dx, y + dy)
+                logger.debug("entropy after update of x %s y%s \n%s", x, y, self.entropy_grid)
+
+    def update_entropy(self, x: int, y: int):
+        if 0 <= x < self.width and 0 <= y < self.height and self.grid[y, x] is None:
+            entropy = self.rules.domain(self.neighbor_signatures[y][x])[1]
+            if self.recorder is not None and entropy != self.entropy_grid[y, x]:
+                self.recorder.entropy(x, y, entropy)
+            self.entropy_grid[y, x] = entropy
 
     def is_valid_object(self, x: int, y: int, obj: Cell) -> bool:
+        compatible = self.rules.compat_table[self.rules.index[obj.id]]
         neighbors = self.get_neighbors(x, y)
         for neighbor in neighbors:
             if neighbor:
-                if obj.id not in neighbor.neighbor_weights or neighbor.id not in obj.neighbor_weights:
+                if not compatible[self.rules.index[neighbor.id]]:
                     return False
         return True
 
@@ -118,16 +173,19 @@ class Grid:
 
     def calculate_weight(self, x: int, y: int, obj: Cell) -> float:
         weight = 1.0
+        column = self.rules.index[obj.id]
+        weight_table = self.rules.weight_table
+        index = self.rules.index
         neighbors = self.get_neighbors(x, y)
         for neighbor in neighbors:
             if neighbor:
-                weight *= neighbor.neighbor_weights.get(obj.id, 0)
+                weight *= weight_table[index[neighbor.id]][column]
         return weight
 
     def smooth(self) -> bool:
         remove_id = None
         if self.connector_id:
-            remove_id = self.biomes.find_by_id(self.connector_id).id
+            remove_id = self.rules.find_by_id(self.connector_id).id
         while True:
             x, y = self.smooth_point
             
@@ -164,13 +222,37 @@ class Grid:
                 most_common_ids_dict[current_object.id] = 0
 
             if most_common_ids_dict[current_object.id] < 3 and current_object.id != majority_id:
-                self.grid[y, x] = self.biomes.find_by_id(majority_id)
+                self.grid[y, x] = self.rules.find_by_id(majority_id)
                 self._smooth_change = True
                 return True  # Return after smoothing one cell
             
             # Move to the next cell if no change was made
             self.update_smooth_point()
 
+    def iter_collapse(self, chunk_size: Optional[int] = None):
+        # Collapse the rest of the grid, yielding a CollapseEvent per cell set, or lists of chunk_size of them
+        return iter_collapse(self, chunk_size)
+
+    def iter_smooth(self, chunk_size: Optional[int] = None):
+        # Smooth with the worklist, yielding a CollapseEvent per cell changed, or lists of chunk_size of them
+        if self._smooth_worklist is None:
+            self._smooth_worklist = SmoothWorklist(self, self.connector_id)
+        return iter_smooth(self._smooth_worklist, chunk_size)
+
+    def index_array(self) -> np.ndarray:
+        # The map as a uint8 index array over rules.cells, EMPTY where uncollapsed
+        return self.rules.encode(self.grid)
+
+    def smooth_vectorized(self, exact: bool = False) -> int:
+        # Smooth the whole grid to a fixpoint in one call, returns the number of cell changes
+        return smooth_grid(self, self.connector_id, exact)
+
+    def smooth_incremental(self, budget: Optional[int] = None) -> bool:
+        # Worklist smoothing, looks at no more than budget cells per call and returns True while work remains
+        if self._smooth_worklist is None:
+            self._smooth_worklist = SmoothWorklist(self, self.connector_id)
+        return self._smooth_worklist.run(budget)
+
     # Advance smooth point to next entry in grid
     def update_smooth_point(self):
         x, y = self.smooth_point
@@ -179,23 +261,42 @@ class Grid:
         else:
             self.smooth_point = (0, y + 1)
 
-    def is_valid_object(self, x: int, y: int, obj: Cell) -> bool:
-        neighbors = self.get_neighbors(x, y)
-        for neighbor in neighbors:
-            if neighbor:
-                if obj.id not in neighbor.neighbor_weights or neighbor.id not in obj.neighbor_weights:
-                    return False
-        return True
-
     def add_random(self, id: str, size: int = 1) -> None:
+        obj = self.rules.find_by_id(id)
+        for x, y in self.random_cross(size):
+            self.set_cell(x, y, obj)
+
+    def random_cross(self, size: int) -> List[Tuple[int, int]]:
+        # Cells of a cross with arms of size at a random spot, drawn the way add_random places them
         offset = size - 1
-        x = np.random.randint(0 + offset, self.width - offset)
-        y = np.random.randint(0 + offset, self.height - offset)
-        obj = self.biomes.find_by_id(id)
-        for dx in range(-size, size):
-            self.set_cell(x+dx, y, obj)
-        for dy in range(-size, size):
-            self.set_cell(x, y+dy, obj)
+        x = self.rng.randrange(0 + offset, self.width - offset)
+        y = self.rng.randrange(0 + offset, self.height - offset)
+        # Negative indexes would wrap around to the other edge of the array
+        cross = [(x + dx, y) for dx in range(-size, size) if 0 <= x + dx < self.width]
+        return cross + [(x, y + dy) for dy in range(-size, size) if 0 <= y + dy < self.height]
+
+    def add_many(self, seeds: Sequence[Tuple[str, int]]) -> None:
+        # Stamp the same crosses as calling add_random for each (id, size), with one entropy update
+        index = self.rules.index
+        self.set_cells([(x, y, index[id]) for id, size in seeds for x, y in self.random_cross(size)])
+
+    def stamp(self, mask: Any, id: str) -> None:
+        # Pin the cells of a height x width mask to one biome, e.g. an area painted in an editor
+        biome = self.rules.index[id]
+        self.set_cells([(x, y, biome) for x, y in mask_cells(mask, self.width, self.height)])
+
+    def save(self, path: str, codec: str = 'raw') -> int:
+        # Write the map as a map file, EMPTY where uncollapsed, returns its size in bytes. See mapgen.mapfile
+        from .mapfile import save_map
+        return save_map(path, self.index_array(), self.rules, codec)
+
+    def load(self, path: str) -> None:
+        # Pin every collapsed cell of a saved map of this grid's size, matching biomes by id
+        from .mapfile import load_map
+        self.set_cells(load_map(path).cells_for(self.rules, self.width, self.height))
 
     def needs_work(self) -> bool:
-        return np.any(self.grid == None)
\ No newline at end of file
+        return bool(self.open_cells)
+
+    def remaining(self) -> int:
+        return len(self.open_cells)
\ No newline at end of file
@@ -1,12 +1,20 @@
 import logging
 import random
+from array import array
 from collections import Counter
 from dataclasses import dataclass, field
-from typing import List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Iterable, List, Optional, Sequence, Tuple
 
-from .biomes import Biomes
+from .biomes import EMPTY, Biomes, CompiledBiomes
+from .events import EventRecorder, iter_collapse, iter_smooth
 from .exceptions import ImpossibleWorld
+from .smoothing import SmoothWorklist, smooth_indices
+from .storage import IndexRows, mask_cells, neighbor_table
 from .cell import Cell
+from .entropy import EntropyIndex
+
+if TYPE_CHECKING:
+    import numpy as np
 
 # Creating a logger
 logger: logging.Logger = logging.getLogger(__name__)
@@ -16,22 +24,59 @@ class Grid:
     width: int
     height: int
     biomes: Biomes
-    grid: List[List[Optional[Cell]]] = field(init=False)
-    entropy_grid: List[List[int]] = field(init=False)
+    grid: IndexRows = field(init=False)
     smooth_point: Tuple[int, int] = (0, 0)
 
     connector_name: str = None
+    # Seed for this grid's own random number generator, None seeds from the OS
+    seed: Optional[int] = None
+    # Treat the grid as a torus, so cells on opposite edges are neighbors. Smoothing ignores this
+    # and stops at the edges, whichever entry point runs it
+    wrap: bool = False
     USE_RANDOM = True
 
     def __post_init__(self):
-        self.grid = [[None for _ in range(self.width)] for _ in range(self.height)]
+        # Each grid draws from its own generator, so runs are reproducible and grids don't interfere
+        self.rng: random.Random = random.Random(self.seed)
+        self.rules: CompiledBiomes = self.biomes.compile()
+        size = self.width * self.height
+        # One byte per cell, indexed by y * width + x: the biome index into rules.cells, or EMPTY
+        self.cells: array = array('B', [EMPTY]) * size
+        # Cell rows over the same bytes for code that wants grid[y][x]
+        view = memoryview(self.cells)
+        self.grid = IndexRows([view[y * self.width:(y + 1) * self.width] for y in range(self.height)], self.rules)
+        self._map: Optional["np.ndarray"] = None
+        self.neighbors = neighbor_table(self.width, self.height, self.wrap)
+        # smooth() stops at the edges even on a torus, like the vectorized and worklist smoothing
+        self.smooth_neighbors = neighbor_table(self.width, self.height, False) if self.wrap else self.neighbors
         initial_entropy = self.calculate_initial_entropy()
-        self.entropy_grid = [[initial_entropy for _ in range(self.width)] for _ in range(self.height)]
+        # Entropy per flat index, only kept up to date for open cells
+        self.entropy: List[int] = [initial_entropy] * size
+        # Collapsed neighbor counts per flat index, kept up to date by set_cell and used to look up sampling tables
+        self.neighbor_signatures: List[int] = [0] * size
+        # Also counts the uncollapsed cells, so completion checks don't scan the grid
+        self.entropy_index = EntropyIndex(self.width, self.height, initial_entropy)
         self.smoothed = set()  # Track smoothed cells
         self._smooth_change: bool = False  # Trace if we've changed anything through a pass of the grid
+        self._smooth_worklist: Optional[SmoothWorklist] = None
+        # Gets every cell set and entropy change while installed, see iter_collapse
+        self.recorder: Optional[EventRecorder] = None
+
+    @property
+    def map(self) -> "np.ndarray":
+        # (height, width) numpy view of cells, made on first use so numpy is only imported when wanted
+        if self._map is None:
+            import numpy as np
+            self._map = np.frombuffer(self.cells, dtype=np.uint8).reshape(self.height, self.width)
+        return self._map
+
+    @property
+    def entropy_grid(self) -> List[List[int]]:
+        # Rows copied out of the flat entropy list
+        return [self.entropy[y * self.width:(y + 1) * self.width] for y in range(self.height)]
 
     def calculate_initial_entropy(self) -> int:
-        return len(self.biomes.biomes)
+        return len(self.rules)
 
     def collapse_least_entropy_cell(self):
         if self.USE_RANDOM:
@@ -42,93 +87,101 @@ class Grid:
             self.collapse_cell(x, y)
 
     def find_least_entropy_cell_first(self) -> Tuple[Optional[int], Optional[int]]:
-        min_entropy = float('inf')
-        min_entropy_index = (None, None)
-
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.grid[y][x] is None:
-                    if self.entropy_grid[y][x] < min_entropy:
-                        min_entropy = self.entropy_grid[y][x]
-                        min_entropy_index = (y, x)
-        
-        if min_entropy == float('inf'):
-            return None, None
-        
-        return min_entropy_index
+        return self.entropy_index.first()
 
     def find_least_entropy_cell_random(self) -> Tuple[Optional[int], Optional[int]]:
-        min_entropy = float('inf')
-        min_entropy_indices = []
-
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.grid[y][x] is None:
-                    if self.entropy_grid[y][x] < min_entropy:
-                        min_entropy = self.entropy_grid[y][x]
-                        min_entropy_indices = [(y, x)]
-                    elif self.entropy_grid[y][x] == min_entropy:
-                        min_entropy_indices.append((y, x))
-        
-        if min_entropy == float('inf'):
-            return None, None
-        
-        return random.choice(min_entropy_indices)
+        return self.entropy_index.random(self.rng)
     
     def collapse_cell(self, x: int, y: int):
-        if self.grid[y][x] is None:  # Note: numpy uses (row, col), i.e., (y, x)
-            weights = [self.calculate_weight(x, y, obj) for obj in self.biomes.biomes]
-            try:
-                chosen_object = random.choices(self.biomes.biomes, weights=weights)[0]
-            except ValueError:
+        flat = y * self.width + x
+        if self.cells[flat] == EMPTY:
+            # Weighted candidates come from a table shared by every cell with the same neighborhood
+            candidates, cum_weights = self.rules.sampling_table(self.neighbor_signatures[flat], self.rules.full_mask)
+            if not candidates:
                 raise ImpossibleWorld(f"Cannot resolve world, stopping at {x},{y}", self.get_neighbors(x, y))
-            self.set_cell(x, y, chosen_object)
+            chosen_object = self.rng.choices(candidates, cum_weights=cum_weights)[0]
+            self.set_flat(flat, self.rules.index[chosen_object.id])
             
     def set_cell(self, x: int, y: int, cell: Cell):
-        self.grid[y][x] = cell
-        self.update_neighbors_entropy(x, y, cell)
-
-    def update_neighbors_entropy(self, x: int, y: int, chosen_object: Cell):
-        for dx in [-1, 0, 1]:
-            for dy in [-1, 0, 1]:
-                if dx == 0 and dy == 0:
-                    continue
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height and self.grid[ny][nx] is None:
-                    valid_objects = [obj for obj in self.biomes.biomes if self.is_valid_object(nx, ny, obj)]
-                    self.entropy_grid[ny][nx] = len(valid_objects)
+        self.set_flat(y * self.width + x, self.rules.index[cell.id])
+
+    def set_flat(self, flat: int, biome: int) -> None:
+        self.update_signatures(flat, self.cells[flat], biome)
+        self.cells[flat] = biome
+        if self.recorder is not None:
+            self.recorder.cell(flat % self.width, flat // self.width, biome)
+        self.entropy_index.remove_flat(flat)
+        self.update_neighbors_entropy(flat)
+
+    def update_signatures(self, flat: int, old: int, new: int) -> None:
+        # Each cell's signature counts its collapsed neighbors per biome, see CompiledBiomes.signature_units
+        units = self.rules.signature_units
+        delta = units[new]
+        if old != EMPTY:
+            delta -= units[old]
+        if delta == 0:
+            return
+        signatures = self.neighbor_signatures
+        for neighbor in self.neighbors[flat]:
+            signatures[neighbor] += delta
+
+    def set_cells(self, cells: Iterable[Tuple[int, int, int]]) -> None:
+        # Pin every (x, y, biome index) first, then update the open cells around them once each
+        touched = set()
+        for x, y, biome in cells:
+            flat = y * self.width + x
+            self.update_signatures(flat, self.cells[flat], biome)
+            self.cells[flat] = biome
+            if self.recorder is not None:
+                self.recorder.cell(x, y, biome)
+            self.entropy_index.remove_flat(flat)
+            touched.update(self.neighbors[flat])
+        self.update_entropy(touched)
+
+    def update_neighbors_entropy(self, flat: int):
+        self.update_entropy(self.neighbors[flat])
+
+    def update_entropy(self, flats: Iterable[int]):
+        cells = self.cells
+        signatures = self.neighbor_signatures
+        domain = self.rules.domain
+        for neighbor in flats:
+            if cells[neighbor] == EMPTY:
+                entropy = domain(signatures[neighbor])[1]
+                if self.recorder is not None and entropy != self.entropy[neighbor]:
+                    self.recorder.entropy(neighbor % self.width, neighbor // self.width, entropy)
+                self.entropy[neighbor] = entropy
+                self.entropy_index.update_flat(neighbor, entropy)
 
     def is_valid_object(self, x: int, y: int, obj: Cell) -> bool:
-        neighbors = self.get_neighbors(x, y)
-        for neighbor in neighbors:
-            if neighbor:
-                if obj.id not in neighbor.neighbor_weights or neighbor.id not in obj.neighbor_weights:
-                    return False
+        compatible = self.rules.compat_table[self.rules.index[obj.id]]
+        for neighbor in self.neighbors[y * self.width + x]:
+            biome = self.cells[neighbor]
+            if biome != EMPTY and not compatible[biome]:
+                return False
         return True
 
-    def get_neighbors(self, x: int, y: int) -> List[Optional[Cell]]:
-        neighbors = []
-        for dx in [-1, 0, 1]:
-            for dy in [-1, 0, 1]:
-                if dx == 0 and dy == 0:
-                    continue
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height:
-                    neighbors.append(self.grid[ny][nx])
-        return neighbors
+    def get_neighbors(self, x: int, y: int, table=None) -> List[Optional[Cell]]:
+        # table is a neighbor table to read instead of self.neighbors, smooth() passes one that doesn't wrap
+        cells = self.rules.cells
+        table = self.neighbors if table is None else table
+        return [None if self.cells[neighbor] == EMPTY else cells[self.cells[neighbor]]
+                for neighbor in table[y * self.width + x]]
 
     def calculate_weight(self, x: int, y: int, obj: Cell) -> float:
         weight = 1.0
-        neighbors = self.get_neighbors(x, y)
-        for neighbor in neighbors:
-            if neighbor:
-                weight *= neighbor.neighbor_weights.get(obj.id, 0)
+        column = self.rules.index[obj.id]
+        weight_table = self.rules.weight_table
+        for neighbor in self.neighbors[y * self.width + x]:
+            biome = self.cells[neighbor]
+            if biome != EMPTY:
+                weight *= weight_table[biome][column]
         return weight
 
     def smooth(self) -> bool:
         remove_id = None
         if self.connector_name:
-            remove_id = self.biomes.find_by_id(self.connector_name).id
+            remove_id = self.rules.find_by_id(self.connector_name).id
         while True:
             x, y = self.smooth_point
             
@@ -142,7 +195,7 @@ class Grid:
                     return False
             
             # Get the neighbors of the current cell
-            neighbors = self.get_neighbors(x, y)
+            neighbors = self.get_neighbors(x, y, self.smooth_neighbors)
             
             # Collect the IDs of the neighbors
             neighbor_ids = [neighbor.id for neighbor in neighbors if neighbor is not None]
@@ -165,13 +218,38 @@ class Grid:
                 most_common_ids_dict[current_object.id] = 0
 
             if most_common_ids_dict[current_object.id] < 3 and current_object.id != majority_id:
-                self.grid[y][x] = self.biomes.find_by_id(majority_id)
+                self.grid[y][x] = self.rules.find_by_id(majority_id)
                 self._smooth_change = True
                 return True  # Return after smoothing one cell
             
             # Move to the next cell if no change was made
             self.update_smooth_point()
 
+    def iter_collapse(self, chunk_size: Optional[int] = None):
+        # Collapse the rest of the grid, yielding a CollapseEvent per cell set, or lists of chunk_size of them
+        return iter_collapse(self, chunk_size)
+
+    def iter_smooth(self, chunk_size: Optional[int] = None):
+        # Smooth with the worklist, yielding a CollapseEvent per cell changed, or lists of chunk_size of them
+        if self._smooth_worklist is None:
+            self._smooth_worklist = SmoothWorklist(self, self.connector_name)
+        return iter_smooth(self._smooth_worklist, chunk_size)
+
+    def index_array(self) -> "np.ndarray":
+        # The map as a uint8 index array over rules.cells, EMPTY where uncollapsed
+        return self.map.copy()
+
+    def smooth_vectorized(self, exact: bool = False) -> int:
+        # Smooth the whole grid to a fixpoint in one call, returns the number of cell changes
+        connector = self.rules.index[self.connector_name] if self.connector_name else None
+        return smooth_indices(self.map, len(self.rules), connector, exact=exact)
+
+    def smooth_incremental(self, budget: Optional[int] = None) -> bool:
+        # Worklist smoothing, looks at no more than budget cells per call and returns True while work remains
+        if self._smooth_worklist is None:
+            self._smooth_worklist = SmoothWorklist(self, self.connector_name)
+        return self._smooth_worklist.run(budget)
+
     # Advance smooth point to next entry in grid
     def update_smooth_point(self):
         x, y = self.smooth_point
@@ -181,17 +259,41 @@ class Grid:
             self.smooth_point = (0, y + 1)
 
     def add_random(self, id: str, size: int = 1) -> None:
+        obj = self.rules.find_by_id(id)
+        for x, y in self.random_cross(size):
+            self.set_cell(x, y, obj)
+
+    def random_cross(self, size: int) -> List[Tuple[int, int]]:
+        # Cells of a cross with arms of size at a random spot, drawn the way add_random places them
         offset = size - 1
-        x = random.randint(0 + offset, self.width - offset - 1)
-        y = random.randint(0 + offset, self.height - offset - 1)
-        obj = self.biomes.find_by_id(id)
-        for dx in range(-size, size + 1):
-            if 0 <= x + dx < self.width:
-                self.set_cell(x + dx, y, obj)
-        for dy in range(-size, size + 1):
-            if 0 <= y + dy < self.height:
-                self.set_cell(x, y + dy, obj)
+        x = self.rng.randint(0 + offset, self.width - offset - 1)
+        y = self.rng.randint(0 + offset, self.height - offset - 1)
+        cross = [(x + dx, y) for dx in range(-size, size + 1) if 0 <= x + dx < self.width]
+        return cross + [(x, y + dy) for dy in range(-size, size + 1) if 0 <= y + dy < self.height]
+
+    def add_many(self, seeds: Sequence[Tuple[str, int]]) -> None:
+        # Stamp the same crosses as calling add_random for each (id, size), with one entropy update
+        index = self.rules.index
+        self.set_cells([(x, y, index[id]) for id, size in seeds for x, y in self.random_cross(size)])
+
+    def stamp(self, mask: Any, id: str) -> None:
+        # Pin the cells of a height x width mask to one biome, e.g. an area painted in an editor
+        biome = self.rules.index[id]
+        self.set_cells([(x, y, biome) for x, y in mask_cells(mask, self.width, self.height)])
+
+    def save(self, path: str, codec: str = 'raw') -> int:
+        # Write the map as a map file, EMPTY where uncollapsed, returns its size in bytes. See mapgen.mapfile
+        from .mapfile import save_map
+        return save_map(path, self.index_array(), self.rules, codec)
+
+    def load(self, path: str) -> None:
+        # Pin every collapsed cell of a saved map of this grid's size, matching biomes by id
+        from .mapfile import load_map
+        self.set_cells(load_map(path).cells_for(self.rules, self.width, self.height))
 
     def needs_work(self) -> bool:
-        return any(any(cell is None for cell in row) for row in self.grid)
+        return bool(len(self.entropy_index))
+
+    def remaining(self) -> int:
+        return len(self.entropy_index)
     
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .biomes import Biomes, CompiledBiomes
+from .cache import LRUCache
+from .generate import generate_map
+from .presets import CONNECTOR_ID
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Bump when a change to the engines means old cache entries no longer match what they would generate
+CACHE_VERSION = 3
+
+
+class MapCache:
+    """
+    Content-addressed store of generated maps. A map is keyed by a hash of everything that
+    decides what gets generated: the compiled biome rules, the size, the add_random seeds,
+    the engine, the grid seed and the generation options. Entries are uint8 index arrays
+    in <directory>/<key[:2]>/<key>.npy, with the most recent ones also kept in memory.
+    """
+
+    def __init__(self, directory: str, memory_size: Optional[int] = 128):
+        self.directory = directory
+        self.memory: LRUCache = LRUCache(memory_size)
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(rules: CompiledBiomes, width: int, height: int, seeds: Sequence[Tuple[str, int]], engine: str,
+            seed: int, **options: Any) -> str:
+        description = {
+            'version': CACHE_VERSION,
+            'rules': rules.digest,
+            'width': width,
+            'height': height,
+            'seeds': [list(s) for s in seeds],
+            'engine': engine,
+            'seed': seed,
+            'options': options,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        indices = self.memory.get(key)
+        if indices is not None:
+            return indices
+        try:
+            indices = np.load(self.path(key))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        indices.setflags(write=False)
+        self.memory.put(key, indices)
+        return indices
+
+    def put(self, key: str, indices: np.ndarray) -> np.ndarray:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename, so readers in other processes never see half a map
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, indices)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        indices = indices.copy()
+        indices.setflags(write=False)
+        self.memory.put(key, indices)
+        return indices
+
+    def get_or_generate(self, engine: str, biomes: Biomes, width: int, height: int,
+                        seeds: Sequence[Tuple[str, int]], seed: int, connector: Optional[str] = CONNECTOR_ID,
+                        smooth: bool = True, retries: int = 3, use_random: Optional[bool] = None) -> np.ndarray:
+        # The returned array is read-only, since the same object is handed out to every caller
+        key = self.key(biomes.compile(), width, height, seeds, engine, seed,
+                       connector=connector, smooth=smooth, retries=retries, use_random=use_random)
+        indices = self.get(key)
+        if indices is None:
+            logger.debug("Map cache miss for %s", key)
+            indices, _ = generate_map(engine, biomes, width, height, seeds, seed, connector, smooth, retries,
+                                      use_random)
+            indices = self.put(key, indices)
+        return indices
+
+    def stats(self) -> Dict[str, Any]:
+        return {'memory': self.memory.stats(), 'disk_hits': self.disk_hits, 'misses': self.misses}
@@ -0,0 +1,308 @@
+"""
+Compact binary map files and image export without pygame.
+
+A map file is a header, the biome palette, then the map as a height x width uint8 index
+array over that palette, EMPTY where a cell was never collapsed. The array is stored raw,
+run-length encoded or zlib compressed. Raw files load through numpy.memmap, so opening
+even a very large map reads only the header until cells are touched.
+
+    grid.save('map.wfcm', codec='rle')
+    saved = load_map('map.wfcm')
+    write_png('map.png', saved.indices, saved.colors, scale=4)
+
+    python -m mapgen.mapfile info map.wfcm
+    python -m mapgen.mapfile image map.wfcm map.png --scale 4
+    python -m mapgen.mapfile convert maps/map_0.npy map_0.wfcm --biomes random --codec zlib
+"""
+import argparse
+import logging
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .biomes import EMPTY, CompiledBiomes
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+MAP_MAGIC = b'WFCM'
+MAP_VERSION = 1
+CODECS = ('raw', 'rle', 'zlib')
+# magic, version, codec, width, height, biome count, CompiledBiomes.digest, length of the ids block, payload length
+_HEADER = struct.Struct('<4sHHIIH32sIQ')
+# The payload starts on this boundary, so a raw map can be mapped and viewed as is
+ALIGN = 64
+# Longest run one RLE entry holds, longer runs are split. Runs in generated maps are mostly a
+# few cells long, so a one byte length keeps an entry to two bytes
+RUN_MAX = 0xFF
+# Rows handed to zlib or written out at a time, which bounds the memory export needs
+BAND_ROWS = 256
+# Color of EMPTY and of palette slots no biome uses, the same as the window background
+BLACK = (0, 0, 0)
+
+
+@dataclass(frozen=True)
+class MapFile:
+    """
+    A loaded map file. indices is a read-only (height, width) uint8 array over ids and
+    colors; for raw files it's a numpy.memmap of the file itself.
+    """
+    indices: np.ndarray
+    ids: Tuple[str, ...]
+    colors: Tuple[Tuple[int, int, int], ...]
+    digest: str
+    codec: str
+
+    @property
+    def width(self) -> int:
+        return self.indices.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.indices.shape[0]
+
+    def indices_for(self, rules: CompiledBiomes) -> np.ndarray:
+        # The map as indices over rules.cells, translated by biome id when the palettes differ
+        if self.digest == rules.digest or self.ids == rules.ids:
+            return self.indices
+        missing = [biome_id for biome_id in self.ids if biome_id not in rules.index]
+        if missing:
+            raise ValueError(f"Saved map uses biomes {', '.join(map(repr, missing))} that aren't in the rules")
+        lookup = np.full(256, EMPTY, dtype=np.uint8)
+        lookup[:len(self.ids)] = [rules.index[biome_id] for biome_id in self.ids]
+        return lookup[self.indices]
+
+    def cells_for(self, rules: CompiledBiomes, width: int, height: int) -> List[Tuple[int, int, int]]:
+        # (x, y, biome index) of every collapsed cell, for pinning the map into a width x height grid
+        if (self.width, self.height) != (width, height):
+            raise ValueError(f"Saved map is {self.width}x{self.height}, the grid is {width}x{height}")
+        indices = self.indices_for(rules)
+        ys, xs = np.nonzero(indices != EMPTY)
+        return list(zip(xs.tolist(), ys.tolist(), indices[ys, xs].tolist()))
+
+
+def palette_array(colors: Sequence[Sequence[int]]) -> np.ndarray:
+    # (256, 3) uint8 lookup table from biome index to RGB, BLACK for EMPTY and unused slots
+    palette = np.empty((256, 3), dtype=np.uint8)
+    palette[:] = BLACK
+    if len(colors):
+        palette[:len(colors)] = colors
+    return palette
+
+
+def rle_encode(indices: np.ndarray) -> bytes:
+    # Run lengths then run values, both uint8, over the flattened map
+    flat = np.ascontiguousarray(indices).reshape(-1)
+    if not flat.size:
+        return b''
+    starts = np.flatnonzero(np.diff(flat)) + 1
+    starts = np.concatenate(([0], starts))
+    lengths = np.diff(np.append(starts, flat.size))
+    values = flat[starts]
+    if lengths.max() > RUN_MAX:
+        pieces = -(-lengths // RUN_MAX)
+        values = np.repeat(values, pieces)
+        split = np.full(int(pieces.sum()), RUN_MAX, dtype=np.int64)
+        split[np.cumsum(pieces) - 1] = lengths - (pieces - 1) * RUN_MAX
+        lengths = split
+    return lengths.astype(np.uint8).tobytes() + values.astype(np.uint8).tobytes()
+
+
+def rle_decode(payload: Any) -> np.ndarray:
+    # The flattened map back from rle_encode's output
+    runs = len(payload) // 2
+    lengths = np.frombuffer(payload, dtype=np.uint8, count=runs)
+    values = np.frombuffer(payload, dtype=np.uint8, count=runs, offset=runs)
+    return np.repeat(values, lengths)
+
+
+def _zlib_chunks(indices: np.ndarray, level: int):
+    compressor = zlib.compressobj(level)
+    for y in range(0, indices.shape[0], BAND_ROWS):
+        yield compressor.compress(np.ascontiguousarray(indices[y:y + BAND_ROWS]).tobytes())
+    yield compressor.flush()
+
+
+def save_map(path: str, indices: np.ndarray, rules: CompiledBiomes, codec: str = 'raw', level: int = 6) -> int:
+    """
+    Write a (height, width) uint8 index array over rules.cells as a map file, returning
+    its size in bytes. level is the zlib compression level.
+    """
+    return write_map(path, indices, rules.ids, [cell.color for cell in rules.cells], rules.digest, codec, level)
+
+
+def write_map(path: str, indices: np.ndarray, ids: Sequence[str], colors: Sequence[Sequence[int]], digest: str,
+              codec: str = 'raw', level: int = 6) -> int:
+    # save_map with the palette given directly, for maps whose rules aren't at hand
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec!r}, expected one of {', '.join(CODECS)}")
+    if indices.ndim != 2 or indices.dtype != np.uint8:
+        raise ValueError(f"Expected a 2D uint8 index array, got {indices.dtype} of shape {indices.shape}")
+    height, width = indices.shape
+    ids_block = '\0'.join(ids).encode('utf-8')
+    palette = b''.join(bytes(color) for color in colors)
+    if codec == 'raw':
+        chunks: Any = (np.ascontiguousarray(indices[y:y + BAND_ROWS]).tobytes() for y in range(0, height, BAND_ROWS))
+        payload_length = width * height
+    elif codec == 'rle':
+        chunks = [rle_encode(indices)]
+        payload_length = len(chunks[0])
+    else:
+        chunks = list(_zlib_chunks(indices, level))
+        payload_length = sum(map(len, chunks))
+    header = _HEADER.pack(MAP_MAGIC, MAP_VERSION, CODECS.index(codec), width, height, len(ids),
+                          bytes.fromhex(digest), len(ids_block), payload_length)
+    head = header + ids_block + palette
+    head += bytes(-len(head) % ALIGN)
+    with open(path, 'wb') as f:
+        f.write(head)
+        for chunk in chunks:
+            f.write(chunk)
+    return len(head) + payload_length
+
+
+def read_header(f: Any) -> Tuple[str, int, int, Tuple[str, ...], Tuple[Tuple[int, int, int], ...], str, int, int]:
+    # (codec, width, height, ids, colors, digest, payload offset, payload length) of an open map file
+    raw = f.read(_HEADER.size)
+    if len(raw) < _HEADER.size:
+        raise ValueError("Not a map file: too short")
+    magic, version, codec, width, height, count, digest, ids_length, payload_length = _HEADER.unpack(raw)
+    if magic != MAP_MAGIC:
+        raise ValueError("Not a map file: bad magic")
+    if version != MAP_VERSION or codec >= len(CODECS):
+        raise ValueError(f"Unsupported map file version {version} codec {codec}")
+    ids_block = f.read(ids_length)
+    ids = tuple(ids_block.decode('utf-8').split('\0')) if count else ()
+    palette = f.read(3 * count)
+    colors = tuple(tuple(palette[3 * i:3 * i + 3]) for i in range(count))
+    offset = _HEADER.size + ids_length + 3 * count
+    offset += -offset % ALIGN
+    return CODECS[codec], width, height, ids, colors, digest.hex(), offset, payload_length
+
+
+def load_map(path: str, mmap: bool = True) -> MapFile:
+    """
+    Open a map file. A raw map comes back as a read-only numpy.memmap of the file, without
+    reading or copying the cells, unless mmap is False; RLE and zlib maps are decoded.
+    """
+    with open(path, 'rb') as f:
+        codec, width, height, ids, colors, digest, offset, payload_length = read_header(f)
+        if codec == 'raw' and mmap:
+            indices = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(height, width))
+        else:
+            f.seek(offset)
+            payload = f.read(payload_length)
+            if len(payload) != payload_length:
+                raise ValueError(f"Map file is truncated, expected {payload_length} payload bytes")
+            if codec == 'raw':
+                flat = np.frombuffer(payload, dtype=np.uint8)
+            elif codec == 'rle':
+                flat = rle_decode(payload)
+            else:
+                flat = np.frombuffer(zlib.decompress(payload, bufsize=width * height or 1), dtype=np.uint8)
+            if flat.size != width * height:
+                raise ValueError(f"Map payload holds {flat.size} cells, expected {width * height}")
+            indices = flat.reshape(height, width)
+            indices.setflags(write=False)
+    return MapFile(indices, ids, colors, digest, codec)
+
+
+def _scaled_band(indices: np.ndarray, y: int, scale: int) -> np.ndarray:
+    band = indices[y:y + BAND_ROWS]
+    if scale > 1:
+        band = np.repeat(np.repeat(band, scale, axis=0), scale, axis=1)
+    return band
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def write_png(path: str, indices: np.ndarray, colors: Sequence[Sequence[int]], scale: int = 1, level: int = 1) -> None:
+    """
+    Write a uint8 index array as an 8 bit palette PNG, each cell scale x scale pixels. The
+    biome colors become the PNG palette, so the pixels are the indices as they are and no
+    RGB image is ever built. level is the zlib level; maps compress well even at 1.
+    """
+    height, width = indices.shape
+    header = struct.pack('>IIBBBBB', width * scale, height * scale, 8, 3, 0, 0, 0)
+    compressor = zlib.compressobj(level)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk(b'IHDR', header))
+        f.write(_png_chunk(b'PLTE', palette_array(colors).tobytes()))
+        for y in range(0, height, BAND_ROWS):
+            band = _scaled_band(indices, y, scale)
+            # Every scanline starts with its filter type, 0 for none
+            rows = np.zeros((band.shape[0], band.shape[1] + 1), dtype=np.uint8)
+            rows[:, 1:] = band
+            data = compressor.compress(rows.tobytes())
+            if data:
+                f.write(_png_chunk(b'IDAT', data))
+        f.write(_png_chunk(b'IDAT', compressor.flush()))
+        f.write(_png_chunk(b'IEND', b''))
+
+
+def write_ppm(path: str, indices: np.ndarray, colors: Sequence[Sequence[int]], scale: int = 1) -> None:
+    # Write a uint8 index array as a binary PPM, looking up the RGB of a band of rows at a time
+    height, width = indices.shape
+    palette = palette_array(colors)
+    with open(path, 'wb') as f:
+        f.write(b'P6\n%d %d\n255\n' % (width * scale, height * scale))
+        for y in range(0, height, BAND_ROWS):
+            f.write(palette[_scaled_band(indices, y, scale)].tobytes())
+
+
+def write_image(path: str, indices: np.ndarray, colors: Sequence[Sequence[int]], scale: int = 1) -> None:
+    # PPM for .ppm paths, PNG otherwise
+    if path.lower().endswith('.ppm'):
+        write_ppm(path, indices, colors, scale)
+    else:
+        write_png(path, indices, colors, scale)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    from .presets import BIOME_SETS
+
+    parser = argparse.ArgumentParser(prog='python -m mapgen.mapfile', description='Inspect, convert and render map files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help='print the size, codec and biomes of map files')
+    info.add_argument('paths', nargs='+')
+    image = commands.add_parser('image', help='render a map file as a PNG or PPM')
+    image.add_argument('path')
+    image.add_argument('out')
+    image.add_argument('--scale', type=int, default=1, help='pixels per cell along each side')
+    convert = commands.add_parser('convert', help='rewrite a map file or a .npy index array with another codec')
+    convert.add_argument('path')
+    convert.add_argument('out')
+    convert.add_argument('--codec', choices=CODECS, default='rle')
+    convert.add_argument('--biomes', choices=sorted(BIOME_SETS), default=None,
+                         help='biome set of a .npy index array, which has no palette of its own')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if args.command == 'info':
+        for path in args.paths:
+            saved = load_map(path)
+            logger.info("%s: %sx%s %s, biomes %s", path, saved.width, saved.height, saved.codec, ' '.join(saved.ids))
+        return 0
+    if args.command == 'image':
+        saved = load_map(args.path)
+        write_image(args.out, saved.indices, saved.colors, args.scale)
+        return 0
+    if args.path.endswith('.npy'):
+        if args.biomes is None:
+            parser.error('converting a .npy index array needs --biomes')
+        size = save_map(args.out, np.load(args.path, mmap_mode='r'), BIOME_SETS[args.biomes].compile(), args.codec)
+    else:
+        saved = load_map(args.path)
+        size = write_map(args.out, saved.indices, saved.ids, saved.colors, saved.digest, args.codec)
+    logger.info("%s: %s bytes", args.out, size)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,195 @@
+import logging
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from .biomes import EMPTY, Biomes, CompiledBiomes
+from .exceptions import ImpossibleWorld
+from .presets import CONNECTOR_ID
+from .smoothing import NEIGHBOR_OFFSETS, smooth_indices
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+_DX = np.array([dx for dx, _ in NEIGHBOR_OFFSETS])
+_DY = np.array([dy for _, dy in NEIGHBOR_OFFSETS])
+# The 3x3 window around a cell, itself included
+_WINDOW_DX = np.repeat(np.arange(-1, 2), 3)
+_WINDOW_DY = np.tile(np.arange(-1, 2), 3)
+
+
+class MultiGrid:
+    """
+    Solves count independent maps of the same size at once, with the same rules as ngrid.
+    Every step collapses one cell in each unfinished map: the least entropy cells are found
+    with one argmin over all maps, and sampling and the neighborhood updates are fancy
+    indexed array operations over the batch, so the Python overhead is per step rather than
+    per map.
+
+    Arrays are (count, height + 2, width + 2) with a border that is never open, so windows
+    around edge cells don't need clipping. Domains are bitmasks over rules.cells, and the
+    neighbor weights are only multiplied out for the cells being collapsed. Entropy ties are
+    broken by a per-map priority, a random permutation of the cells with use_random and
+    row-major order otherwise. A map that hits a contradiction is started again from scratch,
+    up to retries times, and then marked failed.
+    """
+
+    LARGE_INT = np.iinfo(np.int64).max  # Key of cells that are collapsed or part of the border
+
+    def __init__(self, biomes: Biomes, count: int, width: int, height: int,
+                 seeds: Sequence[Tuple[str, int]] = (), seed: Optional[int] = None, use_random: bool = True,
+                 retries: int = 3):
+        self.rules: CompiledBiomes = biomes.compile()
+        biome_count = len(self.rules)
+        if biome_count > 64:
+            raise ValueError(f"MultiGrid packs domains into 64 bit masks, got {biome_count} biomes")
+        self.count = count
+        self.width = width
+        self.height = height
+        self.seeds = [(self.rules.index[biome_id], size) for biome_id, size in seeds]
+        self.use_random = use_random
+        self.retries = retries
+        self.rng: np.random.Generator = np.random.default_rng(seed)
+
+        mask_dtype = np.uint16 if biome_count <= 16 else np.uint32 if biome_count <= 32 else np.uint64
+        # Row EMPTY of the lookup tables is the identity, for neighbors that are open or in the border
+        self._compat = np.full(EMPTY + 1, (1 << biome_count) - 1, dtype=mask_dtype)
+        self._compat[:biome_count] = self.rules.compat_masks
+        self._weights = np.ones((EMPTY + 1, biome_count), dtype=np.float64)
+        self._weights[:biome_count] = self.rules.weights
+        self._bits = np.arange(biome_count, dtype=mask_dtype)
+
+        shape = (count, height + 2, width + 2)
+        self.map = np.full(shape, EMPTY, dtype=np.uint8)
+        self.open = np.zeros(shape, dtype=bool)
+        self.domains = np.zeros(shape, dtype=mask_dtype)
+        # key = entropy * cells + priority, so one argmin finds the least entropy cell and breaks ties
+        self.priority = np.zeros(shape, dtype=np.int64)
+        self.key = np.full(shape, self.LARGE_INT, dtype=np.int64)
+        self.row_min = np.full((count, height + 2), self.LARGE_INT, dtype=np.int64)
+        self.attempts = np.zeros(count, dtype=np.int64)
+        self.done = np.zeros(count, dtype=bool)
+        self.failed = np.zeros(count, dtype=bool)
+        self.steps = 0
+        self.reset(np.arange(count))
+
+    def reset(self, maps: np.ndarray) -> None:
+        # Clear the given maps, stamp the seed crosses and rebuild their domains
+        cells = self.width * self.height
+        inner = np.s_[1:-1, 1:-1]
+        self.map[maps] = EMPTY
+        if self.use_random:
+            order = self.rng.permuted(np.tile(np.arange(cells), (len(maps), 1)), axis=1)
+        else:
+            order = np.tile(np.arange(cells), (len(maps), 1))
+        self.priority[(maps,) + inner] = order.reshape(len(maps), self.height, self.width)
+        for biome, size in self.seeds:
+            # Same cross as Grid.add_random, centered far enough in that the arms fit
+            offset = size - 1
+            xs = self.rng.integers(offset, self.width - offset, size=len(maps))
+            ys = self.rng.integers(offset, self.height - offset, size=len(maps))
+            for d in range(-size, size + 1):
+                valid = (xs + d >= 0) & (xs + d < self.width)
+                self.map[maps[valid], ys[valid] + 1, xs[valid] + d + 1] = biome
+                valid = (ys + d >= 0) & (ys + d < self.height)
+                self.map[maps[valid], ys[valid] + d + 1, xs[valid] + 1] = biome
+
+        grids = self.map[maps]
+        domains = np.full((len(maps), self.height, self.width), self._compat[EMPTY])
+        for dx, dy in NEIGHBOR_OFFSETS:
+            domains &= self._compat[grids[:, 1 + dy:self.height + 1 + dy, 1 + dx:self.width + 1 + dx]]
+        self.domains[(maps,) + inner] = domains
+        self.open[maps] = False
+        self.open[(maps,) + inner] = grids[:, 1:-1, 1:-1] == EMPTY
+        self.key[maps] = np.where(self.open[maps],
+                                  np.bitwise_count(self.domains[maps]).astype(np.int64) * cells + self.priority[maps],
+                                  self.LARGE_INT)
+        self.row_min[maps] = self.key[maps].min(axis=2)
+        self.attempts[maps] += 1
+
+    def active(self) -> np.ndarray:
+        return np.flatnonzero(~(self.done | self.failed))
+
+    def needs_work(self) -> bool:
+        return bool(self.active().size)
+
+    def step(self) -> bool:
+        # Collapse one cell in every unfinished map, returns False once all maps are done or failed
+        maps = self.active()
+        if not maps.size:
+            return False
+        self.steps += 1
+        ys = self.row_min[maps].argmin(axis=1)
+        finished = self.row_min[maps, ys] == self.LARGE_INT
+        self.done[maps[finished]] = True
+        maps, ys = maps[~finished], ys[~finished]
+        if not maps.size:
+            return False
+        xs = self.key[maps, ys].argmin(axis=1)
+
+        # Weighted draw like random.choices(cum_weights=...), zero weight candidates can't come up
+        neighbors = self.map[maps[:, None], ys[:, None] + _DY, xs[:, None] + _DX]
+        allowed = (self.domains[maps, ys, xs][:, None] >> self._bits) & 1
+        cum_weights = np.cumsum(self._weights[neighbors].prod(axis=1) * allowed, axis=1)
+        total = cum_weights[:, -1]
+        chosen = np.count_nonzero(cum_weights <= (self.rng.random(len(maps)) * total)[:, None], axis=1)
+
+        stuck = ~(total > 0)
+        if stuck.any():
+            self.restart(maps[stuck])
+            maps, ys, xs, chosen = maps[~stuck], ys[~stuck], xs[~stuck], chosen[~stuck]
+        self.collapse(maps, ys, xs, chosen)
+        return True
+
+    def restart(self, maps: np.ndarray) -> None:
+        logger.debug("Contradiction in maps %s after %s steps", maps.tolist(), self.steps)
+        retry = self.attempts[maps] <= self.retries
+        self.failed[maps[~retry]] = True
+        if retry.any():
+            self.reset(maps[retry])
+
+    def collapse(self, maps: np.ndarray, ys: np.ndarray, xs: np.ndarray, biomes: np.ndarray) -> None:
+        # Set one cell per map, given in padded coordinates, and update the 3x3 window around it
+        self.map[maps, ys, xs] = biomes
+        self.open[maps, ys, xs] = False
+        n, wy, wx = maps[:, None], ys[:, None] + _WINDOW_DY, xs[:, None] + _WINDOW_DX
+        self.domains[n, wy, wx] &= self._compat[biomes][:, None]
+        cells = self.width * self.height
+        self.key[n, wy, wx] = np.where(self.open[n, wy, wx],
+                                       np.bitwise_count(self.domains[n, wy, wx]).astype(np.int64) * cells
+                                       + self.priority[n, wy, wx],
+                                       self.LARGE_INT)
+        rows = ys[:, None] + np.arange(-1, 2)
+        self.row_min[n, rows] = self.key[n, rows].min(axis=2)
+
+    def run(self) -> None:
+        while self.step():
+            pass
+
+    def result(self) -> np.ndarray:
+        # (count, height, width) uint8 index arrays over rules.cells, failed maps are left as they stopped
+        return self.map[:, 1:-1, 1:-1].copy()
+
+
+def generate_maps(biomes: Biomes, count: int, width: int, height: int, seeds: Sequence[Tuple[str, int]],
+                  seed: Optional[int] = None, connector: Optional[str] = CONNECTOR_ID, smooth: bool = True,
+                  retries: int = 3, use_random: bool = True, allow_failed: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Generate count maps in one MultiGrid and return them stacked as a (count, height, width)
+    uint8 index array over biomes.compile().cells, with the attempts each map took. Raises
+    ImpossibleWorld if any map fails after retries restarts, unless allow_failed is set, in
+    which case failed maps get 0 attempts and are left unfinished.
+    """
+    grid = MultiGrid(biomes, count, width, height, seeds, seed, use_random, retries)
+    grid.run()
+    maps = grid.result()
+    if grid.failed.any() and not allow_failed:
+        raise ImpossibleWorld(f"Cannot resolve {int(grid.failed.sum())} of {count} maps "
+                              f"after {retries + 1} attempts")
+    if smooth:
+        rules = grid.rules
+        connector_index = rules.index[connector] if connector and connector in rules.index else None
+        for n in np.flatnonzero(grid.done):
+            smooth_indices(maps[n], len(rules), connector_index)
+    attempts = np.where(grid.failed, 0, grid.attempts)
+    return maps, attempts
@@ -0,0 +1,249 @@
+import logging
+import random
+from dataclasses import dataclass, field
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .biomes import EMPTY, Biomes, CompiledBiomes
+from .events import EventRecorder, iter_collapse, iter_smooth
+from .exceptions import ImpossibleWorld
+from .smoothing import NEIGHBOR_OFFSETS, SmoothWorklist, smooth_indices
+from .storage import IndexRows, mask_cells
+from .cell import Cell
+from .entropy import EntropyIndex
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Grid:
+    """
+    Grid engine that keeps everything in numpy arrays: the map as a uint8 index array over
+    rules.cells (EMPTY where uncollapsed), the domains as an (H, W, B) boolean array and the
+    product of neighbor weights per candidate as an (H, W, B) float array. Collapsing a cell
+    updates its 3x3 neighborhood with slice operations and cell selection is an argmin over
+    the entropy array. Open cells are also kept in an EntropyIndex, so picking the next
+    cell doesn't scan the map either, and there is no per-cell Python work outside the
+    chosen cell's neighborhood.
+
+    Like lgrid it only applies constraints from collapsed nearest neighbors.
+    """
+    width: int
+    height: int
+    biomes: Biomes
+    map: np.ndarray = field(init=False)
+    domains: np.ndarray = field(init=False)
+    weights: np.ndarray = field(init=False)
+    entropy_grid: np.ndarray = field(init=False)
+
+    connector_name: str = None
+    # Seed for this grid's own random number generator, None seeds from the OS
+    seed: Optional[int] = None
+    USE_RANDOM = True
+    LARGE_INT = 10**9  # Entropy of collapsed cells, so argmin never picks them
+
+    def __post_init__(self):
+        # Each grid draws from its own generator, so runs are reproducible and grids don't interfere
+        self.rng: random.Random = random.Random(self.seed)
+        self.rules: CompiledBiomes = self.biomes.compile()
+        biome_count = len(self.rules)
+        self.map = np.full((self.height, self.width), EMPTY, dtype=np.uint8)
+        self.domains = np.ones((self.height, self.width, biome_count), dtype=bool)
+        self.weights = np.ones((self.height, self.width, biome_count), dtype=np.float64)
+        self.entropy_grid = np.full((self.height, self.width), self.calculate_initial_entropy(), dtype=np.int32)
+        # Open cells by entropy, kept up to date by update_entropy. Also counts them, so needs_work doesn't scan
+        self.entropy_index = EntropyIndex(self.width, self.height, self.calculate_initial_entropy())
+        # Row EMPTY of the lookup tables is the identity, for neighbors that are open or off the grid
+        self._compatible = np.ones((EMPTY + 1, biome_count), dtype=bool)
+        self._compatible[:biome_count] = self.rules.compatible
+        self._weights = np.ones((EMPTY + 1, biome_count), dtype=np.float64)
+        self._weights[:biome_count] = self.rules.weights
+        self.grid: IndexRows = IndexRows(self.map, self.rules)
+        self._smooth_worklist: Optional[SmoothWorklist] = None
+        # Gets every cell set and entropy change while installed, see iter_collapse
+        self.recorder: Optional[EventRecorder] = None
+
+    def calculate_initial_entropy(self) -> int:
+        return len(self.rules)
+
+    def collapse_least_entropy_cell(self):
+        if self.USE_RANDOM:
+            y, x = self.find_least_entropy_cell_random()
+        else:
+            y, x = self.find_least_entropy_cell_first()
+        if x is not None and y is not None:
+            self.collapse_cell(x, y)
+
+    def find_least_entropy_cell_first(self) -> Tuple[Optional[int], Optional[int]]:
+        return self.entropy_index.first()
+
+    def find_least_entropy_cell_random(self) -> Tuple[Optional[int], Optional[int]]:
+        return self.entropy_index.random(self.rng)
+
+    def collapse_cell(self, x: int, y: int):
+        if self.map[y, x] == EMPTY:
+            # Same draw as random.choices(cum_weights=...), zero weight candidates can't come up
+            cum_weights = np.cumsum(self.weights[y, x] * self.domains[y, x])
+            total = cum_weights[-1]
+            if not total > 0:
+                raise ImpossibleWorld(f"Cannot resolve world, stopping at {x},{y}", self.get_neighbors(x, y))
+            chosen = int(np.searchsorted(cum_weights, self.rng.random() * total, side='right'))
+            self.set_index(x, y, chosen)
+
+    def set_cell(self, x: int, y: int, cell: Cell):
+        self.set_index(x, y, self.rules.index[cell.id])
+
+    def set_index(self, x: int, y: int, biome: int) -> None:
+        old = self.map[y, x]
+        self.map[y, x] = biome
+        if self.recorder is not None:
+            self.recorder.cell(x, y, biome)
+        y0, y1 = max(y - 1, 0), min(y + 2, self.height)
+        x0, x1 = max(x - 1, 0), min(x + 2, self.width)
+        if old == EMPTY:
+            # The cell itself is in the window too, but it's collapsed so its domain no longer matters
+            self.domains[y0:y1, x0:x1] &= self.rules.compatible[biome]
+            self.weights[y0:y1, x0:x1] *= self.rules.weights[biome]
+        else:
+            # Constraints can't be divided back out, so rebuild the neighborhood from the map
+            self.rebuild(x0, y0, x1, y1)
+        self.update_entropy(x0, y0, x1, y1)
+
+    def set_cells(self, cells: Iterable[Tuple[int, int, int]]) -> None:
+        # Pin every (x, y, biome index) first, then rebuild the box around them in one go
+        x0, y0, x1, y1 = self.width, self.height, 0, 0
+        for x, y, biome in cells:
+            self.map[y, x] = biome
+            if self.recorder is not None:
+                self.recorder.cell(x, y, biome)
+            x0, y0, x1, y1 = min(x0, x), min(y0, y), max(x1, x + 1), max(y1, y + 1)
+        if x0 >= x1:
+            return
+        x0, y0, x1, y1 = max(x0 - 1, 0), max(y0 - 1, 0), min(x1 + 1, self.width), min(y1 + 1, self.height)
+        self.rebuild(x0, y0, x1, y1)
+        self.update_entropy(x0, y0, x1, y1)
+
+    def rebuild(self, x0: int = 0, y0: int = 0, x1: Optional[int] = None, y1: Optional[int] = None) -> None:
+        # Recompute domains and weights inside [x0, x1) x [y0, y1) from the collapsed cells around them
+        x1 = self.width if x1 is None else x1
+        y1 = self.height if y1 is None else y1
+        # The window with a one cell border, EMPTY where the border is off the grid
+        padded = np.full((y1 - y0 + 2, x1 - x0 + 2), EMPTY, dtype=np.uint8)
+        py0, py1 = max(y0 - 1, 0), min(y1 + 1, self.height)
+        px0, px1 = max(x0 - 1, 0), min(x1 + 1, self.width)
+        padded[py0 - y0 + 1:py1 - y0 + 1, px0 - x0 + 1:px1 - x0 + 1] = self.map[py0:py1, px0:px1]
+        domains = np.ones((y1 - y0, x1 - x0, len(self.rules)), dtype=bool)
+        products = np.ones((y1 - y0, x1 - x0, len(self.rules)), dtype=np.float64)
+        for dx, dy in NEIGHBOR_OFFSETS:
+            neighbors = padded[1 + dy:y1 - y0 + 1 + dy, 1 + dx:x1 - x0 + 1 + dx]
+            domains &= self._compatible[neighbors]
+            products *= self._weights[neighbors]
+        self.domains[y0:y1, x0:x1] = domains
+        self.weights[y0:y1, x0:x1] = products
+
+    def update_entropy(self, x0: int = 0, y0: int = 0, x1: Optional[int] = None, y1: Optional[int] = None) -> None:
+        window = np.s_[y0:y1, x0:x1]
+        is_open = self.map[window] == EMPTY
+        entropy = np.where(is_open, self.domains[window].sum(axis=-1), self.LARGE_INT)
+        ys, xs = np.nonzero(entropy != self.entropy_grid[window])
+        self.entropy_grid[window] = entropy
+        index = self.entropy_index
+        width = self.width
+        for y, x, cell_open, cell_entropy in zip(ys.tolist(), xs.tolist(), is_open[ys, xs].tolist(),
+                                                 entropy[ys, xs].tolist()):
+            if cell_open:
+                index.update_flat((y0 + y) * width + x0 + x, cell_entropy)
+                if self.recorder is not None:
+                    self.recorder.entropy(x0 + x, y0 + y, cell_entropy)
+            else:
+                index.remove_flat((y0 + y) * width + x0 + x)
+
+    def is_valid_object(self, x: int, y: int, obj: Cell) -> bool:
+        return bool(self.domains[y, x, self.rules.index[obj.id]])
+
+    def get_neighbors(self, x: int, y: int) -> List[Optional[Cell]]:
+        neighbors = []
+        for dx, dy in NEIGHBOR_OFFSETS:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < self.width and 0 <= ny < self.height:
+                neighbors.append(self.grid[ny][nx])
+        return neighbors
+
+    def calculate_weight(self, x: int, y: int, obj: Cell) -> float:
+        return float(self.weights[y, x, self.rules.index[obj.id]])
+
+    def iter_collapse(self, chunk_size: Optional[int] = None):
+        # Collapse the rest of the grid, yielding a CollapseEvent per cell set, or lists of chunk_size of them
+        return iter_collapse(self, chunk_size)
+
+    def iter_smooth(self, chunk_size: Optional[int] = None):
+        # Smooth with the worklist, yielding a CollapseEvent per cell changed, or lists of chunk_size of them
+        if self._smooth_worklist is None:
+            self._smooth_worklist = SmoothWorklist(self, self.connector_name)
+        return iter_smooth(self._smooth_worklist, chunk_size)
+
+    def index_array(self) -> np.ndarray:
+        return self.map.copy()
+
+    def smooth(self) -> bool:
+        # Change one cell with the smoothing worklist, False once there is nothing left to change
+        if self._smooth_worklist is None:
+            self._smooth_worklist = SmoothWorklist(self, self.connector_name)
+        worklist = self._smooth_worklist
+        changes = worklist.changes
+        while worklist.run(1):
+            if worklist.changes != changes:
+                return True
+        return worklist.changes != changes
+
+    def smooth_vectorized(self, exact: bool = False) -> int:
+        # Smooth the whole grid to a fixpoint in one call, returns the number of cell changes
+        connector = self.rules.index[self.connector_name] if self.connector_name else None
+        return smooth_indices(self.map, len(self.rules), connector, exact=exact)
+
+    def smooth_incremental(self, budget: Optional[int] = None) -> bool:
+        # Worklist smoothing, looks at no more than budget cells per call and returns True while work remains
+        if self._smooth_worklist is None:
+            self._smooth_worklist = SmoothWorklist(self, self.connector_name)
+        return self._smooth_worklist.run(budget)
+
+    def add_random(self, id: str, size: int = 1) -> None:
+        biome = self.rules.index[id]
+        for x, y in self.random_cross(size):
+            self.set_index(x, y, biome)
+
+    def random_cross(self, size: int) -> List[Tuple[int, int]]:
+        # Cells of a cross with arms of size at a random spot, drawn the way add_random places them
+        offset = size - 1
+        x = self.rng.randint(0 + offset, self.width - offset - 1)
+        y = self.rng.randint(0 + offset, self.height - offset - 1)
+        cross = [(x + dx, y) for dx in range(-size, size + 1) if 0 <= x + dx < self.width]
+        return cross + [(x, y + dy) for dy in range(-size, size + 1) if 0 <= y + dy < self.height]
+
+    def add_many(self, seeds: Sequence[Tuple[str, int]]) -> None:
+        # Stamp the same crosses as calling add_random for each (id, size), with one rebuild
+        index = self.rules.index
+        self.set_cells([(x, y, index[id]) for id, size in seeds for x, y in self.random_cross(size)])
+
+    def stamp(self, mask: Any, id: str) -> None:
+        # Pin the cells of a height x width mask to one biome, e.g. an area painted in an editor
+        biome = self.rules.index[id]
+        self.set_cells([(x, y, biome) for x, y in mask_cells(mask, self.width, self.height)])
+
+    def save(self, path: str, codec: str = 'raw') -> int:
+        # Write the map as a map file, EMPTY where uncollapsed, returns its size in bytes. See mapgen.mapfile
+        from .mapfile import save_map
+        return save_map(path, self.index_array(), self.rules, codec)
+
+    def load(self, path: str) -> None:
+        # Pin every collapsed cell of a saved map of this grid's size, matching biomes by id
+        from .mapfile import load_map
+        self.set_cells(load_map(path).cells_for(self.rules, self.width, self.height))
+
+    def needs_work(self) -> bool:
+        return bool(len(self.entropy_index))
+
+    def remaining(self) -> int:
+        return len(self.entropy_index)
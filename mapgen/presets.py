@@ -0,0 +1,91 @@
+from typing import Dict, List, Tuple
+
+from .biomes import Biomes
+from .cell import Cell
+
+lbiomes: Biomes = Biomes()
+tbiomes: Biomes = Biomes()
+rbiomes: Biomes = Biomes()
+
+tbiomes.add_biome(Cell(id='g', color=(128, 255, 0),
+                  neighbor_weights={'g': 2, 'f': 0.38}))
+tbiomes.add_biome(Cell(id='f', color=(0, 204, 0),
+                  neighbor_weights={'f': 2, 'g': 0.4, 'F': 0.66}))
+tbiomes.add_biome(Cell(id='F', color=(0, 102, 51),
+                  neighbor_weights={'F': 2, 'f': 0.85}))
+
+
+# Define some grid objects with single character IDs and neighbor weights for first index renders
+lbiomes.add_biome(Cell(id='W', color=(0, 0, 153),
+                  neighbor_weights={'W': 1.5, "w": 0.9, 'r': 0.01}))
+lbiomes.add_biome(Cell(id='w', color=(0, 0, 204),
+                  neighbor_weights={'w': 1.5, 'W': 0.7, 'g': 0.7, 's': 0.6, 'r': 0.01}))
+lbiomes.add_biome(Cell(id='g', color=(128, 255, 0),
+                  neighbor_weights={'g': 2, 'w': 0.25, 'f': 0.35, 's': 0.35, 'h': 0.5, 'r': 0.01}))
+lbiomes.add_biome(Cell(id='f', color=(0, 204, 0),
+                  neighbor_weights={'f': 2, 'g': 0.4, 'F': 0.66, 'r': 0.01}))
+lbiomes.add_biome(Cell(id='F', color=(0, 102, 51),
+                  neighbor_weights={'F': 2, 'f': 0.85, 'r': 0.01}))
+lbiomes.add_biome(Cell(id='h', color=(102, 51, 0),
+                  neighbor_weights={'h': 2, 'g': 0.66, 'm': 0.7, 'r': 0.01}))
+lbiomes.add_biome(Cell(id='m', color=(128, 128, 128),
+                  neighbor_weights={'m': 2, 'M': 0.75, 'h': 0.8, 'r': 0.01}))
+lbiomes.add_biome(Cell(id='M', color=(192, 192, 192),
+                  neighbor_weights={'M': 2, 'm': 1.0, 'r': 0.01}))
+lbiomes.add_biome(Cell(id='s', color=(153, 153, 0),
+                  neighbor_weights={'s': 2, 'w': 0.6, 'g': 0.8, 'r': 0.01}))
+lbiomes.add_biome(Cell(id='r', color=(210, 180, 140),
+                  neighbor_weights={'r': 0.001, 'W': 0.1, 'w': 0.1, 'g': 0.1, 
+                                    'f': 0.1, 'F': 0.1, 'h': 0.1, 'm': 0.1, 'M': 0.1, 
+                                    's': 0.1, 'r': 0.01 }))
+
+
+# Define some cell types for random index renders
+rbiomes.add_biome(Cell(id='W', color=(0, 0, 153),
+                  neighbor_weights={'W': 1.3, "w": 0.9, 'r': 0.001}))
+rbiomes.add_biome(Cell(id='w', color=(0, 0, 204),
+                  neighbor_weights={'w': 1.35, 'W': 0.5, 'g': 0.7, 's': 0.6, 'r': 0.001}))
+rbiomes.add_biome(Cell(id='g', color=(128, 255, 0),
+                  neighbor_weights={'g': 2.2, 'w': 0.27, 'f': 0.38, 's': 0.18, 'h': 0.39, 'r': 0.001}))
+rbiomes.add_biome(Cell(id='f', color=(0, 204, 0),
+                  neighbor_weights={'f': 2.2, 'g': 0.65, 'F': 1.2, 'r': 0.001}))
+rbiomes.add_biome(Cell(id='F', color=(0, 102, 51),
+                  neighbor_weights={'F': 1.3, 'f': 1.0, 'r': 0.001}))
+rbiomes.add_biome(Cell(id='h', color=(102, 51, 0),
+                  neighbor_weights={'h': 2, 'g': 0.7, 'm': 1.0, 'r': 0.001}))
+rbiomes.add_biome(Cell(id='m', color=(128, 128, 128),
+                  neighbor_weights={'m': 1.2, 'M': 0.7, 'h': 0.8, 'r': 0.001}))
+rbiomes.add_biome(Cell(id='M', color=(192, 192, 192),
+                  neighbor_weights={'M': 1.2, 'm': 1.0, 'r': 0.001}))
+rbiomes.add_biome(Cell(id='s', color=(153, 153, 0),
+                  neighbor_weights={'s': 2, 'w': 0.75, 'g': 0.76, 'r': 0.001}))
+rbiomes.add_biome(Cell(id='r', color=(210, 180, 140),
+                  neighbor_weights={'r': 0.001, 'W': 0.1, 'w': 0.1, 'g': 0.1, 
+                                    'f': 0.1, 'F': 0.1, 'h': 0.1, 'm': 0.1, 'M': 0.1, 
+                                    's': 0.1}))
+
+
+# Biome sets by name, for front ends that pick one from the command line
+BIOME_SETS: Dict[str, Biomes] = {
+    'landscape': lbiomes,
+    'random': rbiomes,
+    'forest': tbiomes,
+}
+
+# Biome id used to join other biomes, smoothing won't spread it
+CONNECTOR_ID = 'r'
+
+# (biome id, size) crosses stamped with add_random before generating, as used by main.py
+DEFAULT_SEEDS: List[Tuple[str, int]] = [
+    ('s', 5),
+    ('s', 5),
+    ('W', 5),
+    ('W', 3),
+    ('W', 3),
+    ('M', 3),
+    ('M', 4),
+    ('M', 5),
+    ('F', 5),
+    ('F', 5),
+    ('F', 5),
+]
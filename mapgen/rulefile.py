@@ -0,0 +1,274 @@
+"""
+Biome sets kept in JSON or TOML rule files.
+
+    {"biomes": [
+        {"id": "g", "color": [128, 255, 0], "neighbors": {"g": 2, "f": 0.38}},
+        {"id": "f", "color": [0, 204, 0], "neighbors": {"f": 2, "g": 0.4}}
+    ]}
+
+or in TOML, one [[biomes]] table per biome with the same keys. neighbors maps the ids a
+biome may sit next to onto the weight it gives them. A file is checked before use: every
+neighbor id has to exist, a biome has to list itself, and if a lists b then b has to list a,
+since the engines only let two biomes touch when both allow it.
+
+Loading a file also writes a compiled sidecar next to it, named after the file's sha256.
+Later loads of the unchanged file map the sidecar instead of parsing and compiling again.
+
+    python -m mapgen.rulefile check rules/*.json
+    python -m mapgen.rulefile export landscape rules/landscape.json
+"""
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .biomes import EMPTY, Biomes, CompiledBiomes
+from .cell import Cell
+from .exceptions import InvalidRules
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+SIDECAR_MAGIC = b'WFCR'
+SIDECAR_VERSION = 2
+SIDECAR_SUFFIX = '.wfcr'
+# magic, version, biome count, sha256 of the rule file, CompiledBiomes.digest, length of the ids block
+_HEADER = struct.Struct('<4sHH32s32sI')
+
+
+def _toml():
+    try:
+        import tomllib
+    except ImportError:
+        # Python before 3.11, the same parser is on PyPI as tomli
+        import tomli as tomllib
+    return tomllib
+
+
+def parse_rules(data: bytes, path: str) -> List[Dict[str, Any]]:
+    # The biome tables of a rule file, as plain dicts
+    if path.endswith('.toml'):
+        try:
+            document = _toml().loads(data.decode('utf-8'))
+        except ImportError:
+            raise InvalidRules(path, ["reading TOML needs Python 3.11 or the tomli package"])
+        except ValueError as e:
+            raise InvalidRules(path, [f"not valid TOML: {e}"])
+    else:
+        try:
+            document = json.loads(data, object_pairs_hook=_unique_keys)
+        except ValueError as e:
+            raise InvalidRules(path, [f"not valid JSON: {e}"])
+    biomes = document.get('biomes') if isinstance(document, dict) else None
+    if not isinstance(biomes, list) or not all(isinstance(biome, dict) for biome in biomes):
+        raise InvalidRules(path, ["expected a list of biome tables under 'biomes'"])
+    return biomes
+
+
+def _unique_keys(pairs: List[Tuple[str, Any]]) -> Dict[str, Any]:
+    # json keeps the last of repeated keys without a word, which hides typos in neighbor lists
+    keys = [key for key, _ in pairs]
+    repeated = sorted({key for key in keys if keys.count(key) > 1})
+    if repeated:
+        raise ValueError(f"repeated key {', '.join(map(repr, repeated))}")
+    return dict(pairs)
+
+
+def validate_rules(biomes: List[Dict[str, Any]]) -> List[str]:
+    # Everything wrong with a list of biome tables, empty when it can be compiled
+    problems = []
+    ids: List[str] = []
+    for n, biome in enumerate(biomes):
+        biome_id = biome.get('id')
+        if not isinstance(biome_id, str) or not biome_id or '\0' in biome_id:
+            problems.append(f"biome {n} has no usable id")
+            continue
+        if biome_id in ids:
+            problems.append(f"biome {biome_id!r} is defined more than once")
+        ids.append(biome_id)
+        color = biome.get('color')
+        if not (isinstance(color, list) and len(color) == 3
+                and all(isinstance(c, int) and not isinstance(c, bool) and 0 <= c <= 255 for c in color)):
+            problems.append(f"biome {biome_id!r} needs a color of three integers from 0 to 255")
+        neighbors = biome.get('neighbors')
+        if not isinstance(neighbors, dict):
+            problems.append(f"biome {biome_id!r} needs a neighbors table")
+            continue
+        for neighbor_id, weight in neighbors.items():
+            if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not weight >= 0:
+                problems.append(f"biome {biome_id!r} gives {neighbor_id!r} a weight that isn't a number >= 0")
+        if not neighbors.get(biome_id):
+            problems.append(f"biome {biome_id!r} has no weight for itself")
+    if len(ids) >= EMPTY:
+        problems.append(f"at most {EMPTY - 1} biomes are allowed, got {len(ids)}")
+
+    known = set(ids)
+    listed = {biome['id']: set(biome['neighbors']) for biome in biomes
+              if isinstance(biome.get('id'), str) and isinstance(biome.get('neighbors'), dict)}
+    for biome_id, neighbors in listed.items():
+        for neighbor_id in sorted(neighbors - known):
+            problems.append(f"biome {biome_id!r} lists unknown biome {neighbor_id!r}")
+        for neighbor_id in sorted(neighbors & known):
+            if biome_id not in listed.get(neighbor_id, ()):
+                problems.append(f"biome {biome_id!r} lists {neighbor_id!r} but {neighbor_id!r} doesn't list it back")
+    return problems
+
+
+def sidecar_path(path: str, source_digest: str) -> str:
+    return f"{path}.{source_digest[:16]}{SIDECAR_SUFFIX}"
+
+
+def write_sidecar(path: str, rules: CompiledBiomes, source_digest: str) -> str:
+    """
+    Write rules in the sidecar format and return its path. Little-endian, in order: the
+    header, the ids joined by NUL, the RGB palette, then padded to 8 bytes the compatibility
+    bitmask of every biome in ceil(B / 8) bytes each and the (B, B) float64 weight matrix.
+    """
+    count = len(rules)
+    ids = '\0'.join(rules.ids).encode('utf-8')
+    mask_bytes = (count + 7) // 8
+    blob = bytearray(_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, count, bytes.fromhex(source_digest),
+                                  bytes.fromhex(rules.digest), len(ids)))
+    blob += ids
+    for cell in rules.cells:
+        blob += bytes(cell.color)
+    blob += bytes(-len(blob) % 8)
+    for mask in rules.compat_masks:
+        blob += mask.to_bytes(mask_bytes, 'little')
+    blob += bytes(-len(blob) % 8)
+    blob += struct.pack(f'<{count * count}d', *(w for row in rules.weight_table for w in row))
+
+    target = sidecar_path(path, source_digest)
+    directory = os.path.dirname(os.path.abspath(target))
+    # Write to a temporary file and rename, so workers never map half a sidecar
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, target)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    # Sidecars of earlier versions of the file are never read again. Only exact sidecar names
+    # of this file go, so rules.json.bak.<digest>.wfcr stays when rules.json is loaded
+    stale_name = re.compile(re.escape(os.path.basename(path)) + r'\.[0-9a-f]{16}' + re.escape(SIDECAR_SUFFIX))
+    for name in os.listdir(directory):
+        stale = os.path.join(directory, name)
+        if stale_name.fullmatch(name) and stale != os.path.abspath(target):
+            os.unlink(stale)
+    return target
+
+
+def read_sidecar(sidecar: str, source_digest: str) -> Optional[CompiledBiomes]:
+    # Map a sidecar and build the rule table on top of it, None if it's missing or doesn't match
+    try:
+        with open(sidecar, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    if len(buffer) < _HEADER.size:
+        return None
+    magic, version, count, source, digest, ids_length = _HEADER.unpack_from(buffer)
+    if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION or source.hex() != source_digest:
+        return None
+    offset = _HEADER.size
+    ids = buffer[offset:offset + ids_length].decode('utf-8').split('\0') if count else []
+    offset += ids_length
+    colors = buffer[offset:offset + 3 * count]
+    offset += 3 * count
+    offset += -offset % 8
+    mask_bytes = (count + 7) // 8
+    compat_masks = [int.from_bytes(buffer[offset + i * mask_bytes:offset + (i + 1) * mask_bytes], 'little')
+                    for i in range(count)]
+    offset += count * mask_bytes
+    offset += -offset % 8
+    weights = struct.unpack_from(f'<{count * count}d', buffer, offset)
+    rows = [weights[i * count:(i + 1) * count] for i in range(count)]
+    cells = [Cell(id=biome_id, color=tuple(colors[3 * i:3 * i + 3]),
+                  neighbor_weights={ids[j]: rows[i][j] for j in range(count) if compat_masks[i] >> j & 1})
+             for i, biome_id in enumerate(ids)]
+    # The numpy weights array is a view of the mapped file
+    return CompiledBiomes.from_tables(cells, compat_masks, rows, digest.hex(), buffers={'weights': (buffer, offset)})
+
+
+def compile_rules(path: str, data: bytes) -> CompiledBiomes:
+    # Parse and validate a rule file's contents, raising InvalidRules with every problem found
+    biomes = parse_rules(data, path)
+    problems = validate_rules(biomes)
+    if problems:
+        raise InvalidRules(path, problems)
+    cells = [Cell(id=biome['id'], color=tuple(biome['color']),
+                  neighbor_weights={neighbor_id: float(weight) for neighbor_id, weight in biome['neighbors'].items()})
+             for biome in biomes]
+    return CompiledBiomes.from_cells(cells)
+
+
+def load_biomes(path: str, cache: bool = True) -> Biomes:
+    """
+    Load a JSON or TOML rule file as a Biomes set. With cache, a sidecar written for the
+    same file contents is used instead of parsing, and one is written if there isn't any;
+    failing to write it (say, a read-only directory) only costs the next load a compile.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    source_digest = hashlib.sha256(data).hexdigest()
+    rules = read_sidecar(sidecar_path(path, source_digest), source_digest) if cache else None
+    if rules is None:
+        rules = compile_rules(path, data)
+        if cache:
+            try:
+                write_sidecar(path, rules, source_digest)
+            except OSError as e:
+                logger.warning("Couldn't write a compiled sidecar for %s: %s", path, e)
+    biomes = Biomes(list(rules.cells))
+    biomes._compiled = rules
+    return biomes
+
+
+def dump_biomes(biomes: Biomes, path: str) -> None:
+    # Write a biome set as a JSON rule file
+    document = {'biomes': [{'id': cell.id, 'color': list(cell.color), 'neighbors': dict(cell.neighbor_weights)}
+                           for cell in biomes.biomes]}
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=1)
+        f.write('\n')
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    from .presets import BIOME_SETS
+
+    parser = argparse.ArgumentParser(prog='python -m mapgen.rulefile', description='Check and convert biome rule files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    check = commands.add_parser('check', help='validate rule files and write their compiled sidecars')
+    check.add_argument('paths', nargs='+')
+    check.add_argument('--no-cache', dest='cache', action='store_false', help="don't write sidecars")
+    export = commands.add_parser('export', help='write one of the built in biome sets as a JSON rule file')
+    export.add_argument('name', choices=sorted(BIOME_SETS))
+    export.add_argument('path')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if args.command == 'export':
+        dump_biomes(BIOME_SETS[args.name], args.path)
+        return 0
+    failed = 0
+    for path in args.paths:
+        try:
+            biomes = load_biomes(path, args.cache)
+        except (InvalidRules, OSError) as e:
+            failed += 1
+            for problem in getattr(e, 'problems', [str(e)]):
+                logger.error("%s: %s", path, problem)
+            continue
+        logger.info("%s: %s biomes ok", path, len(biomes.biomes))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,227 @@
+import logging
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, Iterator, List, Optional, Tuple
+
+from .biomes import EMPTY
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Same neighbor order as get_neighbors in the grids. Counter.most_common breaks ties by
+# first appearance, so the order matters for matching the cell by cell smooth()
+NEIGHBOR_OFFSETS: Tuple[Tuple[int, int], ...] = tuple(
+    (dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx != 0 or dy != 0
+)
+
+# A cell keeps its biome once this many neighbors share it
+KEEP_COUNT = 3
+
+
+def smooth_targets(neighbors: "np.ndarray", current: "np.ndarray", biome_count: int, connector: Optional[int] = None) -> "np.ndarray":
+    """
+    Apply the smooth() rule to a batch of cells. neighbors is (8, ...) in NEIGHBOR_OFFSETS
+    order with EMPTY for missing neighbors, current is the matching (...) array of cell
+    biomes. Returns the biome each cell should end up with.
+    """
+    import numpy as np
+    counts = np.empty((biome_count,) + current.shape, dtype=np.int16)
+    first_seen = np.empty_like(counts)
+    for biome in range(biome_count):
+        matches = neighbors == biome
+        counts[biome] = matches.sum(axis=0)
+        first_seen[biome] = np.where(counts[biome] > 0, matches.argmax(axis=0), len(NEIGHBOR_OFFSETS))
+    # Highest count wins, earlier first appearance breaks ties, as in Counter.most_common
+    rank = counts * 16 + (len(NEIGHBOR_OFFSETS) - first_seen)
+    distinct = (counts > 0).sum(axis=0)
+    if connector is not None:
+        # The connector only wins when it's the only biome around
+        rank[connector] = np.where(distinct > 1, -1, rank[connector])
+    majority = rank.argmax(axis=0)
+
+    valid = current != EMPTY
+    current_count = np.take_along_axis(counts, np.where(valid, current, 0)[np.newaxis], axis=0)[0]
+    change = valid & (distinct > 0) & (current_count < KEEP_COUNT) & (majority != current)
+    return np.where(change, majority, current).astype(np.uint8)
+
+
+def _padded(indices: "np.ndarray") -> "np.ndarray":
+    import numpy as np
+    padded = np.full((indices.shape[0] + 2, indices.shape[1] + 2), EMPTY, dtype=np.uint8)
+    padded[1:-1, 1:-1] = indices
+    return padded
+
+
+def smooth_pass(indices: "np.ndarray", biome_count: int, connector: Optional[int] = None) -> int:
+    # Updating every cell at once can flip pairs of cells back and forth forever, so the
+    # grid is split into the four (x % 2, y % 2) classes. Cells in a class are never
+    # neighbors, so each class is updated in one go from shifted views of the grid.
+    import numpy as np
+    height, width = indices.shape
+    padded = _padded(indices)
+    changes = 0
+    for oy in (0, 1):
+        for ox in (0, 1):
+            current = padded[1 + oy:1 + height:2, 1 + ox:1 + width:2]
+            neighbors = np.stack([padded[1 + oy + dy:1 + height + dy:2, 1 + ox + dx:1 + width + dx:2]
+                                  for dx, dy in NEIGHBOR_OFFSETS])
+            targets = smooth_targets(neighbors, current, biome_count, connector)
+            changes += int(np.count_nonzero(targets != current))
+            current[...] = targets
+    indices[...] = padded[1:-1, 1:-1]
+    return changes
+
+
+_wavefront_cache: "Dict[Tuple[int, int], List[Tuple[np.ndarray, np.ndarray]]]" = {}
+
+
+def _wavefronts(height: int, width: int) -> "List[Tuple[np.ndarray, np.ndarray]]":
+    # In a row-major sweep, cell (x, y) sees the new values of (x-1, y) and the row above up
+    # to (x+1, y-1), and old values everywhere else. All of those have a smaller x + 2y,
+    # and no two cells with the same x + 2y are neighbors, so each diagonal can be
+    # updated at once and still match the cell by cell order.
+    import numpy as np
+    key = (height, width)
+    if key not in _wavefront_cache:
+        ys, xs = np.indices((height, width)).reshape(2, -1)
+        step = xs + 2 * ys
+        order = np.argsort(step, kind="stable")
+        bounds = np.flatnonzero(np.diff(step[order])) + 1
+        _wavefront_cache[key] = [(ys[part], xs[part]) for part in np.split(order, bounds)]
+    return _wavefront_cache[key]
+
+
+def smooth_sweep(indices: "np.ndarray", biome_count: int, connector: Optional[int] = None) -> int:
+    # One row-major pass with the same result as running smooth() across the grid once
+    import numpy as np
+    height, width = indices.shape
+    padded = _padded(indices)
+    changes = 0
+    for ys, xs in _wavefronts(height, width):
+        py, px = ys + 1, xs + 1
+        neighbors = np.stack([padded[py + dy, px + dx] for dx, dy in NEIGHBOR_OFFSETS])
+        current = padded[py, px]
+        targets = smooth_targets(neighbors, current, biome_count, connector)
+        changed = targets != current
+        if changed.any():
+            changes += int(np.count_nonzero(changed))
+            padded[py, px] = targets
+    indices[...] = padded[1:-1, 1:-1]
+    return changes
+
+
+def smooth_indices(indices: "np.ndarray", biome_count: int, connector: Optional[int] = None,
+                   exact: bool = False, max_passes: int = 64) -> int:
+    """
+    Smooth a uint8 index array in place until nothing changes, returning the number of
+    cell changes. exact=True repeats row-major sweeps and ends in the same map as calling
+    smooth() until it returns False. Otherwise whole-grid passes are used, which apply the
+    same rule in a different cell order; if those haven't settled after max_passes the
+    rest is finished with exact sweeps.
+    """
+    total = 0
+    if not exact:
+        for _ in range(max_passes):
+            changes = smooth_pass(indices, biome_count, connector)
+            total += changes
+            if not changes:
+                return total
+        logger.debug("smooth passes did not settle after %s passes, finishing with sweeps", max_passes)
+    while True:
+        changes = smooth_sweep(indices, biome_count, connector)
+        total += changes
+        if not changes:
+            return total
+
+
+def smooth_grid(grid, connector_id: Optional[str] = None, exact: bool = False) -> int:
+    # Run smooth_indices over one of the Grid engines and write back the changed cells
+    import numpy as np
+    rules = grid.rules
+    indices = rules.encode(grid.grid)
+    before = indices.copy()
+    connector = rules.index[connector_id] if connector_id else None
+    changes = smooth_indices(indices, len(rules), connector, exact=exact)
+    for y, x in zip(*np.nonzero(indices != before)):
+        grid.grid[y][x] = rules.cells[indices[y, x]]
+    return changes
+
+
+class SmoothWorklist:
+    """
+    Incremental version of smooth() for the Grid engines. Every cell is queued once, and
+    after that only the neighbors of a cell that changed are queued again, so the work
+    done follows the number of changes instead of passes over the whole grid.
+    """
+
+    def __init__(self, grid, connector_id: Optional[str] = None):
+        self.grid = grid
+        self.rules = grid.rules
+        self.connector: Optional[int] = self.rules.index[connector_id] if connector_id else None
+        self.width: int = grid.width
+        self.height: int = grid.height
+        self.queue: Deque[int] = deque(range(self.width * self.height))
+        self.queued = bytearray(b"\x01" * (self.width * self.height))
+        self.processed = 0
+        self.changes = 0
+
+    def __len__(self) -> int:
+        return len(self.queue)
+
+    def run(self, budget: Optional[int] = None) -> bool:
+        # Process up to budget cells, returns True while there is still work queued
+        for _ in self.iter_changes(budget):
+            pass
+        return bool(self.queue)
+
+    def iter_changes(self, budget: Optional[int] = None) -> Iterator[Tuple[int, int, int]]:
+        # Like run, yielding (x, y, new biome index) for every cell that changes
+        queue = self.queue
+        steps = 0
+        while queue and (budget is None or steps < budget):
+            flat = queue.popleft()
+            self.queued[flat] = 0
+            steps += 1
+            self.processed += 1
+            y, x = divmod(flat, self.width)
+            target = self.target(x, y)
+            if target is not None:
+                self.grid.grid[y][x] = self.rules.cells[target]
+                self.changes += 1
+                self._requeue(x, y)
+                yield x, y, target
+
+    def target(self, x: int, y: int) -> Optional[int]:
+        # The biome index smooth() would change (x, y) to, or None to leave it alone
+        current_cell = self.grid.grid[y][x]
+        if current_cell is None:
+            return None
+        index = self.rules.index
+        counts: Dict[int, int] = {}
+        for dx, dy in NEIGHBOR_OFFSETS:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < self.width and 0 <= ny < self.height:
+                neighbor = self.grid.grid[ny][nx]
+                if neighbor is not None:
+                    biome = index[neighbor.id]
+                    counts[biome] = counts.get(biome, 0) + 1
+        current = index[current_cell.id]
+        if not counts or counts.get(current, 0) >= KEEP_COUNT:
+            return None
+        # Strict comparison keeps the first biome seen on ties, like Counter.most_common
+        majority, best = None, 0
+        for biome, count in counts.items():
+            if count > best and (biome != self.connector or len(counts) == 1):
+                majority, best = biome, count
+        return None if majority == current else majority
+
+    def _requeue(self, x: int, y: int) -> None:
+        for dx, dy in NEIGHBOR_OFFSETS:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < self.width and 0 <= ny < self.height:
+                flat = ny * self.width + nx
+                if not self.queued[flat]:
+                    self.queued[flat] = 1
+                    self.queue.append(flat)
@@ -0,0 +1,168 @@
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Iterator, List, Optional, Tuple
+
+from .biomes import EMPTY, CompiledBiomes
+from .cell import Cell
+from .smoothing import NEIGHBOR_OFFSETS
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+# Grids with more cells than this work neighbors out per lookup instead of holding a table,
+# which costs well over 100 bytes a cell, and their tables aren't cached either
+TABLE_CELLS = 1 << 18
+
+
+def _cell_neighbors(x: int, y: int, width: int, height: int, wrap: bool) -> Tuple[Tuple[int, int], ...]:
+    # (direction, neighbor flat index) pairs of one cell, see neighbor_directions
+    neighbors = []
+    for d, (dx, dy) in enumerate(NEIGHBOR_OFFSETS):
+        nx, ny = x + dx, y + dy
+        if wrap:
+            nx, ny = nx % width, ny % height
+        elif not (0 <= nx < width and 0 <= ny < height):
+            continue
+        neighbors.append((d, ny * width + nx))
+    return tuple(neighbors)
+
+
+def _neighbors(width: int, height: int, wrap: bool) -> Iterator[Tuple[Tuple[int, int], ...]]:
+    for y in range(height):
+        for x in range(width):
+            yield _cell_neighbors(x, y, width, height, wrap)
+
+
+class ComputedNeighbors:
+    """
+    Stands in for neighbor_directions, neighbor_table or neighbor_coords (picked by kind)
+    on grids above TABLE_CELLS, such as the full-width bands of mapgen.banded. Entries
+    are worked out when looked up, with a shortcut for cells away from the edges.
+    """
+    __slots__ = ('width', 'height', 'wrap', 'kind', '_offsets', '_flat_offsets')
+
+    def __init__(self, width: int, height: int, wrap: bool, kind: str):
+        self.width = width
+        self.height = height
+        self.wrap = wrap
+        self.kind = kind
+        self._offsets = tuple((d, dy * width + dx) for d, (dx, dy) in enumerate(NEIGHBOR_OFFSETS))
+        self._flat_offsets = tuple(offset for _, offset in self._offsets)
+
+    def __len__(self) -> int:
+        return self.width * self.height
+
+    def __getitem__(self, flat: int) -> Tuple[Any, ...]:
+        width = self.width
+        y, x = divmod(flat, width)
+        if 0 < x < width - 1 and 0 < y < self.height - 1:
+            if self.kind == 'flat':
+                # lgrid's lookups, by far the most frequent
+                return tuple(map(flat.__add__, self._flat_offsets))
+            pairs = tuple((d, flat + offset) for d, offset in self._offsets)
+        else:
+            pairs = _cell_neighbors(x, y, width, self.height, self.wrap)
+        if self.kind == 'directions':
+            return pairs
+        if self.kind == 'flat':
+            return tuple(neighbor for _, neighbor in pairs)
+        return tuple((neighbor % width, neighbor // width) for _, neighbor in pairs)
+
+
+def neighbor_directions(width: int, height: int, wrap: bool = False) -> Any:
+    """
+    For every flat index y * width + x, the (direction, neighbor flat index) pairs of its
+    neighbors, direction being an index into NEIGHBOR_OFFSETS. Off-grid neighbors are left
+    out, or with wrap the grid is a torus and every cell has all 8.
+    """
+    if width * height > TABLE_CELLS:
+        return ComputedNeighbors(width, height, wrap, 'directions')
+    return _neighbor_directions(width, height, wrap)
+
+
+def neighbor_table(width: int, height: int, wrap: bool = False) -> Any:
+    # Neighbor flat indices per flat index, in NEIGHBOR_OFFSETS order
+    if width * height > TABLE_CELLS:
+        return ComputedNeighbors(width, height, wrap, 'flat')
+    return _neighbor_table(width, height, wrap)
+
+
+def neighbor_coords(width: int, height: int, wrap: bool = False) -> Any:
+    # Neighbor (x, y) pairs per flat index, for engines that keep rows
+    if width * height > TABLE_CELLS:
+        return ComputedNeighbors(width, height, wrap, 'coords')
+    return _neighbor_coords(width, height, wrap)
+
+
+@lru_cache(maxsize=4)
+def _neighbor_directions(width: int, height: int, wrap: bool) -> Tuple[Tuple[Tuple[int, int], ...], ...]:
+    return tuple(_neighbors(width, height, wrap))
+
+
+@lru_cache(maxsize=4)
+def _neighbor_table(width: int, height: int, wrap: bool) -> Tuple[Tuple[int, ...], ...]:
+    # Every cell's index is one shared int object, which keeps the table to about 150 bytes per cell
+    flats = list(range(width * height))
+    return tuple(tuple(flats[flat] for _, flat in neighbors) for neighbors in _neighbors(width, height, wrap))
+
+
+@lru_cache(maxsize=4)
+def _neighbor_coords(width: int, height: int, wrap: bool) -> Tuple[Tuple[Tuple[int, int], ...], ...]:
+    return tuple(tuple((flat % width, flat // width) for flat in neighbors)
+                 for neighbors in _neighbor_table(width, height, wrap))
+
+
+def mask_cells(mask: Any, width: int, height: int) -> List[Tuple[int, int]]:
+    # (x, y) of the truthy cells of a height x width mask, given as an array or nested rows
+    import numpy as np
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape != (height, width):
+        raise ValueError(f"Mask of shape {mask.shape} doesn't match a {width}x{height} grid")
+    ys, xs = np.nonzero(mask)
+    return list(zip(xs.tolist(), ys.tolist()))
+
+
+class IndexRow:
+    # One row of an IndexRows view
+    __slots__ = ('indices', 'rules')
+
+    def __init__(self, indices: "np.ndarray", rules: CompiledBiomes):
+        self.indices = indices
+        self.rules = rules
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, x: int) -> Optional[Cell]:
+        i = self.indices[x]
+        return None if i == EMPTY else self.rules.cells[i]
+
+    def __setitem__(self, x: int, cell: Optional[Cell]) -> None:
+        self.indices[x] = EMPTY if cell is None else self.rules.index[cell.id]
+
+    def __iter__(self) -> Iterator[Optional[Cell]]:
+        cells = self.rules.cells
+        return (None if i == EMPTY else cells[i] for i in self.indices.tolist())
+
+
+class IndexRows:
+    """
+    Rows of Cells over a uint8 index array, or a list of byte rows such as memoryviews, so
+    code written against the list engines' grid.grid[y][x] (display, smoothing worklist,
+    encode) also works on engines that keep one byte per cell. Writes go straight to the
+    index array.
+    """
+    __slots__ = ('indices', 'rules')
+
+    def __init__(self, indices: "np.ndarray", rules: CompiledBiomes):
+        self.indices = indices
+        self.rules = rules
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, y: int) -> IndexRow:
+        return IndexRow(self.indices[y], self.rules)
+
+    def __iter__(self) -> Iterator[IndexRow]:
+        return (IndexRow(row, self.rules) for row in self.indices)
@@ -0,0 +1,235 @@
+"""
+Parallel generation of one large map, split into tiles solved in separate processes.
+
+    python -m mapgen.tiled --width 4000 --height 2000 --tile 256 --workers 8 --seed 0 --out big.npy
+
+The map lives in a multiprocessing.shared_memory block holding the uint8 index array,
+which every worker maps, so tiles are written in place rather than sent back. Tiles are
+separated by seam strips a few cells wide and are solved without looking at each other.
+The seams are solved afterwards, each against the tile cells around it: first the
+vertical seam pieces between two tiles, then the horizontal strips, crossings included.
+Within each phase no two regions touch, so they can run at the same time.
+
+A seam that can't be fitted between the tiles on either side is solved again locally,
+with the region grown into those tiles so the cells next to it can change too.
+"""
+import argparse
+import logging
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .biomes import EMPTY, Biomes
+from .exceptions import ImpossibleWorld
+from .generate import ENGINES, generate_map, make_grid, seeds_that_fit
+from .presets import BIOME_SETS, CONNECTOR_ID, DEFAULT_SEEDS
+from .smoothing import smooth_indices
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+TILE = 256
+SEAM = 2
+# Margins tried, in cells, when a region is solved again after failing
+REGROW = (2, 4, 8, 16)
+
+Rect = Tuple[int, int, int, int]
+
+
+def split(length: int, tile: int, seam: int) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    # Tile and seam spans along one axis: tile, seam, tile, ... with the remainder in the last tile
+    tiles, seams = [], []
+    start = 0
+    while start < length:
+        end = min(start + tile, length)
+        if length - end - seam < tile / 2:
+            # What's left after this tile and a seam would make a sliver of a tile, so this tile takes it
+            end = length
+        tiles.append((start, end))
+        if end < length:
+            seams.append((end, end + seam))
+        start = end + seam
+    return tiles, seams
+
+
+def layout(width: int, height: int, tile: int, seam: int) -> Tuple[List[Rect], List[Rect], List[Rect]]:
+    # (x0, y0, x1, y1) rects of the tiles, the vertical seam pieces between them and the horizontal seam strips
+    columns, column_seams = split(width, tile, seam)
+    rows, row_seams = split(height, tile, seam)
+    tiles = [(x0, y0, x1, y1) for y0, y1 in rows for x0, x1 in columns]
+    vertical = [(x0, y0, x1, y1) for y0, y1 in rows for x0, x1 in column_seams]
+    horizontal = [(0, y0, width, y1) for y0, y1 in row_seams]
+    return tiles, vertical, horizontal
+
+
+def solve_region(out: np.ndarray, rect: Rect, biomes: Biomes, engine: str, connector: Optional[str],
+                 seeds: Sequence[Tuple[str, int]], region_seed: int, retries: int = 3,
+                 use_random: Optional[bool] = None) -> int:
+    """
+    Solve the cells in rect and write them into out. Solved cells in the one cell ring
+    around rect are pinned first, so the region fits against them; cells inside rect are
+    solved from scratch whatever they held. Returns the attempts it took.
+    """
+    height, width = out.shape
+    x0, y0, x1, y1 = rect
+    # Window with the context ring, clipped to the map
+    wx0, wy0, wx1, wy1 = max(x0 - 1, 0), max(y0 - 1, 0), min(x1 + 1, width), min(y1 + 1, height)
+    window = np.array(out[wy0:wy1, wx0:wx1])
+    window[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0] = EMPTY
+    pinned = list(zip(*np.nonzero(window != EMPTY)))
+    seeds = seeds_that_fit(seeds, wx1 - wx0, wy1 - wy0)
+    attempts_rng = random.Random(region_seed)
+    for attempt in range(1, retries + 2):
+        grid = make_grid(engine, biomes, wx1 - wx0, wy1 - wy0, connector, use_random,
+                         seed=attempts_rng.getrandbits(64))
+        try:
+            grid.add_many(seeds)
+            # Pinned after the stamps, so a stamp landing on the ring is overwritten
+            grid.set_cells([(int(x), int(y), int(window[y, x])) for y, x in pinned])
+            while grid.needs_work():
+                grid.collapse_least_entropy_cell()
+        except ImpossibleWorld as e:
+            logger.debug("Region %s attempt %s failed: %s", rect, attempt, e.args[0])
+            continue
+        solved = grid.index_array()
+        out[y0:y1, x0:x1] = solved[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0]
+        return attempt
+    raise ImpossibleWorld(f"Cannot resolve region {rect} after {retries + 1} attempts")
+
+
+# Per-process state of the pool workers, set up once by _init_worker
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(name: str, shape: Tuple[int, int], params: Dict[str, Any]) -> None:
+    block = shared_memory.SharedMemory(name=name)
+    _worker.update(params, block=block, out=np.ndarray(shape, dtype=np.uint8, buffer=block.buf))
+
+
+def _solve_task(task: Tuple[Rect, int, bool]) -> Tuple[Rect, bool]:
+    rect, region_seed, stamp = task
+    try:
+        solve_region(_worker['out'], rect, _worker['biomes'], _worker['engine'], _worker['connector'],
+                     _worker['seeds'] if stamp else (), region_seed, _worker['retries'], _worker['use_random'])
+    except ImpossibleWorld as e:
+        # A region that can't be solved is left to regrow in the parent rather than ending the run
+        logger.debug("Region %s failed: %s", rect, e)
+        return rect, False
+    return rect, True
+
+
+def regrow(out: np.ndarray, rect: Rect, params: Dict[str, Any], region_seed: int) -> None:
+    # Solve rect again together with a growing margin of the cells around it
+    height, width = out.shape
+    x0, y0, x1, y1 = rect
+    for margin in REGROW:
+        grown = (max(x0 - margin, 0), max(y0 - margin, 0), min(x1 + margin, width), min(y1 + margin, height))
+        try:
+            solve_region(out, grown, params['biomes'], params['engine'], params['connector'], (), region_seed,
+                         params['retries'], params['use_random'])
+        except ImpossibleWorld:
+            continue
+        logger.debug("Region %s solved again with a margin of %s", rect, margin)
+        return
+    raise ImpossibleWorld(f"Cannot reconcile region {rect} with its neighbors")
+
+
+def generate_tiled(biomes: Biomes, width: int, height: int, seed: Optional[int] = None, tile: int = TILE,
+                   seam: int = SEAM, workers: Optional[int] = None, engine: str = 'cgrid',
+                   seeds: Sequence[Tuple[str, int]] = (), connector: Optional[str] = CONNECTOR_ID,
+                   smooth: bool = True, retries: int = 3, use_random: Optional[bool] = None) -> np.ndarray:
+    """
+    Generate a height x width map as tiles of about tile x tile cells, solved in a pool of
+    workers processes, and return it as a uint8 index array over biomes.compile().cells.
+    seeds are stamped with add_many in every tile. The result only depends on the
+    arguments, not on the number of workers.
+    """
+    rules = biomes.compile()
+    connector = connector if connector and connector in rules.index else None
+    tiles, vertical, horizontal = layout(width, height, tile, seam)
+    region_seeds = random.Random(seed)
+    params = dict(biomes=biomes, engine=engine, connector=connector, seeds=tuple(seeds), retries=retries,
+                  use_random=use_random)
+    workers = workers or os.cpu_count() or 1
+
+    block = shared_memory.SharedMemory(create=True, size=width * height)
+    try:
+        out = np.ndarray((height, width), dtype=np.uint8, buffer=block.buf)
+        out[:] = EMPTY
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(block.name, (height, width), params)) as executor:
+            for phase, rects in (('tiles', tiles), ('vertical seams', vertical), ('horizontal seams', horizontal)):
+                start = time.perf_counter()
+                tasks = [(rect, region_seeds.getrandbits(64), phase == 'tiles') for rect in rects]
+                results = list(executor.map(_solve_task, tasks))
+                # Failures are solved again here, one at a time, since a grown region can reach its neighbors'
+                failed = [(rect, region_seed) for (rect, ok), (_, region_seed, _) in zip(results, tasks) if not ok]
+                for rect, region_seed in failed:
+                    regrow(out, rect, params, region_seed)
+                logger.debug("Solved %s %s (%s solved again) in %.2fs", len(rects), phase, len(failed),
+                             time.perf_counter() - start)
+        indices = out.copy()
+        del out
+    finally:
+        block.close()
+        block.unlink()
+    if smooth:
+        smooth_indices(indices, len(rules), rules.index[connector] if connector else None)
+    return indices
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m mapgen.tiled',
+                                     description='Generate one large map as tiles solved in parallel.')
+    parser.add_argument('--engine', choices=ENGINES, default='cgrid')
+    parser.add_argument('--biomes', choices=sorted(BIOME_SETS), default='random')
+    parser.add_argument('--width', type=int, required=True)
+    parser.add_argument('--height', type=int, required=True)
+    parser.add_argument('--tile', type=int, default=TILE)
+    parser.add_argument('--seam', type=int, default=SEAM)
+    parser.add_argument('--workers', type=int, default=None, help='defaults to the number of CPUs')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--retries', type=int, default=3, help='restarts allowed per region on ImpossibleWorld')
+    parser.add_argument('--out', default=None, help='.npy file to write')
+    parser.add_argument('--no-smooth', dest='smooth', action='store_false')
+    parser.add_argument('--compare', action='store_true', help='also generate the map serially and report the speedup')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    biomes = BIOME_SETS[args.biomes]
+    rules = biomes.compile()
+    seeds = [(biome_id, size) for biome_id, size in DEFAULT_SEEDS if biome_id in rules.index]
+    start = time.perf_counter()
+    try:
+        indices = generate_tiled(biomes, args.width, args.height, args.seed, args.tile, args.seam, args.workers,
+                                 args.engine, seeds, smooth=args.smooth, retries=args.retries)
+    except ImpossibleWorld as e:
+        logger.error("%s", e.args[0])
+        return 1
+    tiled = time.perf_counter() - start
+    logger.info("Tiled: %sx%s in %.2fs with %s workers", args.width, args.height, tiled,
+                args.workers or os.cpu_count() or 1)
+    if args.out:
+        np.save(args.out, indices)
+    if args.compare:
+        start = time.perf_counter()
+        try:
+            generate_map(args.engine, biomes, args.width, args.height, seeds, args.seed or 0, smooth=args.smooth,
+                         retries=args.retries)
+        except ImpossibleWorld as e:
+            logger.error("Serial: %s", e.args[0])
+            return 1
+        serial = time.perf_counter() - start
+        logger.info("Serial: %.2fs, speedup %.2fx", serial, serial / tiled)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
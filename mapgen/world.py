@@ -0,0 +1,227 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+import numpy as np
+
+from .biomes import EMPTY, Biomes, CompiledBiomes
+from .cache import LRUCache
+from .cell import Cell
+from .exceptions import ImpossibleWorld
+from .generate import make_grid
+from .presets import CONNECTOR_ID
+from .smoothing import NEIGHBOR_OFFSETS, smooth_indices
+
+# Creating a logger
+logger: logging.Logger = logging.getLogger(__name__)
+
+ChunkKey = Tuple[int, int]
+
+# Written next to the chunks, so a directory is only ever continued with the settings that made it
+MANIFEST_NAME = 'world.json'
+CHUNK_NAME = re.compile(r'(-?\d+)_(-?\d+)\.npy')
+
+
+def chunk_seed(seed: int, cx: int, cy: int) -> int:
+    # Stable across runs and platforms, unlike hash()
+    digest = hashlib.blake2b(f"{seed}:{cx}:{cy}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class ChunkCache(LRUCache[np.ndarray]):
+    """
+    LRU cache of chunks that writes an evicted chunk to <directory>/<cx>_<cy>.npy if it
+    hasn't been saved yet, so it can be loaded back instead of generated again.
+    """
+
+    def __init__(self, directory: str, maxsize: Optional[int] = 256):
+        super().__init__(maxsize)
+        self.directory = directory
+        self.unsaved: Set[Hashable] = set()
+        self.spills = 0
+        self.loads = 0
+
+    def path(self, key: ChunkKey) -> str:
+        cx, cy = key
+        return os.path.join(self.directory, f"{cx}_{cy}.npy")
+
+    def add(self, key: ChunkKey, value: np.ndarray) -> None:
+        # A chunk that isn't on disk yet, saved straight away if the cache can't hold it
+        self.unsaved.add(key)
+        self.put(key, value)
+        if key not in self._data:
+            self.save(key, value)
+
+    def evict(self, key: Hashable, value: np.ndarray) -> None:
+        super().evict(key, value)
+        if key in self.unsaved:
+            self.save(key, value)
+
+    def save(self, key: ChunkKey, value: np.ndarray) -> None:
+        np.save(self.path(key), value)
+        self.unsaved.discard(key)
+        self.spills += 1
+
+    def load(self, key: ChunkKey) -> np.ndarray:
+        chunk = np.load(self.path(key))
+        chunk.setflags(write=False)
+        self.loads += 1
+        self.put(key, chunk)
+        return chunk
+
+    def flush(self) -> None:
+        for key in list(self.unsaved):
+            self.save(key, self._data[key])
+
+
+class ChunkedWorld:
+    """
+    Unbounded map made of chunk_size x chunk_size chunks, generated the first time they're
+    looked at. Chunk (cx, cy) covers world cells cx * chunk_size <= x < (cx + 1) * chunk_size
+    and likewise for y; coordinates can be negative.
+
+    A new chunk is solved with one of the Grid engines on a grid one cell bigger on every
+    side, with that ring pinned to the edge cells of neighbor chunks that already exist, so
+    it fits against them. Its generator is seeded from the world seed and the chunk
+    coordinates, but what it looks like still depends on which neighbors existed when it
+    was made. Chunks are kept in a ChunkCache and spilled to directory (a temporary one if
+    not given) when evicted; a directory that already holds chunks continues that world,
+    as long as its manifest agrees on chunk size, seed and rules.
+    """
+
+    def __init__(self, biomes: Biomes, chunk_size: int = 64, seed: int = 0, cache_size: Optional[int] = 256,
+                 directory: Optional[str] = None, engine: str = 'lgrid', connector: Optional[str] = CONNECTOR_ID,
+                 smooth: bool = True, retries: int = 3):
+        self.biomes = biomes
+        self.rules: CompiledBiomes = biomes.compile()
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.engine = engine
+        self.connector = connector if connector in self.rules.index else None
+        self.smooth = smooth
+        self.retries = retries
+        self._tempdir: Optional[tempfile.TemporaryDirectory] = None
+        if directory is None:
+            self._tempdir = tempfile.TemporaryDirectory(prefix='mapgen-world-')
+            directory = self._tempdir.name
+        os.makedirs(directory, exist_ok=True)
+        self.check_manifest(directory)
+        self.cache = ChunkCache(directory, cache_size)
+        # Every chunk that exists, in the cache or on disk
+        self.generated: Set[ChunkKey] = set()
+        for name in os.listdir(directory):
+            match = CHUNK_NAME.fullmatch(name)
+            if match:
+                self.generated.add((int(match.group(1)), int(match.group(2))))
+
+    def manifest(self) -> Dict[str, Any]:
+        return {'chunk_size': self.chunk_size, 'seed': self.seed, 'rules': self.rules.digest}
+
+    def check_manifest(self, directory: str) -> None:
+        # Write the manifest of a new world, or make sure an existing one was made with the same settings
+        path = os.path.join(directory, MANIFEST_NAME)
+        expected = self.manifest()
+        try:
+            with open(path) as f:
+                found = json.load(f)
+        except FileNotFoundError:
+            with open(path, 'w') as f:
+                json.dump(expected, f, indent=1)
+            return
+        problems = [f"{key} is {found.get(key)!r}, not {value!r}" for key, value in expected.items()
+                    if found.get(key) != value]
+        if problems:
+            raise ValueError(f"{directory} holds a different world: {'; '.join(problems)}")
+
+    def chunk(self, cx: int, cy: int) -> np.ndarray:
+        # Read-only uint8 index array over rules.cells, indexed [y, x] within the chunk
+        key = (cx, cy)
+        chunk = self.cache.get(key)
+        if chunk is not None:
+            return chunk
+        if key in self.generated:
+            return self.cache.load(key)
+        chunk = self.generate_chunk(cx, cy)
+        self.generated.add(key)
+        self.cache.add(key, chunk)
+        return chunk
+
+    def biome_at(self, x: int, y: int) -> int:
+        size = self.chunk_size
+        return int(self.chunk(x // size, y // size)[y % size, x % size])
+
+    def cell_at(self, x: int, y: int) -> Cell:
+        return self.rules.cells[self.biome_at(x, y)]
+
+    def region(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        # Index array of world cells x0 <= x < x1, y0 <= y < y1, generating chunks as needed
+        size = self.chunk_size
+        out = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+        for cy in range(y0 // size, (y1 - 1) // size + 1):
+            for cx in range(x0 // size, (x1 - 1) // size + 1):
+                chunk = self.chunk(cx, cy)
+                top, left = cy * size, cx * size
+                ys = slice(max(y0, top), min(y1, top + size))
+                xs = slice(max(x0, left), min(x1, left + size))
+                out[ys.start - y0:ys.stop - y0, xs.start - x0:xs.stop - x0] = \
+                    chunk[ys.start - top:ys.stop - top, xs.start - left:xs.stop - left]
+        return out
+
+    def border(self, cx: int, cy: int) -> np.ndarray:
+        # (size + 2)^2 array with the ring taken from existing neighbor chunks, EMPTY elsewhere
+        size = self.chunk_size
+        ring = np.full((size + 2, size + 2), EMPTY, dtype=np.uint8)
+        for dx, dy in NEIGHBOR_OFFSETS:
+            key = (cx + dx, cy + dy)
+            if key not in self.generated:
+                continue
+            neighbor = self.chunk(*key)
+            # The neighbor's edge that touches this chunk lands on the matching side of the ring
+            src_y = slice(None) if dy == 0 else slice(0, 1) if dy > 0 else slice(size - 1, size)
+            src_x = slice(None) if dx == 0 else slice(0, 1) if dx > 0 else slice(size - 1, size)
+            dst_y = slice(1, size + 1) if dy == 0 else slice(size + 1, size + 2) if dy > 0 else slice(0, 1)
+            dst_x = slice(1, size + 1) if dx == 0 else slice(size + 1, size + 2) if dx > 0 else slice(0, 1)
+            ring[dst_y, dst_x] = neighbor[src_y, src_x]
+        return ring
+
+    def generate_chunk(self, cx: int, cy: int) -> np.ndarray:
+        size = self.chunk_size
+        ring = self.border(cx, cy)
+        pinned = list(zip(*np.nonzero(ring != EMPTY)))
+        seeds = random.Random(chunk_seed(self.seed, cx, cy))
+        for attempt in range(1, self.retries + 2):
+            grid = make_grid(self.engine, self.biomes, size + 2, size + 2, self.connector,
+                             seed=seeds.getrandbits(64))
+            try:
+                grid.set_cells([(int(x), int(y), int(ring[y, x])) for y, x in pinned])
+                while grid.needs_work():
+                    grid.collapse_least_entropy_cell()
+            except ImpossibleWorld as e:
+                logger.debug("Chunk %s,%s attempt %s failed: %s", cx, cy, attempt, e.args[0])
+                continue
+            indices = grid.index_array()
+            if self.smooth:
+                connector = self.rules.index[self.connector] if self.connector else None
+                smooth_indices(indices, len(self.rules), connector)
+            chunk = indices[1:-1, 1:-1].copy()
+            chunk.setflags(write=False)
+            return chunk
+        raise ImpossibleWorld(f"Cannot resolve chunk {cx},{cy} after {self.retries + 1} attempts")
+
+    def flush(self) -> None:
+        # Write every chunk that only exists in memory, so the directory holds the whole world
+        self.cache.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'chunks': len(self.generated), 'cache': self.cache.stats(),
+                'spills': self.cache.spills, 'loads': self.cache.loads}
+
+    def close(self) -> None:
+        if self._tempdir is not None:
+            self._tempdir.cleanup()
+            self._tempdir = None
@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+# Cold import time of each module, measured in a fresh interpreter every run so nothing is
+# already loaded, along with whether it dragged in numpy or pygame
+MODULES = ['mapgen.cgrid', 'mapgen.lgrid', 'mapgen.generate', 'mapgen.ngrid', 'main']
+RUNS = 5
+
+probe = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed, 'numpy' in sys.modules, 'pygame' in sys.modules)
+"""
+
+env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1', PYGAME_HIDE_SUPPORT_PROMPT='1')
+here = os.path.dirname(os.path.abspath(__file__))
+
+for module in MODULES:
+    times = []
+    for _ in range(RUNS):
+        out = subprocess.run([sys.executable, '-c', probe.format(module=module)], cwd=here, env=env,
+                             capture_output=True, text=True, check=True).stdout.split()
+        times.append(float(out[0]))
+    numpy_loaded, pygame_loaded = out[1], out[2]
+    print(f"{module:16} best {min(times) * 1000:7.1f}ms  numpy {numpy_loaded:5}  pygame {pygame_loaded}")
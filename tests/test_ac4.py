@@ -0,0 +1,82 @@
+import pytest
+
+from mapgen.ac4 import MAX_BIOMES, SupportPropagator
+from mapgen.biomes import Biomes
+from mapgen.cell import Cell
+from mapgen.cgrid import Grid
+
+
+def biome_set(count):
+    ids = [f'b{i}' for i in range(count)]
+    return Biomes([Cell(biome_id, (i, i, i), {other: 1.0 for other in ids}) for i, biome_id in enumerate(ids)])
+
+
+def test_too_many_biomes_for_supports():
+    grid = Grid(width=4, height=4, biomes=biome_set(MAX_BIOMES + 1), seed=0)
+    grid.USE_AC4 = True
+    with pytest.raises(ValueError, match='AC-4'):
+        grid.collapse_least_entropy_cell()
+
+
+def test_supports_at_the_limit():
+    grid = Grid(width=4, height=4, biomes=biome_set(MAX_BIOMES), seed=0)
+    grid.USE_AC4 = True
+    while grid.needs_work():
+        grid.collapse_least_entropy_cell()
+    assert grid.remaining() == 0
+
+
+def tight_grid(seed):
+    # c and d can't touch, so domains get pruned well beyond the collapsed cells
+    weights = {'a': {'b': 1, 'c': 0.2, 'd': 1}, 'b': {'a': 1, 'c': 0.2, 'd': 1},
+               'c': {'a': 0.2, 'b': 0.2, 'c': 1}, 'd': {'a': 1, 'b': 1}}
+    grid = Grid(width=30, height=20, biomes=Biomes([Cell(i, (0, 0, 0), w) for i, w in weights.items()]), seed=seed)
+    grid.USE_AC4 = True
+    grid.BACKTRACK_DEPTH = 32
+    return grid
+
+
+def assert_arc_consistent(grid):
+    # Every biome left in an open cell has a compatible biome left in each of its neighbors
+    compat_masks = grid.rules.compat_masks
+    for x, y in grid.open_cells:
+        states = grid.potential_states[y][x]
+        for a in range(len(grid.rules)):
+            if not states >> a & 1:
+                continue
+            for nx, ny in grid.neighbors[y * grid.width + x]:
+                assert grid.potential_states[ny][nx] & compat_masks[a]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_counts_match_a_fresh_rebuild(seed):
+    grid = tight_grid(seed)
+    for _ in range(250):
+        grid.collapse_least_entropy_cell()
+    assert_arc_consistent(grid)
+    counts = grid.supports.counts
+    states = [row[:] for row in grid.potential_states]
+    # Counting from scratch finds nothing more to prune and the same support for every biome left
+    grid._trail = None
+    fresh = SupportPropagator(grid)
+    assert grid.potential_states == states
+    biome_count = len(grid.rules)
+    for x, y in grid.open_cells:
+        base = (y * grid.width + x) * 8 * biome_count
+        for d in range(8):
+            for a in range(biome_count):
+                if states[y][x] >> a & 1:
+                    assert counts[base + d * biome_count + a] == fresh.counts[base + d * biome_count + a]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_finished_maps_follow_the_rules(seed):
+    grid = tight_grid(seed)
+    while grid.needs_work():
+        grid.collapse_least_entropy_cell()
+    compat_table = grid.rules.compat_table
+    index = grid.rules.index
+    for y in range(grid.height):
+        for x in range(grid.width):
+            for nx, ny in grid.neighbors[y * grid.width + x]:
+                assert compat_table[index[grid.grid[y][x].id]][index[grid.grid[ny][nx].id]]
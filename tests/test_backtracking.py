@@ -0,0 +1,66 @@
+import pytest
+
+from mapgen.biomes import Biomes
+from mapgen.cell import Cell
+from mapgen.cgrid import Grid
+from mapgen.exceptions import ImpossibleWorld
+from mapgen.smoothing import NEIGHBOR_OFFSETS
+
+# c and d can't touch, so a cell between them has nothing left: plain runs often hit a contradiction
+WEIGHTS = {
+    'a': {'b': 1, 'c': 0.2, 'd': 1},
+    'b': {'a': 1, 'c': 0.2, 'd': 1},
+    'c': {'a': 0.2, 'b': 0.2, 'c': 1},
+    'd': {'a': 1, 'b': 1},
+}
+SEEDS = range(10)
+
+
+def tight_biomes():
+    return Biomes([Cell(biome_id, (0, 0, 0), dict(weights)) for biome_id, weights in WEIGHTS.items()])
+
+
+def solve(seed, depth):
+    grid = Grid(width=60, height=30, biomes=tight_biomes(), seed=seed)
+    grid.BACKTRACK_DEPTH = depth
+    while grid.needs_work():
+        grid.collapse_least_entropy_cell()
+    return grid
+
+
+def assert_consistent(grid):
+    rules = grid.rules
+    for y in range(grid.height):
+        for x in range(grid.width):
+            signature = 0
+            for dx, dy in NEIGHBOR_OFFSETS:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < grid.width and 0 <= ny < grid.height:
+                    neighbor = rules.index[grid.grid[ny][nx].id]
+                    assert rules.compat_table[rules.index[grid.grid[y][x].id]][neighbor]
+                    signature += rules.signature_units[neighbor]
+            assert grid.neighbor_signatures[y][x] == signature
+
+
+def test_plain_runs_hit_contradictions():
+    failures = 0
+    for seed in SEEDS:
+        try:
+            solve(seed, 0)
+        except ImpossibleWorld:
+            failures += 1
+    assert failures > 0
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_backtracking_recovers(seed):
+    grid = solve(seed, 4)
+    assert grid.remaining() == 0
+    assert len(grid.entropy_index) == 0
+    assert_consistent(grid)
+
+
+def test_backtracking_is_counted():
+    stats = [solve(seed, 4).backtrack_stats() for seed in SEEDS]
+    assert sum(stat['backtracks'] for stat in stats) > 0
+    assert all(stat['max_depth'] <= 4 for stat in stats)
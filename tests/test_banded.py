@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from mapgen import banded
+from mapgen.banded import band_spans, generate_banded
+from mapgen.biomes import EMPTY
+from mapgen.presets import BIOME_SETS, DEFAULT_SEEDS
+from mapgen.smoothing import NEIGHBOR_OFFSETS
+
+
+def violations(indices, rules):
+    # Pairs of neighbors that the rules don't allow next to each other
+    height, width = indices.shape
+    count = 0
+    for dx, dy in NEIGHBOR_OFFSETS:
+        a = indices[max(0, -dy):height - max(0, dy), max(0, -dx):width - max(0, dx)]
+        b = indices[max(0, dy):height + min(0, dy), max(0, dx):width + min(0, dx)]
+        count += int((~rules.compatible[a, b]).sum())
+    return count
+
+
+def test_band_spans_fold_a_short_last_band():
+    assert band_spans(130, 64) == [(0, 64), (64, 130)]
+    assert band_spans(160, 64) == [(0, 64), (64, 128), (128, 160)]
+    assert band_spans(10, 64) == [(0, 10)]
+
+
+@pytest.mark.parametrize('height', [130, 131, 2])
+def test_height_not_a_multiple_of_band_rows(tmp_path, height):
+    # Seeds too big for a band are skipped rather than crashing random_cross
+    out = generate_banded(str(tmp_path / 'map.npy'), BIOME_SETS['random'], 200, height, seed=1, band_rows=64,
+                          seeds=DEFAULT_SEEDS)
+    assert out.shape == (height, 200)
+    assert not (out == EMPTY).any()
+
+
+def test_bands_fit_against_their_frontier(tmp_path):
+    # Without stamps, which are pinned whatever their neighbors, every pair of neighbors is allowed
+    biomes = BIOME_SETS['random']
+    out = generate_banded(str(tmp_path / 'map.npy'), biomes, 200, 131, seed=1, band_rows=64, smooth=False)
+    assert violations(np.asarray(out), biomes.compile()) == 0
+
+
+def test_failing_band_backs_off_into_the_band_above(tmp_path, monkeypatch):
+    solve_band = banded.solve_band
+    calls = []
+
+    def failing(biomes, width, rows, frontier, *args):
+        calls.append(rows)
+        # Every band below the first fails against the frontier it would normally get
+        if frontier is not None and rows <= 32:
+            raise banded.ImpossibleWorld("forced")
+        return solve_band(biomes, width, rows, frontier, *args)
+
+    monkeypatch.setattr(banded, 'solve_band', failing)
+    biomes = BIOME_SETS['landscape']
+    out = generate_banded(str(tmp_path / 'map.npy'), biomes, 60, 96, seed=2, band_rows=32, smooth=False)
+    assert calls == [32, 32, 36, 32, 36]
+    assert not (out == EMPTY).any()
+    assert violations(np.asarray(out), biomes.compile()) == 0
@@ -0,0 +1,23 @@
+import pytest
+
+from mapgen.biomes import Biomes
+from mapgen.cell import Cell
+from mapgen.presets import BIOME_SETS
+from mapgen.rulefile import dump_biomes, load_biomes
+
+
+@pytest.mark.parametrize('name', sorted(BIOME_SETS))
+def test_rule_file_round_trip_keeps_digest(tmp_path, name):
+    path = str(tmp_path / f'{name}.json')
+    dump_biomes(BIOME_SETS[name], path)
+    expected = BIOME_SETS[name].compile().digest
+    assert load_biomes(path, cache=False).compile().digest == expected
+    # Written on the first load, read back from the sidecar on the second
+    assert load_biomes(path).compile().digest == expected
+    assert load_biomes(path).compile().digest == expected
+
+
+def test_digest_ignores_number_types():
+    ints = Biomes([Cell('a', (1, 2, 3), {'a': 2, 'b': 1}), Cell('b', (4, 5, 6), {'b': 1, 'a': 1})])
+    floats = Biomes([Cell('a', [1, 2, 3], {'b': 1.0, 'a': 2.0}), Cell('b', [4, 5, 6], {'a': 1.0, 'b': 1.0})])
+    assert ints.compile().digest == floats.compile().digest
@@ -0,0 +1,125 @@
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from mapgen.biomes import EMPTY
+from mapgen.generate import make_grid
+from mapgen.mapfile import (BAND_ROWS, BLACK, CODECS, RUN_MAX, load_map, rle_decode, rle_encode, save_map, write_png,
+                            write_ppm)
+from mapgen.presets import BIOME_SETS
+
+RULES = BIOME_SETS['random'].compile()
+
+
+def sample_map(height=BAND_ROWS + 3, width=17, seed=0):
+    # Taller than one band, with long runs, short runs and uncollapsed cells
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, len(RULES), (height, width), dtype=np.uint8)
+    indices[:40] = 1
+    indices[-1, ::3] = EMPTY
+    return indices
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_codecs_round_trip(tmp_path, codec):
+    path = str(tmp_path / f'map.{codec}')
+    indices = sample_map()
+    size = save_map(path, indices, RULES, codec)
+    assert size == (tmp_path / f'map.{codec}').stat().st_size
+    for mmap in (True, False):
+        saved = load_map(path, mmap=mmap)
+        assert saved.codec == codec
+        assert (saved.indices == indices).all()
+        assert saved.ids == RULES.ids
+        assert saved.colors == tuple(tuple(cell.color) for cell in RULES.cells)
+        assert saved.digest == RULES.digest
+        assert not saved.indices.flags.writeable
+    assert isinstance(load_map(path).indices, np.memmap) == (codec == 'raw')
+
+
+@pytest.mark.parametrize('flat', [
+    [], [3], [3] * RUN_MAX, [3] * (RUN_MAX + 1), [3] * (3 * RUN_MAX + 7) + [4], [1, 2] * 50, [EMPTY] * 600,
+])
+def test_rle_round_trip(flat):
+    indices = np.array(flat, dtype=np.uint8).reshape(1, -1)
+    payload = rle_encode(indices)
+    assert (rle_decode(payload) == indices.reshape(-1)).all()
+    # No run is longer than a byte can count
+    assert all(payload[:len(payload) // 2])
+
+
+def test_bad_files_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        save_map(str(tmp_path / 'map'), sample_map(), RULES, 'lz4')
+    with pytest.raises(ValueError):
+        save_map(str(tmp_path / 'map'), sample_map().astype(np.int64), RULES)
+    path = tmp_path / 'map'
+    save_map(str(path), sample_map(), RULES, 'zlib')
+    path.write_bytes(path.read_bytes()[:-10])
+    with pytest.raises(ValueError):
+        load_map(str(path))
+    path.write_bytes(b'nope' + bytes(100))
+    with pytest.raises(ValueError):
+        load_map(str(path))
+
+
+@pytest.mark.parametrize('engine', ['cgrid', 'lgrid', 'grid', 'ngrid'])
+def test_grid_save_and_load(tmp_path, engine):
+    path = str(tmp_path / 'map')
+    grid = make_grid(engine, BIOME_SETS['random'], 20, 12, seed=1)
+    for _ in range(100):
+        grid.collapse_least_entropy_cell()
+    grid.save(path, codec='rle')
+    loaded = make_grid(engine, BIOME_SETS['random'], 20, 12, seed=2)
+    loaded.load(path)
+    collapsed = grid.index_array() != EMPTY
+    assert (loaded.index_array()[collapsed] == grid.index_array()[collapsed]).all()
+
+
+def read_png(path):
+    data = path.read_bytes()
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    chunks, offset = [], 8
+    while offset < len(data):
+        length, = struct.unpack_from('>I', data, offset)
+        kind, body = data[offset + 4:offset + 8], data[offset + 8:offset + 8 + length]
+        crc, = struct.unpack_from('>I', data, offset + 8 + length)
+        assert crc == zlib.crc32(kind + body)
+        chunks.append((kind, body))
+        offset += 12 + length
+    return chunks
+
+
+@pytest.mark.parametrize('scale', [1, 3])
+def test_png_holds_the_palette_and_indices(tmp_path, scale):
+    path = tmp_path / 'map.png'
+    indices = sample_map(height=BAND_ROWS + 5, width=9)
+    colors = [cell.color for cell in RULES.cells]
+    write_png(str(path), indices, colors, scale=scale)
+    chunks = read_png(path)
+    kinds = [kind for kind, _ in chunks]
+    assert kinds[:2] == [b'IHDR', b'PLTE'] and kinds[-1] == b'IEND'
+    width, height, depth, color_type = struct.unpack_from('>IIBB', chunks[0][1])
+    assert (width, height, depth, color_type) == (9 * scale, (BAND_ROWS + 5) * scale, 8, 3)
+    palette = np.frombuffer(chunks[1][1], dtype=np.uint8).reshape(-1, 3)
+    assert (palette[:len(colors)] == colors).all()
+    assert (palette[EMPTY] == BLACK).all()
+    raw = zlib.decompress(b''.join(body for kind, body in chunks if kind == b'IDAT'))
+    rows = np.frombuffer(raw, dtype=np.uint8).reshape(height, width + 1)
+    assert (rows[:, 0] == 0).all()
+    assert (rows[:, 1:] == np.repeat(np.repeat(indices, scale, axis=0), scale, axis=1)).all()
+
+
+def test_ppm_matches_the_palette(tmp_path):
+    path = tmp_path / 'map.ppm'
+    indices = sample_map(height=5, width=4)
+    colors = [cell.color for cell in RULES.cells]
+    write_ppm(str(path), indices, colors)
+    header = b'P6\n4 5\n255\n'
+    data = path.read_bytes()
+    assert data.startswith(header)
+    pixels = np.frombuffer(data[len(header):], dtype=np.uint8).reshape(5, 4, 3)
+    for (y, x), index in np.ndenumerate(indices):
+        assert tuple(pixels[y, x]) == (BLACK if index == EMPTY else tuple(colors[index]))
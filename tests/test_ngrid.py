@@ -0,0 +1,36 @@
+import numpy as np
+
+from mapgen.biomes import EMPTY
+from mapgen.ngrid import Grid
+from mapgen.presets import BIOME_SETS
+
+
+def test_window_rebuild_matches_full_rebuild():
+    grid = Grid(width=23, height=17, biomes=BIOME_SETS['random'], seed=3)
+    grid.add_many([('w', 3), ('m', 2)])
+    for _ in range(150):
+        grid.collapse_least_entropy_cell()
+    # Overwrites go through rebuild, corners and edges included
+    for x, y in [(0, 0), (22, 16), (22, 0), (0, 16), (11, 8), (5, 0)]:
+        grid.set_index(x, y, int(grid.rng.randrange(len(grid.rules))))
+    grid.set_cells([(x, y, 0) for x in range(3) for y in range(14, 17)])
+    domains, weights = grid.domains.copy(), grid.weights.copy()
+    grid.rebuild()
+    is_open = grid.map == EMPTY
+    assert (grid.domains[is_open] == domains[is_open]).all()
+    assert np.allclose(grid.weights[is_open], weights[is_open])
+
+
+def test_entropy_index_follows_the_map():
+    grid = Grid(width=30, height=20, biomes=BIOME_SETS['landscape'], seed=1)
+    grid.add_many([('w', 2)])
+    assert grid.remaining() == np.count_nonzero(grid.map == EMPTY)
+    while grid.needs_work():
+        # Same pick as a scan of the whole entropy grid, ties going to the first cell in row order
+        expected = divmod(int(np.argmin(grid.entropy_grid)), grid.width)
+        assert grid.find_least_entropy_cell_first() == expected
+        y, x = grid.find_least_entropy_cell_random()
+        assert grid.entropy_grid[y, x] == grid.entropy_grid.min()
+        grid.collapse_least_entropy_cell()
+        assert grid.remaining() == np.count_nonzero(grid.map == EMPTY)
+    assert grid.remaining() == 0
@@ -0,0 +1,81 @@
+import hashlib
+import json
+
+import pytest
+
+from mapgen.exceptions import InvalidRules
+from mapgen.presets import BIOME_SETS
+from mapgen.rulefile import (SIDECAR_SUFFIX, compile_rules, dump_biomes, load_biomes, read_sidecar, sidecar_path,
+                             validate_rules, write_sidecar)
+
+
+def biome(biome_id, neighbors, color=(1, 2, 3)):
+    return {'id': biome_id, 'color': list(color), 'neighbors': neighbors}
+
+
+def test_valid_rules_have_no_problems():
+    assert validate_rules([biome('a', {'a': 1, 'b': 0.5}), biome('b', {'b': 2, 'a': 1})]) == []
+
+
+@pytest.mark.parametrize('biomes, problem', [
+    ([biome('a', {'a': 1, 'x': 1})], "biome 'a' lists unknown biome 'x'"),
+    ([biome('a', {'a': 1, 'b': 1}), biome('b', {'b': 1})], "biome 'a' lists 'b' but 'b' doesn't list it back"),
+    ([biome('a', {'b': 1}), biome('b', {'b': 1, 'a': 1})], "biome 'a' has no weight for itself"),
+    ([biome('a', {'a': 1}), biome('a', {'a': 1})], "biome 'a' is defined more than once"),
+    ([biome('a', {'a': -1})], "biome 'a' gives 'a' a weight that isn't a number >= 0"),
+    ([biome('a', {'a': 1}, color=(0, 0, 256))], "biome 'a' needs a color of three integers from 0 to 255"),
+    ([{'color': [0, 0, 0], 'neighbors': {}}], "biome 0 has no usable id"),
+])
+def test_validation_finds_each_problem(biomes, problem):
+    assert problem in validate_rules(biomes)
+
+
+def test_repeated_json_keys_are_rejected():
+    data = b'{"biomes": [{"id": "a", "color": [1, 2, 3], "neighbors": {"a": 1, "a": 2}}]}'
+    with pytest.raises(InvalidRules) as info:
+        compile_rules('rules.json', data)
+    assert "repeated key 'a'" in info.value.problems[0]
+
+
+def test_toml_and_json_compile_the_same(tmp_path):
+    toml = tmp_path / 'rules.toml'
+    toml.write_text('[[biomes]]\nid = "a"\ncolor = [1, 2, 3]\nneighbors = { a = 2, b = 1 }\n\n'
+                    '[[biomes]]\nid = "b"\ncolor = [4, 5, 6]\nneighbors = { b = 1, a = 1 }\n')
+    document = {'biomes': [biome('a', {'a': 2, 'b': 1}), biome('b', {'b': 1, 'a': 1}, color=(4, 5, 6))]}
+    (tmp_path / 'rules.json').write_text(json.dumps(document))
+    toml_rules = load_biomes(str(toml), cache=False).compile()
+    assert toml_rules.digest == load_biomes(str(tmp_path / 'rules.json'), cache=False).compile().digest
+
+
+def test_sidecar_round_trip(tmp_path):
+    path = str(tmp_path / 'rules.json')
+    rules = BIOME_SETS['landscape'].compile()
+    source_digest = hashlib.sha256(b'anything').hexdigest()
+    sidecar = write_sidecar(path, rules, source_digest)
+    assert sidecar == sidecar_path(path, source_digest)
+    loaded = read_sidecar(sidecar, source_digest)
+    assert loaded.digest == rules.digest
+    assert loaded.ids == rules.ids
+    assert [cell.color for cell in loaded.cells] == [tuple(cell.color) for cell in rules.cells]
+    assert loaded.compat_masks == rules.compat_masks
+    assert [list(row) for row in loaded.weight_table] == [list(row) for row in rules.weight_table]
+    # A sidecar for other file contents is never used
+    assert read_sidecar(sidecar, hashlib.sha256(b'something else').hexdigest()) is None
+
+
+def test_only_this_files_stale_sidecars_are_removed(tmp_path):
+    path = tmp_path / 'rules.json'
+    dump_biomes(BIOME_SETS['random'], str(path))
+    load_biomes(str(path))
+    old = list(tmp_path.glob('*' + SIDECAR_SUFFIX))
+    assert len(old) == 1
+    others = [tmp_path / f'rules.json.bak.{"0" * 16}{SIDECAR_SUFFIX}',
+              tmp_path / f'rules.json.{"0" * 15}{SIDECAR_SUFFIX}',
+              tmp_path / f'rules.json.{"0" * 16}{SIDECAR_SUFFIX}.keep']
+    for other in others:
+        other.write_bytes(b'')
+    dump_biomes(BIOME_SETS['landscape'], str(path))
+    load_biomes(str(path))
+    assert not old[0].exists()
+    assert all(other.exists() for other in others)
+    assert len(list(tmp_path.glob('rules.json.' + '?' * 16 + SIDECAR_SUFFIX))) == 1
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from mapgen import cgrid, lgrid
+from mapgen.generate import make_grid
+from mapgen.presets import BIOME_SETS, DEFAULT_SEEDS
+from mapgen.smoothing import smooth_indices, smooth_pass
+
+
+def collapsed(engine, seed, width=40, height=25):
+    grid = make_grid(engine, BIOME_SETS['random'], width, height, 'r', seed=seed)
+    grid.add_many(DEFAULT_SEEDS[:4])
+    while grid.needs_work():
+        grid.collapse_least_entropy_cell()
+    return grid
+
+
+@pytest.mark.parametrize('engine', ['cgrid', 'lgrid'])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_exact_sweeps_match_smooth(engine, seed):
+    grid = collapsed(engine, seed)
+    rules = grid.rules
+    indices = grid.index_array()
+    changes = smooth_indices(indices, len(rules), rules.index['r'], exact=True)
+    while grid.smooth():
+        pass
+    assert changes > 0
+    assert (grid.index_array() == indices).all()
+
+
+@pytest.mark.parametrize('module', [cgrid, lgrid])
+def test_wrapped_grids_smooth_the_same_everywhere(module):
+    # wrap only changes collapsing, every smoothing entry point stops at the edges
+    grids = []
+    for _ in range(3):
+        grid = module.Grid(width=30, height=20, biomes=BIOME_SETS['random'], seed=4, wrap=True)
+        grid.connector_name = 'r'
+        grid.add_many(DEFAULT_SEEDS[:4])
+        while grid.needs_work():
+            grid.collapse_least_entropy_cell()
+        grids.append(grid)
+    while grids[0].smooth():
+        pass
+    grids[1].smooth_vectorized(exact=True)
+    while grids[2].smooth_incremental():
+        pass
+    assert (grids[0].index_array() == grids[1].index_array()).all()
+    # The worklist visits cells in another order, so it only has to end where a plain pass changes nothing
+    indices = grids[2].index_array()
+    assert smooth_pass(indices, len(grids[2].rules), grids[2].rules.index['r']) == 0
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_passes_end_in_a_fixpoint(seed):
+    grid = collapsed('cgrid', seed)
+    rules = grid.rules
+    indices = grid.index_array()
+    smooth_indices(indices, len(rules), rules.index['r'])
+    settled = indices.copy()
+    assert smooth_pass(indices, len(rules), rules.index['r']) == 0
+    assert (indices == settled).all()
+
+
+def test_connector_loses_to_any_other_biome():
+    # The connector only wins when it's the only biome around, so w spreads over it
+    rules = BIOME_SETS['random'].compile()
+    r, w, g = rules.index['r'], rules.index['w'], rules.index['g']
+    indices = np.full((3, 3), r, dtype=np.uint8)
+    indices[1, 1] = w
+    indices[0, 0] = g
+    smooth_indices(indices, len(rules), r, exact=True)
+    assert (indices == w).all()
@@ -0,0 +1,19 @@
+import pytest
+
+from mapgen import storage
+from mapgen.storage import ComputedNeighbors, neighbor_coords, neighbor_directions, neighbor_table
+
+
+@pytest.mark.parametrize('width, height, wrap', [(7, 5, False), (7, 5, True), (1, 4, False), (3, 1, True)])
+@pytest.mark.parametrize('kind, build', [('directions', neighbor_directions), ('flat', neighbor_table),
+                                         ('coords', neighbor_coords)])
+def test_computed_neighbors_match_tables(width, height, wrap, kind, build):
+    computed = ComputedNeighbors(width, height, wrap, kind)
+    assert [computed[flat] for flat in range(width * height)] == list(build(width, height, wrap))
+
+
+def test_big_grids_get_no_cached_table():
+    storage._neighbor_table.cache_clear()
+    table = neighbor_table(storage.TABLE_CELLS + 1, 1)
+    assert isinstance(table, ComputedNeighbors)
+    assert storage._neighbor_table.cache_info().currsize == 0
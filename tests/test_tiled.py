@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from mapgen import tiled
+from mapgen.biomes import EMPTY
+from mapgen.exceptions import ImpossibleWorld
+from mapgen.presets import BIOME_SETS, DEFAULT_SEEDS
+from mapgen.tiled import generate_tiled, split
+
+
+def test_split_folds_a_narrow_leftover_into_the_last_tile():
+    assert split(260, 256, 2) == ([(0, 260)], [])
+    assert split(600, 256, 2) == ([(0, 256), (258, 600)], [(256, 258)])
+    assert split(700, 256, 2) == ([(0, 256), (258, 514), (516, 700)], [(256, 258), (514, 516)])
+
+
+@pytest.mark.parametrize('width', [150, 137])
+def test_width_not_a_multiple_of_the_tile(width):
+    # 64 wide tiles leave a leftover narrower than the seeds' crosses without the fold
+    indices = generate_tiled(BIOME_SETS['random'], width, 40, seed=0, tile=64, workers=2, seeds=DEFAULT_SEEDS)
+    assert indices.shape == (40, width)
+    assert not (indices == EMPTY).any()
+
+
+_solve_region = tiled.solve_region
+
+
+def broken_solve_region(out, rect, biomes, engine, connector, seeds, *args):
+    # Stamped regions can't be solved, so every one of them has to regrow in the parent
+    if seeds:
+        raise ImpossibleWorld(f"Cannot resolve region {rect}")
+    return _solve_region(out, rect, biomes, engine, connector, seeds, *args)
+
+
+def test_region_that_raises_is_solved_again(monkeypatch):
+    # The workers are forked, so they see the patched solve_region too
+    monkeypatch.setattr(tiled, 'solve_region', broken_solve_region)
+    indices = generate_tiled(BIOME_SETS['landscape'], 70, 30, seed=0, tile=32, workers=1, seeds=[('w', 2)])
+    assert not (indices == EMPTY).any()
+
+
+def test_seeds_too_big_for_a_region_are_skipped():
+    out = np.full((6, 6), EMPTY, dtype=np.uint8)
+    tiled.solve_region(out, (0, 0, 6, 6), BIOME_SETS['random'], 'lgrid', 'r', [('W', 5), ('W', 3)], region_seed=0)
+    assert not (out == EMPTY).any()
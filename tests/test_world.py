@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from mapgen.presets import BIOME_SETS
+from mapgen.world import ChunkedWorld
+
+
+def make_world(directory, **kwargs):
+    kwargs = {'chunk_size': 8, 'seed': 3, 'cache_size': 4, 'smooth': False, **kwargs}
+    return ChunkedWorld(BIOME_SETS['random'], directory=str(directory), **kwargs)
+
+
+def test_cache_size_zero_saves_every_chunk(tmp_path):
+    world = make_world(tmp_path, cache_size=0)
+    region = world.region(-10, -10, 10, 10)
+    assert (world.region(-10, -10, 10, 10) == region).all()
+    assert world.stats()['loads'] > 0
+
+
+def test_reopened_directory_continues_the_world(tmp_path):
+    world = make_world(tmp_path)
+    region = world.region(-12, -12, 12, 12)
+    world.flush()
+    # Files that aren't chunks are left alone
+    np.save(tmp_path / 'notes.npy', np.zeros(3))
+    np.save(tmp_path / '1_2_3.npy', np.zeros(3))
+    reopened = make_world(tmp_path)
+    assert reopened.generated == world.generated
+    assert (reopened.region(-12, -12, 12, 12) == region).all()
+    assert reopened.stats()['chunks'] == world.stats()['chunks']
+
+
+@pytest.mark.parametrize('changes', [{'seed': 4}, {'chunk_size': 16}, {'biomes': BIOME_SETS['landscape']}])
+def test_reopening_with_other_settings_fails(tmp_path, changes):
+    make_world(tmp_path).region(0, 0, 8, 8)
+    kwargs = {'chunk_size': 8, 'seed': 3, 'biomes': BIOME_SETS['random'], **changes}
+    with pytest.raises(ValueError):
+        ChunkedWorld(directory=str(tmp_path), **kwargs)